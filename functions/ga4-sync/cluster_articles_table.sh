@@ -0,0 +1,51 @@
+#!/bin/bash
+
+# articlesテーブルをidでクラスタ化する一回限りのマイグレーション
+# ga4-syncのMERGE（ON T.id = S.article_id）がブロック単位のプルーニングで
+# 対象行だけを読むようになり、バッチごとのフルスキャンを避けられる
+
+# 設定値
+PROJECT_ID="seo-optimize-464208"
+TARGET_DATASET_ID="content_analysis"
+TABLE="$PROJECT_ID.$TARGET_DATASET_ID.articles"
+BACKUP_TABLE="$PROJECT_ID.$TARGET_DATASET_ID.articles_backup_$(date +%Y%m%d%H%M%S)"
+
+echo "🗂️ articlesテーブルのクラスタ化を開始..."
+echo "対象テーブル: $TABLE"
+
+# 現在のクラスタ設定を確認
+CURRENT_CLUSTERING=$(bq show --format=prettyjson "$PROJECT_ID:$TARGET_DATASET_ID.articles" | jq -r '.clustering.fields // [] | join(",")')
+if [ "$CURRENT_CLUSTERING" == "id" ]; then
+    echo "✅ 既にidでクラスタ化されています"
+    exit 0
+fi
+echo "現在のクラスタ設定: ${CURRENT_CLUSTERING:-なし}"
+
+read -p "テーブルを再作成してidでクラスタ化しますか？ (y/N): " CONFIRM
+if [ "$CONFIRM" != "y" ]; then
+    echo "中止しました"
+    exit 0
+fi
+
+# 1. バックアップ作成
+echo "💾 バックアップを作成中: $BACKUP_TABLE"
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "CREATE TABLE \`$BACKUP_TABLE\` AS SELECT * FROM \`$TABLE\`"
+
+if [ $? -ne 0 ]; then
+    echo "❌ バックアップの作成に失敗"
+    exit 1
+fi
+
+# 2. idでクラスタ化してテーブルを再作成（既存データも再配置される）
+echo "🔧 idでクラスタ化したテーブルを再作成中..."
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "CREATE OR REPLACE TABLE \`$TABLE\` CLUSTER BY id AS SELECT * FROM \`$TABLE\`"
+
+if [ $? -eq 0 ]; then
+    echo "✅ クラスタ化完了"
+    echo "問題がなければバックアップを削除してください: bq rm -f -t ${BACKUP_TABLE/./:}"
+else
+    echo "❌ クラスタ化に失敗しました（バックアップ: $BACKUP_TABLE）"
+    exit 1
+fi
@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# 同期状態テーブル（sync_state）を作成する一回限りのマイグレーション
+# ga4-syncは前回同期時のチェックサムをこのテーブルの1行にMERGEで上書きする
+# （実行時にテーブルを作成しない。既存の履歴行は最新の1行だけ残して削除する）
+
+# 設定値
+PROJECT_ID="seo-optimize-464208"
+TARGET_DATASET_ID="content_analysis"
+TABLE="$PROJECT_ID.$TARGET_DATASET_ID.sync_state"
+
+echo "🗂️ 同期状態テーブルのマイグレーションを開始..."
+echo "対象テーブル: $TABLE"
+
+# 1. テーブル作成
+echo "🔧 テーブルを作成中..."
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "CREATE TABLE IF NOT EXISTS \`$TABLE\` (
+     run_ts TIMESTAMP,
+     hash STRING,
+     updated_records INT64
+   )"
+
+if [ $? -ne 0 ]; then
+    echo "❌ テーブルの作成に失敗"
+    exit 1
+fi
+
+# 2. 以前の実行で追記された履歴行を削除し、最新の1行だけ残す
+echo "🧹 古い同期状態を削除中..."
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "DELETE FROM \`$TABLE\` WHERE run_ts < (SELECT MAX(run_ts) FROM \`$TABLE\`)"
+
+if [ $? -eq 0 ]; then
+    echo "✅ マイグレーション完了"
+else
+    echo "❌ 古い同期状態の削除に失敗しました"
+    exit 1
+fi
@@ -1,4 +1,6 @@
 import os
+import re
+import hashlib
 import logging
 from datetime import datetime, timedelta
 from google.cloud import bigquery
@@ -6,8 +8,6 @@ import functions_framework
 from typing import Dict, List, Optional, Tuple
 import concurrent.futures
 from threading import Lock
-from urllib.parse import urlparse
-import time
 import json
 
 # ログ設定
@@ -19,6 +19,7 @@ SOURCE_PROJECT_ID = 'mcs-fs-pro'
 SOURCE_DATASET_ID = 'analytics_250893262'
 TARGET_PROJECT_ID = os.environ.get('GCP_PROJECT', 'seo-optimize-464208')
 TARGET_DATASET_ID = 'content_analysis'
+SYNC_STATE_TABLE_ID = f"{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.sync_state"
 
 # GA4から取得する日数 (環境変数から取得、デフォルトは7日)
 GA4_DAYS_BACK = int(os.environ.get('GA4_DAYS_BACK', '7'))
@@ -34,6 +35,12 @@ BULK_INSERT_BATCH_SIZE = 500
 MAX_WORKERS = 2
 TIMEOUT_SECONDS = 480  # 8分のタイムアウト
 
+# URL正規化用の定数（行ごとに生成しないようモジュールレベルで定義）
+FORESIGHT_HOST = 'www.foresight.jp'
+COLUMN_PATH_MARKER = '/column/'
+# スキーム://www.foresight.jp の直後からパラメータ・クエリ・フラグメントの手前までをパスとして取得
+GA4_URL_PATTERN = re.compile(r'^[^:/?#]+://www\.foresight\.jp(?=[/?#;]|$)([^?#;]*)')
+
 class GA4DataSync:
     def __init__(self):
         self.source_client = bigquery.Client(project=SOURCE_PROJECT_ID)
@@ -49,34 +56,15 @@ class GA4DataSync:
             return True
         return False
     
-    def get_available_ga4_tables(self, days_back: int = 7) -> List[str]:
-        """利用可能なGA4テーブルを取得"""
-        try:
-            end_date = datetime.now()
-            available_tables = []
-            
-            # 過去数日分のテーブルをチェック
-            for i in range(days_back):
-                check_date = end_date - timedelta(days=i)
-                table_suffix = check_date.strftime('%Y%m%d')
-                table_name = f"{SOURCE_PROJECT_ID}.{SOURCE_DATASET_ID}.events_{table_suffix}"
-                
-                try:
-                    # テーブルの存在確認
-                    table_ref = self.source_client.get_table(table_name)
-                    available_tables.append(table_suffix)
-                    logger.info(f"利用可能なテーブル: events_{table_suffix}")
-                except Exception:
-                    logger.warning(f"テーブルが見つかりません: events_{table_suffix}")
-            
-            return available_tables
-            
-        except Exception as e:
-            logger.error(f"テーブル確認エラー: {str(e)}")
-            return []
+    def get_ga4_table_suffix_range(self, days_back: int = 7) -> Tuple[str, str]:
+        """GA4テーブルの_TABLE_SUFFIX範囲（開始日, 終了日）を取得"""
+        # GA4の日次エクスポートは翌日に作成されるため、前日までの期間を対象とする
+        end_date = datetime.now() - timedelta(days=1)
+        start_date = end_date - timedelta(days=days_back - 1)
+        return start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d')
     
     def get_ga4_pageviews_optimized(self, days_back: int = None) -> List[Dict]:
-        """最適化されたGA4データ取得（利用可能なテーブルのみ使用）"""
+        """最適化されたGA4データ取得（ワイルドカードテーブルを使用）"""
         # GA4_DAYS_BACK をデフォルト値として使用
         if days_back is None:
             days_back = GA4_DAYS_BACK
@@ -84,41 +72,24 @@ class GA4DataSync:
         if self.check_timeout("GA4データ取得開始"):
             raise TimeoutError("GA4データ取得でタイムアウト")
         
-        # 利用可能なテーブルを取得
-        available_tables = self.get_available_ga4_tables(days_back + 2) # 念のため2日余分にチェック
-        
-        if not available_tables:
-            logger.error("利用可能なGA4テーブルがありません")
-            return []
+        # 存在しない日付のテーブルはワイルドカードスキャンで自動的に除外される
+        suffix_from, suffix_to = self.get_ga4_table_suffix_range(days_back)
+        logger.info(f"使用するテーブル範囲（{days_back}日分）: events_{suffix_from} - events_{suffix_to}")
         
-        # 指定された日数分のテーブルを使用
-        tables_to_use = available_tables[:days_back]
-        logger.info(f"使用するテーブル（{len(tables_to_use)}日分）: {tables_to_use}")
-        
-        if not tables_to_use:
-            logger.warning("指定された日数に対応する利用可能なテーブルがありません。")
-            return []
+        # GA4_LIMIT の値に基づいて LIMIT 句を生成
+        limit_clause = f"LIMIT {GA4_LIMIT}" if GA4_LIMIT is not None else ""
 
-        # 複数テーブルからデータを取得するクエリに変更
-        table_queries = []
-        for table_suffix in tables_to_use:
-            table_queries.append(f"""
+        query = f"""
+        WITH combined_events AS (
             SELECT
                 (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') as page_location,
                 CONCAT(user_pseudo_id, '-', (SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'ga_session_id')) AS session_id,
                 traffic_source.medium as traffic_medium,
                 COALESCE((SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'engagement_time_msec'), 0) as engagement_time_msec,
                 event_name
-            FROM `{SOURCE_PROJECT_ID}.{SOURCE_DATASET_ID}.events_{table_suffix}`
-            WHERE (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') LIKE '%foresight.jp%column%'
-            """)
-        
-        # GA4_LIMIT の値に基づいて LIMIT 句を生成
-        limit_clause = f"LIMIT {GA4_LIMIT}" if GA4_LIMIT is not None else ""
-
-        query = f"""
-        WITH combined_events AS (
-            {' UNION ALL '.join(table_queries)}
+            FROM `{SOURCE_PROJECT_ID}.{SOURCE_DATASET_ID}.events_*`
+            WHERE _TABLE_SUFFIX BETWEEN @suffix_from AND @suffix_to
+                AND (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') LIKE '%foresight.jp%column%'
         )
         SELECT
             page_location,
@@ -138,28 +109,28 @@ class GA4DataSync:
         """
         
         try:
+            # 日付範囲はパラメータで渡し、同じ範囲の再実行でクエリキャッシュが効くようにする
             job_config = bigquery.QueryJobConfig(
                 use_query_cache=True,
                 use_legacy_sql=False,
                 maximum_bytes_billed=2 * 10**9,  # 2GB制限に削減
-                dry_run=False
+                dry_run=False,
+                query_parameters=[
+                    bigquery.ScalarQueryParameter('suffix_from', 'STRING', suffix_from),
+                    bigquery.ScalarQueryParameter('suffix_to', 'STRING', suffix_to)
+                ]
             )
             
             logger.info("GA4クエリ実行開始")
             query_job = self.source_client.query(query, job_config=job_config)
             
-            # より短い間隔でジョブの状態を監視
-            timeout_count = 0
-            while query_job.state != 'DONE':
-                if timeout_count > 10:  # 60秒待機に短縮
-                    logger.warning("GA4クエリをキャンセル中...")
-                    query_job.cancel()
-                    raise TimeoutError("GA4クエリがタイムアウトしました")
-                time.sleep(6)
-                timeout_count += 1
-                logger.info(f"GA4クエリ実行中... ({timeout_count * 6}秒経過)")
-                
-            results = query_job.result(timeout=30)
+            # ポーリングせずにジョブ完了までブロックして待機
+            try:
+                results = query_job.result(timeout=90)
+            except concurrent.futures.TimeoutError:
+                logger.warning("GA4クエリをキャンセル中...")
+                query_job.cancel()
+                raise TimeoutError("GA4クエリがタイムアウトしました")
             
             pageviews_data = []
             for row in results:
@@ -177,34 +148,16 @@ class GA4DataSync:
             
         except Exception as e:
             logger.error(f"GA4データ取得エラー: {str(e)}")
-            # 複数テーブルでフォールバックを試行
-            # フォールバック時も GA4_DAYS_BACK を考慮するように修正
-            return self.get_ga4_pageviews_multi_table_fallback(available_tables[:GA4_DAYS_BACK])
+            # 取得件数を絞ったクエリでフォールバックを試行
+            return self.get_ga4_pageviews_multi_table_fallback(days_back)
 
-    def get_ga4_pageviews_multi_table_fallback(self, available_tables: List[str]) -> List[Dict]:
+    def get_ga4_pageviews_multi_table_fallback(self, days_back: int) -> List[Dict]:
         """複数テーブルを使用したフォールバック処理"""
         logger.warning("複数テーブルフォールバックモードでGA4データを取得")
         
-        if not available_tables:
-            return []
-        
-        # 最大3つのテーブルを使用 (または GA4_DAYS_BACK の日数分)
-        tables_to_use = available_tables[:max(3, GA4_DAYS_BACK)] # 少なくとも3つ、または指定された日数分
-        logger.info(f"使用するテーブル: {tables_to_use}")
-        
-        # UNION ALLを使用して複数テーブルから取得
-        table_queries = []
-        for table_suffix in tables_to_use:
-            table_queries.append(f"""
-            SELECT
-                (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') as page_location,
-                CONCAT(user_pseudo_id, '-', (SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'ga_session_id')) AS session_id,
-                traffic_source.medium as traffic_medium,
-                COALESCE((SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'engagement_time_msec'), 0) as engagement_time_msec,
-                event_name
-            FROM `{SOURCE_PROJECT_ID}.{SOURCE_DATASET_ID}.events_{table_suffix}`
-            WHERE (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') LIKE '%foresight.jp%column%'
-            """)
+        # 最低3日分 (または GA4_DAYS_BACK の日数分)
+        suffix_from, suffix_to = self.get_ga4_table_suffix_range(max(3, days_back))
+        logger.info(f"使用するテーブル範囲: events_{suffix_from} - events_{suffix_to}")
         
         # フォールバック用のLIMIT (デフォルトは2000、GA4_LIMITが設定されていればそれを使用)
         fallback_limit = 2000 if GA4_LIMIT is None else GA4_LIMIT
@@ -212,7 +165,15 @@ class GA4DataSync:
 
         query = f"""
         WITH combined_events AS (
-            {' UNION ALL '.join(table_queries)}
+            SELECT
+                (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') as page_location,
+                CONCAT(user_pseudo_id, '-', (SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'ga_session_id')) AS session_id,
+                traffic_source.medium as traffic_medium,
+                COALESCE((SELECT value.int_value FROM UNNEST(event_params) WHERE key = 'engagement_time_msec'), 0) as engagement_time_msec,
+                event_name
+            FROM `{SOURCE_PROJECT_ID}.{SOURCE_DATASET_ID}.events_*`
+            WHERE _TABLE_SUFFIX BETWEEN @suffix_from AND @suffix_to
+                AND (SELECT value.string_value FROM UNNEST(event_params) WHERE key = 'page_location') LIKE '%foresight.jp%column%'
         )
         SELECT
             page_location,
@@ -235,21 +196,20 @@ class GA4DataSync:
             job_config = bigquery.QueryJobConfig(
                 use_query_cache=True,
                 maximum_bytes_billed=1 * 10**9,  # 1GB制限
+                query_parameters=[
+                    bigquery.ScalarQueryParameter('suffix_from', 'STRING', suffix_from),
+                    bigquery.ScalarQueryParameter('suffix_to', 'STRING', suffix_to)
+                ]
             )
             
             query_job = self.source_client.query(query, job_config=job_config)
             
-            # より短いタイムアウトでジョブを監視
-            timeout_count = 0
-            while query_job.state != 'DONE':
-                if timeout_count > 8:  # 48秒待機
-                    query_job.cancel()
-                    raise TimeoutError("フォールバッククエリがタイムアウトしました")
-                time.sleep(6)
-                timeout_count += 1
-                logger.info(f"フォールバッククエリ実行中... ({timeout_count * 6}秒経過)")
-                
-            results = query_job.result(timeout=30)
+            # ポーリングせずにジョブ完了までブロックして待機
+            try:
+                results = query_job.result(timeout=75)
+            except concurrent.futures.TimeoutError:
+                query_job.cancel()
+                raise TimeoutError("フォールバッククエリがタイムアウトしました")
             
             pageviews_data = []
             for row in results:
@@ -268,9 +228,32 @@ class GA4DataSync:
         except Exception as e:
             logger.error(f"フォールバックモードでもエラー: {str(e)}")
             # 最後の手段として最小限のデータを取得
-            return self.get_ga4_pageviews_minimal(available_tables[0] if available_tables else None)
+            return self.get_ga4_pageviews_minimal(self.get_latest_ga4_table_suffix(suffix_from, suffix_to))
 
-    def get_ga4_pageviews_minimal(self, table_suffix: str) -> List[Dict]:
+    def get_latest_ga4_table_suffix(self, suffix_from: str, suffix_to: str) -> Optional[str]:
+        """期間内に存在する最新のGA4日次テーブルのサフィックスを取得（日次エクスポートは遅れて作成されることがあるため）"""
+        try:
+            query = f"""
+            SELECT MAX(SUBSTR(table_name, 8)) AS table_suffix
+            FROM `{SOURCE_PROJECT_ID}.{SOURCE_DATASET_ID}.INFORMATION_SCHEMA.TABLES`
+            WHERE table_name BETWEEN CONCAT('events_', @suffix_from) AND CONCAT('events_', @suffix_to)
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ScalarQueryParameter('suffix_from', 'STRING', suffix_from),
+                    bigquery.ScalarQueryParameter('suffix_to', 'STRING', suffix_to)
+                ]
+            )
+            rows = list(self.source_client.query(query, job_config=job_config).result(timeout=20))
+            table_suffix = rows[0].table_suffix if rows else None
+            logger.info(f"最新のGA4テーブル: events_{table_suffix}" if table_suffix else "期間内にGA4テーブルが見つかりません")
+            return table_suffix
+            
+        except Exception as e:
+            logger.error(f"GA4テーブル一覧の取得エラー: {str(e)}")
+            return None
+
+    def get_ga4_pageviews_minimal(self, table_suffix: Optional[str]) -> List[Dict]:
         """最小限のGA4データ取得"""
         if not table_suffix:
             return []
@@ -341,69 +324,8 @@ class GA4DataSync:
         if self.check_timeout("マッピングデータ取得開始"):
             raise TimeoutError("マッピングデータ取得でタイムアウト")
         
-        # まずテーブルの存在確認
-        try:
-            # coursesテーブルの確認
-            courses_query = f"""
-            SELECT COUNT(*) as count
-            FROM `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.courses`
-            LIMIT 1
-            """
-            
-            job_config = bigquery.QueryJobConfig(use_query_cache=True)
-            query_job = self.target_client.query(courses_query, job_config=job_config)
-            courses_result = query_job.result(timeout=20)
-            courses_count = list(courses_result)[0].count
-            logger.info(f"coursesテーブル: {courses_count} 件")
-            
-            # articlesテーブルの確認
-            articles_query = f"""
-            SELECT COUNT(*) as count
-            FROM `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.articles`
-            LIMIT 1
-            """
-            
-            query_job = self.target_client.query(articles_query, job_config=job_config)
-            articles_result = query_job.result(timeout=20)
-            articles_count = list(articles_result)[0].count
-            logger.info(f"articlesテーブル: {articles_count} 件")
-            
-            if courses_count == 0 or articles_count == 0:
-                logger.error(f"テーブルにデータがありません: courses={courses_count}, articles={articles_count}")
-                return {}
-                
-        except Exception as e:
-            logger.error(f"テーブル確認エラー: {str(e)}")
-            return {}
-            
-        # メインクエリを段階的に実行
+        # 件数確認用の事前クエリは発行せず、メインの結合結果で空テーブルを判定する
         try:
-            # まず結合前の基本データを確認
-            basic_query = f"""
-            SELECT
-                c.slug as course_slug,
-                c.id as course_id,
-                COUNT(a.id) as article_count
-            FROM `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.courses` c
-            LEFT JOIN `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.articles` a
-            ON c.id = a.koza_id
-            WHERE c.slug IS NOT NULL AND c.slug != ''
-            GROUP BY c.slug, c.id
-            HAVING article_count > 0
-            LIMIT 10
-            """
-            
-            job_config = bigquery.QueryJobConfig(use_query_cache=True)
-            query_job = self.target_client.query(basic_query, job_config=job_config)
-            basic_results = query_job.result(timeout=30)
-            
-            basic_data = list(basic_results)
-            logger.info(f"基本結合データ: {len(basic_data)} 件")
-            
-            if len(basic_data) == 0:
-                logger.error("coursesとarticlesの結合でデータが取得できません")
-                return {}
-            
             # マッピングデータのLIMIT (デフォルトは10000、GA4_LIMITが設定されていればそれを使用)
             # ここはGA4_LIMITではなく、別途マッピングデータのLIMITを考慮すべきですが、
             # GA4_LIMITと連動させる場合は以下のように調整
@@ -414,11 +336,7 @@ class GA4DataSync:
                 c.slug as course_slug,
                 a.id as article_id,
                 a.link as article_link,
-                a.title as article_title,
-                COALESCE(a.pageviews, 0) as current_pageviews,
-                COALESCE(a.organic_sessions, 0) as current_organic_sessions,
-                COALESCE(a.engaged_sessions, 0) as current_engaged_sessions,
-                COALESCE(a.avg_engagement_time, 0) as current_avg_engagement_time
+                a.title as article_title
             FROM `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.courses` c
             JOIN `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.articles` a
             ON c.id = a.koza_id
@@ -454,11 +372,7 @@ class GA4DataSync:
                     'article_id': row.article_id,
                     'course_slug': row.course_slug,
                     'article_link': article_link,
-                    'article_title': row.article_title,
-                    'current_pageviews': row.current_pageviews,
-                    'current_organic_sessions': row.current_organic_sessions,
-                    'current_engaged_sessions': row.current_engaged_sessions,
-                    'current_avg_engagement_time': row.current_avg_engagement_time
+                    'article_title': row.article_title
                 }
                 
                 # 最初の5件のデータをログ出力
@@ -468,7 +382,7 @@ class GA4DataSync:
             logger.info(f"記事マッピングデータを {len(mapping)} 件取得（処理行数: {row_count}）")
             
             if len(mapping) == 0:
-                logger.error("マッピングデータが0件です。クエリ結果をデバッグします")
+                logger.error("マッピングデータが0件です。courses/articlesテーブルにデータがあるか確認してください")
                 # デバッグ用のサンプルクエリ
                 debug_query = f"""
                 SELECT
@@ -499,28 +413,19 @@ class GA4DataSync:
 
     def normalize_ga4_url(self, url: str) -> Optional[str]:
         """GA4のURLを正規化してパスを抽出"""
-        if not url:
+        if not url or FORESIGHT_HOST not in url:
             return None
         
-        try:
-            parsed_url = urlparse(url)
-            
-            if parsed_url.netloc != 'www.foresight.jp':
-                return None
-            
-            path = parsed_url.path.strip('/')
-            
-            if '/column/' not in path:
-                return None
-            
-            if path and not path.endswith('/'):
-                path += '/'
-            
-            return path
-                
-        except Exception as e:
-            logger.debug(f"URL正規化エラー for '{url}': {str(e)}")
+        match = GA4_URL_PATTERN.match(url)
+        if not match:
             return None
+        
+        path = match.group(1).strip('/')
+        
+        if COLUMN_PATH_MARKER not in path:
+            return None
+        
+        return path + '/'
 
     def match_urls_and_aggregate_optimized(self, ga4_data: List[Dict], url_patterns: Dict) -> List[Dict]:
         """最適化されたURLマッチングとページビュー集計"""
@@ -532,34 +437,27 @@ class GA4DataSync:
         
         logger.info(f"GA4データ正規化開始: {len(ga4_data)} 件")
         
-        # バッチ処理で正規化
-        batch_size = 1000
-        for i in range(0, len(ga4_data), batch_size):
-            batch = ga4_data[i:i+batch_size]
-            
-            for ga4_item in batch:
-                ga4_url = ga4_item['page_location']
-                normalized_path = self.normalize_ga4_url(ga4_url)
-                
-                if normalized_path:
-                    if normalized_path not in path_metrics:
-                        path_metrics[normalized_path] = {
-                            'pageviews': 0,
-                            'organic_sessions': 0,
-                            'engaged_sessions': 0,
-                            'total_engagement_time_msec': 0,
-                            'total_sessions': 0
-                        }
-                    path_metrics[normalized_path]['pageviews'] += ga4_item['pageviews']
-                    path_metrics[normalized_path]['organic_sessions'] += ga4_item['organic_sessions']
-                    path_metrics[normalized_path]['engaged_sessions'] += ga4_item['engaged_sessions']
-                    path_metrics[normalized_path]['total_engagement_time_msec'] += ga4_item['total_engagement_time_msec']
-                    path_metrics[normalized_path]['total_sessions'] += ga4_item['total_sessions']
+        # 全件を1パスで正規化・集計
+        for ga4_item in ga4_data:
+            normalized_path = self.normalize_ga4_url(ga4_item['page_location'])
+            if not normalized_path:
+                continue
+
+            metrics = path_metrics.get(normalized_path)
+            if metrics is None:
+                metrics = path_metrics[normalized_path] = {
+                    'pageviews': 0,
+                    'organic_sessions': 0,
+                    'engaged_sessions': 0,
+                    'total_engagement_time_msec': 0,
+                    'total_sessions': 0
+                }
+            metrics['pageviews'] += ga4_item['pageviews']
+            metrics['organic_sessions'] += ga4_item['organic_sessions']
+            metrics['engaged_sessions'] += ga4_item['engaged_sessions']
+            metrics['total_engagement_time_msec'] += ga4_item['total_engagement_time_msec']
+            metrics['total_sessions'] += ga4_item['total_sessions']
 
-            # 進捗ログ
-            if i % 2000 == 0:
-                logger.info(f"正規化進捗: {i}/{len(ga4_data)}")
-        
         logger.info(f"正規化後のユニークパス数: {len(path_metrics)}")
         
         # マッチング処理
@@ -576,131 +474,209 @@ class GA4DataSync:
                     if metrics['total_sessions'] > 0 else 0
                 )
                 
-                # 差分がある場合のみ更新対象とする
-                pageviews_diff = abs(article_info['current_pageviews'] - metrics['pageviews'])
-                organic_sessions_diff = abs(article_info['current_organic_sessions'] - metrics['organic_sessions'])
-                engaged_sessions_diff = abs(article_info['current_engaged_sessions'] - metrics['engaged_sessions'])
-                avg_engagement_time_diff = abs(article_info['current_avg_engagement_time'] - avg_engagement_time)
-
-                if pageviews_diff > 0 or organic_sessions_diff > 0 or engaged_sessions_diff > 0 or avg_engagement_time_diff > 0.1: # 0.1秒以上の差
-                    pageviews_updates.append({
-                        'article_id': article_info['article_id'],
-                        'pageviews': metrics['pageviews'],
-                        'organic_sessions': metrics['organic_sessions'],
-                        'engaged_sessions': metrics['engaged_sessions'],
-                        'avg_engagement_time': avg_engagement_time,
-                        'course_slug': article_info['course_slug'],
-                        'article_title': article_info['article_title'][:50] + '...' if len(article_info['article_title']) > 50 else article_info['article_title']
-                    })
+                # 差分判定はMERGEのWHEN MATCHED条件でBigQuery側に任せる
+                pageviews_updates.append({
+                    'article_id': article_info['article_id'],
+                    'pageviews': metrics['pageviews'],
+                    'organic_sessions': metrics['organic_sessions'],
+                    'engaged_sessions': metrics['engaged_sessions'],
+                    'avg_engagement_time': avg_engagement_time,
+                    'course_slug': article_info['course_slug'],
+                    'article_title': article_info['article_title'][:50] + '...' if len(article_info['article_title']) > 50 else article_info['article_title']
+                })
                 
                 matched_count += 1
         
-        logger.info(f"マッチング結果: {matched_count} 件マッチ、{len(pageviews_updates)} 件更新対象")
+        logger.info(f"マッチング結果: {matched_count} 件マッチ")
         
         return pageviews_updates
 
-    def update_pageviews_batch_optimized(self, pageviews_updates: List[Dict]):
-        """最適化された一括更新処理"""
+    def update_pageviews_batch_optimized(self, pageviews_updates: List[Dict]) -> Tuple[int, int]:
+        """最適化された一括更新処理（更新件数と、更新に失敗した・タイムアウトで未処理の件数を返す）"""
         if not pageviews_updates:
             logger.info("更新対象のデータがありません")
-            return
+            return 0, 0
         
         if self.check_timeout("一括更新開始"):
             raise TimeoutError("一括更新でタイムアウト")
         
-        # バッチサイズで分割して処理
+        # バッチサイズで分割し、MERGEジョブを1つずつ実行
+        # （同じテーブルへのMERGEを同時に実行すると並行更新エラーになり、個別更新へのフォールバックが増えるため並列にしない）
         batch_size = BULK_INSERT_BATCH_SIZE
         total_updated = 0
+        total_failed = 0
         
         for i in range(0, len(pageviews_updates), batch_size):
-            batch = pageviews_updates[i:i+batch_size]
-            
-            try:
-                # 一括更新用のクエリを実行
-                pageviews_cases = []
-                organic_sessions_cases = []
-                engaged_sessions_cases = []
-                avg_engagement_time_cases = []
-                article_ids = []
-                
-                for update in batch:
-                    article_id_str = f"'{update['article_id']}'"
-                    article_ids.append(article_id_str)
-                    pageviews_cases.append(f"WHEN {article_id_str} THEN {update['pageviews']}")
-                    organic_sessions_cases.append(f"WHEN {article_id_str} THEN {update['organic_sessions']}")
-                    engaged_sessions_cases.append(f"WHEN {article_id_str} THEN {update['engaged_sessions']}")
-                    avg_engagement_time_cases.append(f"WHEN {article_id_str} THEN {update['avg_engagement_time']:.4f}")
-
-                update_query = f"""
-                UPDATE `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.articles`
-                SET 
-                    pageviews = CASE id
-                        {' '.join(pageviews_cases)}
-                        ELSE pageviews
-                    END,
-                    organic_sessions = CASE id
-                        {' '.join(organic_sessions_cases)}
-                        ELSE organic_sessions
-                    END,
-                    engaged_sessions = CASE id
-                        {' '.join(engaged_sessions_cases)}
-                        ELSE engaged_sessions
-                    END,
-                    avg_engagement_time = CASE id
-                        {' '.join(avg_engagement_time_cases)}
-                        ELSE avg_engagement_time
-                    END,
-                    last_synced = CURRENT_TIMESTAMP()
-                WHERE id IN ({', '.join(article_ids)})
-                """
-                
-                job_config = bigquery.QueryJobConfig()
-                
-                query_job = self.target_client.query(update_query, job_config=job_config)
-                query_job.result(timeout=75)
-                
-                total_updated += len(batch)
-                logger.info(f"バッチ更新完了: {total_updated}/{len(pageviews_updates)} 件")
-                
-            except Exception as e:
-                logger.error(f"バッチ更新エラー (バッチ {i//batch_size + 1}): {str(e)}")
-                # 個別更新にフォールバック
-                self.update_pageviews_individual_optimized(batch)
-                total_updated += len(batch)
+            if self.check_timeout("一括更新"):
+                total_failed += len(pageviews_updates) - i
+                logger.warning(f"一括更新でタイムアウト: {len(pageviews_updates) - i} 件未処理")
+                break
+            updated_count, failed_count = self._run_update_batch(pageviews_updates[i:i+batch_size], i//batch_size + 1)
+            total_updated += updated_count
+            total_failed += failed_count
         
-        logger.info(f"全体更新完了: {total_updated} 件")
+        logger.info(f"全体更新完了: {total_updated} 件 (失敗・未処理: {total_failed} 件)")
+        return total_updated, total_failed
 
-    def update_pageviews_individual_optimized(self, pageviews_updates: List[Dict]):
-        """最適化された個別更新処理"""
+    def _run_update_batch(self, batch: List[Dict], batch_number: int) -> Tuple[int, int]:
+        """1バッチ分のMERGEを実行し、更新件数と失敗件数を返す"""
+        query_job = None
+        try:
+            # MERGEで一括更新（値に差分がある行のみ更新）
+            update_rows = [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter('article_id', 'STRING', str(update['article_id'])),
+                    bigquery.ScalarQueryParameter('pageviews', 'INT64', update['pageviews']),
+                    bigquery.ScalarQueryParameter('organic_sessions', 'INT64', update['organic_sessions']),
+                    bigquery.ScalarQueryParameter('engaged_sessions', 'INT64', update['engaged_sessions']),
+                    bigquery.ScalarQueryParameter('avg_engagement_time', 'FLOAT64', round(update['avg_engagement_time'], 4))
+                )
+                for update in batch
+            ]
+
+            merge_query = f"""
+            MERGE `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.articles` T
+            USING (SELECT * FROM UNNEST(@updates)) S
+            ON T.id = S.article_id
+            WHEN MATCHED AND (
+                T.pageviews IS DISTINCT FROM S.pageviews
+                OR T.organic_sessions IS DISTINCT FROM S.organic_sessions
+                OR T.engaged_sessions IS DISTINCT FROM S.engaged_sessions
+                OR T.avg_engagement_time IS NULL
+                OR ABS(T.avg_engagement_time - S.avg_engagement_time) > 0.1
+            ) THEN UPDATE SET
+                pageviews = S.pageviews,
+                organic_sessions = S.organic_sessions,
+                engaged_sessions = S.engaged_sessions,
+                avg_engagement_time = S.avg_engagement_time,
+                last_synced = CURRENT_TIMESTAMP()
+            """
+            
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter('updates', 'STRUCT', update_rows)]
+            )
+            
+            query_job = self.target_client.query(merge_query, job_config=job_config)
+            query_job.result(timeout=75)
+            
+            updated_count = query_job.num_dml_affected_rows or 0
+            logger.info(f"バッチ更新完了 (バッチ {batch_number}): {len(batch)} 件中 {updated_count} 件更新")
+            return updated_count, 0
+            
+        except Exception as e:
+            logger.error(f"バッチ更新エラー (バッチ {batch_number}): {str(e)}")
+            # 待機がタイムアウトした場合もMERGEが実行され続けないよう、個別更新の前にジョブを取り消す
+            if query_job is not None:
+                try:
+                    query_job.cancel()
+                except Exception as cancel_error:
+                    logger.warning(f"MERGEジョブの取り消しに失敗 (バッチ {batch_number}): {str(cancel_error)}")
+            # 個別更新にフォールバック
+            return self.update_pageviews_individual_optimized(batch)
+
+    def update_pageviews_individual_optimized(self, pageviews_updates: List[Dict]) -> Tuple[int, int]:
+        """最適化された個別更新処理（更新件数と、更新に失敗した・タイムアウトで未処理の件数を返す）"""
         updated_count = 0
+        failed_count = 0
         
-        for update in pageviews_updates:
+        for index, update in enumerate(pageviews_updates):
             if self.check_timeout("個別更新"):
-                logger.warning(f"個別更新でタイムアウト: {updated_count} 件完了")
+                failed_count += len(pageviews_updates) - index
+                logger.warning(f"個別更新でタイムアウト: {updated_count} 件完了, {len(pageviews_updates) - index} 件未処理")
                 break
                 
             try:
                 update_query = f"""
                 UPDATE `{TARGET_PROJECT_ID}.{TARGET_DATASET_ID}.articles`
                 SET 
-                    pageviews = {update['pageviews']},
-                    organic_sessions = {update['organic_sessions']},
-                    engaged_sessions = {update['engaged_sessions']},
-                    avg_engagement_time = {update['avg_engagement_time']:.4f},
+                    pageviews = @pageviews,
+                    organic_sessions = @organic_sessions,
+                    engaged_sessions = @engaged_sessions,
+                    avg_engagement_time = @avg_engagement_time,
                     last_synced = CURRENT_TIMESTAMP()
-                WHERE id = '{update['article_id']}'
+                WHERE id = @article_id
                 """
                 
-                job_config = bigquery.QueryJobConfig()
+                job_config = bigquery.QueryJobConfig(
+                    query_parameters=[
+                        bigquery.ScalarQueryParameter('article_id', 'STRING', str(update['article_id'])),
+                        bigquery.ScalarQueryParameter('pageviews', 'INT64', update['pageviews']),
+                        bigquery.ScalarQueryParameter('organic_sessions', 'INT64', update['organic_sessions']),
+                        bigquery.ScalarQueryParameter('engaged_sessions', 'INT64', update['engaged_sessions']),
+                        bigquery.ScalarQueryParameter('avg_engagement_time', 'FLOAT64', round(update['avg_engagement_time'], 4))
+                    ]
+                )
                 
                 query_job = self.target_client.query(update_query, job_config=job_config)
                 query_job.result(timeout=20)
                 updated_count += 1
                 
             except Exception as e:
+                failed_count += 1
                 logger.error(f"記事ID {update['article_id']} 更新エラー: {str(e)}")
         
-        logger.info(f"個別更新完了: {updated_count} 件")
+        logger.info(f"個別更新完了: {updated_count} 件 (失敗・未処理: {failed_count} 件)")
+        return updated_count, failed_count
+
+    def compute_updates_hash(self, pageviews_updates: List[Dict]) -> str:
+        """更新内容のチェックサムを計算"""
+        update_keys = sorted(
+            (
+                str(update['article_id']),
+                update['pageviews'],
+                update['organic_sessions'],
+                update['engaged_sessions'],
+                round(update['avg_engagement_time'], 4)
+            )
+            for update in pageviews_updates
+        )
+        return hashlib.blake2b(repr(update_keys).encode(), digest_size=16).hexdigest()
+
+    def get_last_sync_hash(self) -> Optional[str]:
+        """前回同期時のチェックサムを取得"""
+        try:
+            query = f"""
+            SELECT hash
+            FROM `{SYNC_STATE_TABLE_ID}`
+            ORDER BY run_ts DESC
+            LIMIT 1
+            """
+            
+            query_job = self.target_client.query(query)
+            rows = list(query_job.result(timeout=20))
+            return rows[0].hash if rows else None
+            
+        except Exception as e:
+            # 初回実行などで状態テーブルが存在しない場合は常に同期する
+            logger.info(f"前回同期状態を取得できませんでした: {str(e)}")
+            return None
+
+    def save_sync_hash(self, updates_hash: str, updated_records: int):
+        """今回同期時のチェックサムを保存（状態テーブルはcreate_sync_state_table.shで作成し、常に1行だけ保持する）"""
+        try:
+            merge_query = f"""
+            MERGE `{SYNC_STATE_TABLE_ID}` T
+            USING (SELECT @hash AS hash, @updated_records AS updated_records) S
+            ON TRUE
+            WHEN MATCHED THEN UPDATE SET
+                run_ts = CURRENT_TIMESTAMP(),
+                hash = S.hash,
+                updated_records = S.updated_records
+            WHEN NOT MATCHED THEN
+                INSERT (run_ts, hash, updated_records)
+                VALUES (CURRENT_TIMESTAMP(), S.hash, S.updated_records)
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ScalarQueryParameter('hash', 'STRING', updates_hash),
+                    bigquery.ScalarQueryParameter('updated_records', 'INT64', updated_records)
+                ]
+            )
+            self.target_client.query(merge_query, job_config=job_config).result(timeout=20)
+            
+        except Exception as e:
+            logger.warning(f"同期状態の保存に失敗: {str(e)}")
 
     def sync_pageviews_optimized(self):
         """最適化されたメイン同期処理"""
@@ -726,20 +702,42 @@ class GA4DataSync:
             logger.info("Step 3: URLマッチング")
             pageviews_updates = self.match_urls_and_aggregate_optimized(ga4_data, mapping)
             
+            # 前回同期と集計結果が同一なら更新処理をスキップ
+            updates_hash = self.compute_updates_hash(pageviews_updates)
+            if updates_hash == self.get_last_sync_hash():
+                elapsed_time = (datetime.now() - self.start_time).total_seconds()
+                logger.info(f"前回同期から変更がないため更新をスキップ (実行時間: {elapsed_time:.2f}秒)")
+                return {
+                    'status': 'skipped_unchanged',
+                    'total_ga4_records': len(ga4_data),
+                    'mapped_articles': len(mapping),
+                    'updated_records': 0,
+                    'execution_time_seconds': elapsed_time
+                }
+            
             logger.info("Step 4: データ更新")
+            updated_records = 0
+            failed_records = 0
             if pageviews_updates:
-                self.update_pageviews_batch_optimized(pageviews_updates)
+                updated_records, failed_records = self.update_pageviews_batch_optimized(pageviews_updates)
             else:
                 logger.info("更新対象データなし")
             
+            # 失敗・未処理の更新がある場合はチェックサムを保存せず、次回も同じ集計結果で更新する
+            if failed_records:
+                logger.warning(f"更新に失敗・未処理の記事があるため同期状態を保存しません: {failed_records} 件")
+            else:
+                self.save_sync_hash(updates_hash, updated_records)
+            
             elapsed_time = (datetime.now() - self.start_time).total_seconds()
             logger.info(f"最適化された同期処理完了 (実行時間: {elapsed_time:.2f}秒)")
             
             return {
-                'status': 'success',
+                'status': 'partial_failure' if failed_records else 'success',
                 'total_ga4_records': len(ga4_data),
                 'mapped_articles': len(mapping),
-                'updated_records': len(pageviews_updates),
+                'updated_records': updated_records,
+                'failed_records': failed_records,
                 'execution_time_seconds': elapsed_time
             }
             
@@ -1,10 +1,66 @@
 import logging
-from typing import List, Dict, Any
+import uuid
+from datetime import datetime, timezone
+from typing import Iterator, List, Dict, Any
 
 from google.cloud import bigquery
 
+try:
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import types as storage_types
+    from google.cloud.bigquery_storage_v1 import writer as storage_writer
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+    STORAGE_WRITE_AVAILABLE = True
+except ImportError:
+    STORAGE_WRITE_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
+# 記事取得時に1ページで受け取る行数（full_content_htmlを含むため小さめにする）
+ARTICLES_PAGE_SIZE = 100
+
+# Storage Write APIの1リクエストあたりの行数（10MB/リクエストの上限に収まるよう調整）
+STORAGE_WRITE_ROWS_PER_REQUEST = 200
+
+# insert_rows_jsonで1回に送る行数
+INSERT_ROWS_JSON_BATCH_SIZE = 500
+
+# article_chunksテーブルに対応するprotoフィールド定義 (名前, 型, ラベル)
+_CHUNK_ROW_FIELDS = [
+    ("chunk_id", "TYPE_STRING", "LABEL_OPTIONAL"),
+    ("article_id", "TYPE_STRING", "LABEL_OPTIONAL"),
+    ("koza_id", "TYPE_STRING", "LABEL_OPTIONAL"),
+    ("chunk_index", "TYPE_INT64", "LABEL_OPTIONAL"),
+    ("chunk_title", "TYPE_STRING", "LABEL_OPTIONAL"),
+    ("chunk_text", "TYPE_STRING", "LABEL_OPTIONAL"),
+    ("content_embedding", "TYPE_DOUBLE", "LABEL_REPEATED"),
+    ("embedding_model", "TYPE_STRING", "LABEL_OPTIONAL"),
+    # TIMESTAMP列はエポックからのマイクロ秒(INT64)で送る
+    ("created_at", "TYPE_INT64", "LABEL_OPTIONAL"),
+]
+
+
+def _build_chunk_row_message_class():
+    """article_chunksの1行を表すprotoメッセージクラスを動的に生成する。"""
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name="article_chunk_row.proto", package="content_analysis", syntax="proto2"
+    )
+    message_proto = file_proto.message_type.add(name="ArticleChunkRow")
+    for number, (name, field_type, label) in enumerate(_CHUNK_ROW_FIELDS, start=1):
+        message_proto.field.add(
+            name=name,
+            number=number,
+            type=descriptor_pb2.FieldDescriptorProto.Type.Value(field_type),
+            label=descriptor_pb2.FieldDescriptorProto.Label.Value(label),
+        )
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName("content_analysis.ArticleChunkRow")
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
 class BigQueryClient:
     """BigQueryとのやり取りを管理するクライアント"""
 
@@ -13,9 +69,12 @@ class BigQueryClient:
         self.client = bigquery.Client(project=project_id)
         self.articles_table_id = f"{project_id}.content_analysis.articles"
         self.chunks_table_id = f"{project_id}.content_analysis.article_chunks"
+        # generate-embeddingsと共有する埋め込みキャッシュ（テーブルはgenerate-embeddings/migrate_embedding_schema.shで作成する）
+        self.embedding_cache_table_id = f"{project_id}.content_analysis.embedding_cache"
+        self._chunk_row_class = None
 
-    def get_articles_for_chunking(self, limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
-        """チャンキング処理対象の記事をarticlesテーブルから取得する。"""
+    def iter_articles_for_chunking(self, limit: int = 10, offset: int = 0, page_size: int = ARTICLES_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """チャンキング処理対象の記事をarticlesテーブルからページ単位で逐次取得する。"""
         query = f"""
             SELECT id, title, full_content, full_content_html, koza_id
             FROM `{self.articles_table_id}`
@@ -27,12 +86,14 @@ class BigQueryClient:
         try:
             logger.info(f"Executing query to fetch articles: \n{query}")
             query_job = self.client.query(query)
-            results = [dict(row) for row in query_job.result()]
-            logger.info(f"{len(results)}件の記事を取得しました。")
-            return results
+            # 全件をdict化して保持せず、page_size件ずつ取得しながら1行ずつ返す
+            fetched_count = 0
+            for row in query_job.result(page_size=page_size):
+                fetched_count += 1
+                yield dict(row)
+            logger.info(f"{fetched_count}件の記事を取得しました。")
         except Exception as e:
             logger.error(f"記事の取得中にエラーが発生しました: {e}", exc_info=True)
-            return []
 
     def insert_chunks(self, chunks: List[Dict[str, Any]], article_ids: List[str], force_regenerate: bool):
         """生成されたチャンクをarticle_chunksテーブルに保存する。"""
@@ -42,15 +103,26 @@ class BigQueryClient:
 
         try:
             if force_regenerate and article_ids:
-                logger.info(f"{len(article_ids)}件の記事IDに対応する既存チャンクを削除します。")
-                formatted_ids = ", ".join([f"'{_id}'" for _id in article_ids])
-                
-                delete_query = f"DELETE FROM `{self.chunks_table_id}` WHERE article_id IN ({formatted_ids})"
-                delete_job = self.client.query(delete_query)
-                delete_job.result()
-                logger.info("既存チャンクの削除が完了しました。")
-
-            errors = self.client.insert_rows_json(self.chunks_table_id, chunks)
+                logger.info(f"{len(article_ids)}件の記事IDに対応する既存チャンクを新しいチャンクで置き換えます。")
+                self._replace_chunks_in_transaction(chunks, article_ids)
+                logger.info(f"{len(chunks)}件の新しいチャンクで置き換えが完了しました。")
+                return
+
+            if STORAGE_WRITE_AVAILABLE:
+                try:
+                    self._write_chunks_with_storage_api(chunks)
+                    logger.info(f"{len(chunks)}件の新しいチャンクが正常に挿入されました。(Storage Write API)")
+                    return
+                except Exception as e:
+                    # PENDINGストリームはコミット前に失敗すれば何も書き込まれないため、そのままフォールバックできる
+                    logger.warning(f"Storage Write APIでの挿入に失敗したため、insert_rows_jsonにフォールバックします: {e}")
+
+            # ストリーミング挿入のリクエストサイズ上限を超えないよう分割して送信
+            errors = []
+            for offset in range(0, len(chunks), INSERT_ROWS_JSON_BATCH_SIZE):
+                errors.extend(self.client.insert_rows_json(
+                    self.chunks_table_id, chunks[offset:offset + INSERT_ROWS_JSON_BATCH_SIZE]
+                ))
             if not errors:
                 logger.info(f"{len(chunks)}件の新しいチャンクが正常に挿入されました。")
             else:
@@ -59,3 +131,154 @@ class BigQueryClient:
         except Exception as e:
             logger.error(f"チャンクの保存処理中にエラーが発生しました: {e}", exc_info=True)
             raise
+
+    def get_cached_embeddings(self, text_hashes: List[str], embedding_model: str) -> Dict[str, List[float]]:
+        """テキストのハッシュをキーに、保存済みの埋め込みベクトルを取得する。"""
+        if not text_hashes:
+            return {}
+        try:
+            query = f"""
+                SELECT text_hash, ANY_VALUE(content_embedding) AS content_embedding
+                FROM `{self.embedding_cache_table_id}`
+                WHERE embedding_model = @embedding_model
+                  AND text_hash IN UNNEST(@text_hashes)
+                GROUP BY text_hash
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ScalarQueryParameter("embedding_model", "STRING", embedding_model),
+                    bigquery.ArrayQueryParameter("text_hashes", "STRING", text_hashes),
+                ]
+            )
+            rows = self.client.query(query, job_config=job_config).result()
+            return {row.text_hash: list(row.content_embedding) for row in rows if row.content_embedding}
+        except Exception as e:
+            # キャッシュは最適化のためのものなので、失敗しても全件APIで生成する
+            logger.warning(f"埋め込みキャッシュの取得に失敗しました: {e}")
+            return {}
+
+    def save_cached_embeddings(self, embeddings_by_hash: Dict[str, List[float]], embedding_model: str, created_at: str):
+        """新たに生成した埋め込みベクトルをテキストのハッシュとともに保存する。"""
+        if not embeddings_by_hash:
+            return
+        rows = [
+            {
+                "text_hash": text_hash,
+                "embedding_model": embedding_model,
+                "content_embedding": embedding,
+                "created_at": created_at,
+            }
+            for text_hash, embedding in embeddings_by_hash.items()
+        ]
+        try:
+            errors = []
+            for offset in range(0, len(rows), INSERT_ROWS_JSON_BATCH_SIZE):
+                errors.extend(self.client.insert_rows_json(
+                    self.embedding_cache_table_id, rows[offset:offset + INSERT_ROWS_JSON_BATCH_SIZE]
+                ))
+            if errors:
+                logger.warning(f"埋め込みキャッシュの保存中にエラーが発生しました: {errors}")
+        except Exception as e:
+            logger.warning(f"埋め込みキャッシュの保存に失敗しました: {e}")
+
+    def _replace_chunks_in_transaction(self, chunks: List[Dict[str, Any]], article_ids: List[str]):
+        """ステージングテーブル経由で既存チャンクの削除と新規挿入を1つのトランザクションで行う。"""
+        staging_table_id = f"{self.chunks_table_id}_staging_{uuid.uuid4().hex}"
+        columns = ", ".join(name for name, _, _ in _CHUNK_ROW_FIELDS)
+
+        chunks_table = self.client.get_table(self.chunks_table_id)
+        load_config = bigquery.LoadJobConfig(
+            schema=chunks_table.schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+
+        try:
+            self.client.load_table_from_json(chunks, staging_table_id, job_config=load_config).result()
+
+            script = f"""
+                BEGIN
+                    BEGIN TRANSACTION;
+                    DELETE FROM `{self.chunks_table_id}` WHERE article_id IN UNNEST(@article_ids);
+                    INSERT INTO `{self.chunks_table_id}` ({columns})
+                    SELECT {columns} FROM `{staging_table_id}`;
+                    COMMIT TRANSACTION;
+                EXCEPTION WHEN ERROR THEN
+                    ROLLBACK TRANSACTION;
+                    RAISE USING MESSAGE = @@error.message;
+                END;
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("article_ids", "STRING", [str(_id) for _id in article_ids])]
+            )
+            self.client.query(script, job_config=job_config).result()
+        finally:
+            self.client.delete_table(staging_table_id, not_found_ok=True)
+
+    def _write_chunks_with_storage_api(self, chunks: List[Dict[str, Any]]):
+        """Storage Write APIのPENDINGストリームでチャンクを書き込み、一括コミットする。"""
+        if self._chunk_row_class is None:
+            self._chunk_row_class = _build_chunk_row_message_class()
+        row_class = self._chunk_row_class
+
+        write_client = bigquery_storage_v1.BigQueryWriteClient()
+        project, dataset, table = self.chunks_table_id.split(".")
+        parent = write_client.table_path(project, dataset, table)
+
+        write_stream = write_client.create_write_stream(
+            parent=parent,
+            write_stream=storage_types.WriteStream(type_=storage_types.WriteStream.Type.PENDING),
+        )
+        stream_name = write_stream.name
+
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        row_class.DESCRIPTOR.CopyToProto(proto_descriptor)
+        request_template = storage_types.AppendRowsRequest(
+            write_stream=stream_name,
+            proto_rows=storage_types.AppendRowsRequest.ProtoData(
+                writer_schema=storage_types.ProtoSchema(proto_descriptor=proto_descriptor)
+            ),
+        )
+        append_rows_stream = storage_writer.AppendRowsStream(write_client, request_template)
+
+        try:
+            futures = []
+            for offset in range(0, len(chunks), STORAGE_WRITE_ROWS_PER_REQUEST):
+                proto_rows = storage_types.ProtoRows()
+                for chunk in chunks[offset:offset + STORAGE_WRITE_ROWS_PER_REQUEST]:
+                    proto_rows.serialized_rows.append(self._to_chunk_row(row_class, chunk).SerializeToString())
+                request = storage_types.AppendRowsRequest(
+                    offset=offset,
+                    proto_rows=storage_types.AppendRowsRequest.ProtoData(rows=proto_rows),
+                )
+                futures.append(append_rows_stream.send(request))
+
+            for future in futures:
+                future.result()
+        finally:
+            append_rows_stream.close()
+
+        write_client.finalize_write_stream(name=stream_name)
+        commit_response = write_client.batch_commit_write_streams(
+            storage_types.BatchCommitWriteStreamsRequest(parent=parent, write_streams=[stream_name])
+        )
+        if commit_response.stream_errors:
+            raise RuntimeError(f"ストリームのコミットに失敗しました: {commit_response.stream_errors}")
+
+    @staticmethod
+    def _to_chunk_row(row_class, chunk: Dict[str, Any]):
+        """チャンクのdictをprotoメッセージに変換する。"""
+        row = row_class()
+        for name, _, label in _CHUNK_ROW_FIELDS:
+            value = chunk.get(name)
+            if value is None:
+                continue
+            if label == "LABEL_REPEATED":
+                getattr(row, name).extend(value)
+            elif name == "created_at":
+                created_at = datetime.fromisoformat(value) if isinstance(value, str) else value
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                row.created_at = int(created_at.timestamp() * 1_000_000)
+            else:
+                setattr(row, name, value)
+        return row
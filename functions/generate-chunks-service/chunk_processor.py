@@ -2,10 +2,32 @@ import logging
 import re
 import html
 import unicodedata
-from bs4 import BeautifulSoup, NavigableString
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Iterable, Iterator, Optional
+from selectolax.lexbor import LexborHTMLParser, LexborNode
 
 logger = logging.getLogger(__name__)
 
+_WS_RE = re.compile(r'\s+')
+_TAG_RE = re.compile(r'<[^>]+>')
+_HEADING_TAGS = frozenset(('h1', 'h2', 'h3', 'h4', 'h5', 'h6'))
+_STRIP_TAGS = frozenset(('script', 'style', 'meta', 'link', 'nav', 'footer'))
+_STRIP_SELECTOR = ', '.join(('img[alt]',) + tuple(sorted(_STRIP_TAGS)))
+
+# 文末の判定: 日本語の句点・感嘆符・疑問符（閉じ括弧を含む）、または空白・文末が続くピリオド
+# （小数点の「3.14」などはピリオドの直後が空白でないため文末とみなさない）
+_SENTENCE_RE = re.compile(r'.*?(?:[。！？!?]+[」』）)]*|\.(?=\s|$)|$)', re.S)
+
+
+def split_sentence_spans(text: str) -> list[tuple[int, int]]:
+    """テキストを文単位に分割し、各文の(開始, 終了)オフセットを返す（空白のみの文は除外）"""
+    return [
+        match.span() for match in _SENTENCE_RE.finditer(text)
+        if not text[match.start():match.end()].isspace() and match.start() != match.end()
+    ]
+
+
 class ChunkProcessor:
     """HTMLコンテンツを意味のあるチャンクに分割するための高機能プロセッサ（HTML保持→分割→テキスト化）"""
 
@@ -19,11 +41,11 @@ class ChunkProcessor:
         self.min_chunk_chars = min_chunk_chars
         self.max_chunk_chars = max_chunk_chars
         self.overlap_chars = overlap_chars
-        self.heading_tags = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+        self.heading_tags = _HEADING_TAGS
 
     def _clean_text(self, text: str) -> str:
         """不要な空白や改行を削除してテキストを整形する"""
-        text = re.sub(r'\s+', ' ', text)
+        text = _WS_RE.sub(' ', text)
         return text.strip()
     
     def _extract_text_from_html(self, html_content: str) -> str:
@@ -32,39 +54,68 @@ class ChunkProcessor:
             return ""
         
         try:
-            soup = BeautifulSoup(html_content, 'html.parser')
+            tree = LexborHTMLParser(html_content)
+            return self._extract_text_from_nodes([tree.root])
             
-            # 画像のalt属性をテキストとして保持
-            for img in soup.find_all('img'):
-                if img.get('alt'):
-                    img.replace_with(f" {img.get('alt')} ")
+        except Exception as e:
+            logger.error(f"HTML→テキスト変換エラー: {e}")
+            # フォールバック: 単純な正規表現でHTMLタグを削除
+            return _TAG_RE.sub(' ', str(html_content))
+
+    def _extract_text_from_nodes(self, nodes: Iterable[LexborNode]) -> str:
+        """解析済みのノードから直接テキストを抽出（画像のalt属性も保持、ノードは書き換える）"""
+        texts = []
+        for node in nodes:
+            if node.tag == '-text':
+                node_text = node.text(deep=False).strip()
+                if node_text:
+                    texts.append(node_text)
+                continue
             
             # スクリプトやスタイルタグは完全削除
-            for tag in soup(['script', 'style', 'meta', 'link', 'nav', 'footer']):
-                tag.decompose()
-            
-            # テキスト抽出
-            text = soup.get_text(separator=' ', strip=True)
+            if node.tag in _STRIP_TAGS:
+                continue
             
-            # HTMLエンティティのデコード
-            text = html.unescape(text)
+            # 画像のalt属性をテキストとして保持
+            if node.tag == 'img':
+                alt = (node.attributes.get('alt') or '').strip()
+                if alt:
+                    texts.append(alt)
+                continue
+            # 画像の置換と不要タグの削除を1回のCSSセレクター走査で行う
+            # （子孫を先に処理するよう逆順に処理し、削除済みノードに触れないようにする）
+            for matched in reversed(node.css(_STRIP_SELECTOR)):
+                if matched.tag == 'img':
+                    alt = matched.attributes.get('alt')
+                    if alt:
+                        matched.replace_with(f" {alt} ")
+                else:
+                    matched.decompose()
             
-            # Unicode正規化
+            # テキスト抽出（空のテキストノードは除外して空白1つで連結）
+            texts.extend(
+                node_text for node_text in (
+                    child.text(deep=False).strip()
+                    for child in node.traverse(include_text=True)
+                    if child.tag == '-text'
+                ) if node_text
+            )
+        
+        # HTMLエンティティのデコード
+        text = html.unescape(' '.join(texts))
+        
+        # Unicode正規化（ASCIIのみのテキストはNFKCで変化しないため省略）
+        if not text.isascii():
             text = unicodedata.normalize('NFKC', text)
-            
-            return text
-            
-        except Exception as e:
-            logger.error(f"HTML→テキスト変換エラー: {e}")
-            # フォールバック: 単純な正規表現でHTMLタグを削除
-            return re.sub(r'<[^>]+>', ' ', str(html_content))
+        
+        return text
 
     def split_into_chunks(self, html_content: str) -> list[dict]:
         """
         HTMLコンテンツを階層的な見出しに基づいて意味のあるセクションへ分割し、
         文字数制約とオーバーラップを適用してチャンクを生成する。
         
-        処理フロー:
+        処理フロー（各段階はジェネレーターで連結し、1回の走査で処理する）:
         1. HTMLを見出しタグで分割（HTML構造を保持）
         2. 各セクションからテキストを抽出（この段階でHTML除去）
         3. 短すぎるセクションを結合
@@ -74,118 +125,114 @@ class ChunkProcessor:
         if not html_content:
             return []
 
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # 1. 見出しタグを基準にHTMLをセクションに分割（HTML構造を保持）
-        sections = self._split_by_headings(soup)
-        
-        logger.info(f"見出しベース分割: {len(sections)}セクション")
+        final_chunks = list(self._iter_chunks(html_content))
 
-        # 2. 各セクションからテキストを抽出（HTMLタグを除去）
-        text_sections = self._extract_text_from_sections(sections)
-        
-        logger.info(f"テキスト抽出完了: {len(text_sections)}セクション")
+        logger.info(f"最終的なチャンク生成数: {len(final_chunks)}")
+        return final_chunks
 
-        # 3. 短すぎるものを結合
-        combined_sections = self._combine_short_sections_v2(text_sections)
-        
-        logger.info(f"短いセクション結合後: {len(combined_sections)}セクション")
+    def _iter_chunks(self, html_content: str) -> Iterator[dict]:
+        """チャンクを確定した順に返す（中間リストを作らず、保留中のセクションは高々1つ）"""
+        # パーサーは<html><body>で包むため、body直下をルート要素として扱う
+        tree = LexborHTMLParser(html_content)
+        root = tree.body or tree.root
 
-        # 4. 長すぎるセクションをさらに分割
+        sections = self._split_by_headings(root)
+        text_sections = self._extract_text_from_sections(sections)
+        combined_sections = self._combine_short_sections_v2(text_sections)
         split_sections = self._split_long_sections(combined_sections)
-        
-        logger.info(f"長いセクション分割後: {len(split_sections)}セクション")
-        
-        # 5. チャンクにオーバーラップを追加
-        final_chunks = self._apply_overlap(split_sections)
+        yield from self._apply_overlap(split_sections)
 
-        logger.info(f"最終的なチャンク生成数: {len(final_chunks)}")
-        return final_chunks
-
-    def _split_by_headings(self, soup: BeautifulSoup) -> list[dict]:
+    def _split_by_headings(self, root: LexborNode) -> Iterator[dict]:
         """見出しタグを基準にHTMLをセクションに分割する（HTML要素を保持）"""
-        sections = []
         current_section = {'title': '冒頭', 'title_html': '', 'elements': []}
 
         # ルート要素の直下の要素を処理
-        for element in soup.children:
-            # NavigableString（テキストノード）をスキップ
-            if isinstance(element, NavigableString):
-                if element.strip():
+        for element in root.iter(include_text=True):
+            # テキストノードは空白のみならスキップ
+            if element.tag == '-text':
+                if element.text(deep=False).strip():
                     current_section['elements'].append(element)
                 continue
+
+            # コメントなど要素以外のノードは対象外
+            if element.tag.startswith('-'):
+                continue
             
-            if hasattr(element, 'name') and element.name in self.heading_tags:
-                # 現在のセクションをリストに追加
+            if element.tag in self.heading_tags:
+                # 現在のセクションを確定
                 if current_section['elements'] or current_section['title'] != '冒頭':
-                    sections.append(current_section)
+                    yield current_section
                 
                 # 新しいセクションを開始
                 current_section = {
-                    'title': self._clean_text(element.get_text()),
-                    'title_html': str(element),
+                    'title': self._clean_text(element.text()),
+                    'title_html': element.html,
                     'elements': []
                 }
             else:
                 current_section['elements'].append(element)
         
-        # 最後のセクションを追加
+        # 最後のセクションを確定
         if current_section['elements'] or current_section['title'] != '冒頭':
-            sections.append(current_section)
-            
-        return sections
+            yield current_section
     
-    def _extract_text_from_sections(self, sections: list[dict]) -> list[dict]:
+    def _extract_text_from_sections(self, sections: Iterable[dict]) -> Iterator[dict]:
         """各セクションからテキストを抽出（この段階でHTMLタグを除去）"""
-        text_sections = []
-        
         for section in sections:
             # 見出しテキスト
             title = section['title']
             
-            # 本文HTML
-            elements_html = ''.join(str(el) for el in section['elements'])
+            # 解析済みの要素から直接テキストを抽出（HTMLへの再変換・再解析はしない）
+            try:
+                text = self._extract_text_from_nodes(section['elements'])
+            except Exception as e:
+                logger.error(f"HTML→テキスト変換エラー: {e}")
+                # フォールバック: 単純な正規表現でHTMLタグを削除
+                text = _TAG_RE.sub(' ', ''.join(el.html or '' for el in section['elements']))
             
-            # HTML→テキスト変換
-            text = self._extract_text_from_html(elements_html)
+            # 抽出済みの要素はツリーから削除し、処理済みセクションのノードを保持し続けない
+            for el in section['elements']:
+                el.decompose()
+            section['elements'] = []
             
             if text.strip() or title != '冒頭':
-                text_sections.append({
+                yield {
                     'title': title,
                     'text': text
-                })
-        
-        return text_sections
+                }
 
-    def _combine_short_sections_v2(self, sections: list[dict]) -> list[dict]:
+    def _combine_short_sections_v2(self, sections: Iterable[dict]) -> Iterator[dict]:
         """短すぎるセクションを前のセクションに結合する（テキスト抽出済み）"""
-        combined_sections = []
+        # 結合先となる保留中のセクション（本文は断片のリストで持ち、確定時に1回だけ連結）
+        pending_title = None
+        pending_parts: list[str] = []
         
         for section in sections:
             text = section['text'].strip()
             title = section['title']
             
             # 短すぎて、かつ結合先のセクションが存在する場合
-            if combined_sections and len(text) < self.min_chunk_chars:
+            if pending_parts and len(text) < self.min_chunk_chars:
                 logger.info(f"セクション '{title}' (文字数: {len(text)}) は短すぎるため、前のセクションに結合します。")
                 # タイトルも保持（見出しとして）
-                combined_sections[-1]['text'] += f"\n\n{title}\n{text}"
-            elif len(text) >= self.min_chunk_chars or not combined_sections:
-                # 最小文字数以上、または最初のセクション
-                combined_sections.append({'title': title, 'text': text})
-            else:
-                logger.warning(f"セクション '{title}' (文字数: {len(text)}) は短すぎますが、これをチャンクとして保持します。")
-                combined_sections.append({'title': title, 'text': text})
+                pending_parts.append(f"\n\n{title}\n{text}")
+                continue
+
+            # 最小文字数以上、または最初のセクション: 保留中のセクションを確定して入れ替える
+            if pending_parts:
+                yield {'title': pending_title, 'text': ''.join(pending_parts)}
+            pending_title = title
+            pending_parts = [text]
 
-        return combined_sections
+        if pending_parts:
+            yield {'title': pending_title, 'text': ''.join(pending_parts)}
 
-    def _split_long_sections(self, sections: list[dict]) -> list[dict]:
+    def _split_long_sections(self, sections: Iterable[dict]) -> Iterator[dict]:
         """最大文字数を超えるセクションを句点「。」と段落で分割する"""
-        final_sections = []
         for section in sections:
             text = section['text']
             if len(text) <= self.max_chunk_chars:
-                final_sections.append(section)
+                yield section
                 continue
 
             logger.info(f"セクション '{section['title']}' (文字数: {len(text)}) は長すぎるため、分割します。")
@@ -195,10 +242,12 @@ class ChunkProcessor:
             if len(paragraphs) > 1:
                 paragraphs = [p.strip() for p in paragraphs if p.strip()]
             else:
-                # 段落分割がない場合は句点で分割
-                paragraphs = [s + '。' for s in text.split('。') if s.strip()]
+                # 段落分割がない場合は文単位で分割
+                paragraphs = [text[start:end].strip() for start, end in split_sentence_spans(text)]
 
-            current_sub_chunk = ""
+            # サブチャンクは断片のリストで保持し、確定時に1回だけ連結する
+            current_parts: list[str] = []
+            current_len = 0
             sub_chunk_count = 0
 
             for paragraph in paragraphs:
@@ -206,83 +255,128 @@ class ChunkProcessor:
 
                 # 段落自体が長すぎる場合は文単位で分割
                 if len(paragraph) > self.max_chunk_chars:
-                    sentences = paragraph.split('。')
-                    for sentence in sentences:
-                        if not sentence: continue
-                        sentence_with_period = sentence + '。' if not sentence.endswith('。') else sentence
-
-                        if len(current_sub_chunk) + len(sentence_with_period) > self.max_chunk_chars:
-                            if current_sub_chunk:
-                                final_sections.append({
+                    sentences = [paragraph[start:end].strip() for start, end in split_sentence_spans(paragraph)]
+                    # 文の長さ（区切りの空白1文字を含む）の累積和から、区切り位置をまとめて求める
+                    cumulative = list(accumulate(len(sentence) + 1 for sentence in sentences))
+                    carry_len = current_len if current_parts else 0
+                    start = 0
+                    for group_index, end in enumerate(self._sentence_group_ends(cumulative, carry_len)):
+                        group = ' '.join(sentences[start:end])
+                        if group_index == 0 and carry_len:
+                            # 直前のサブチャンクに収まる文はそのまま続ける
+                            if end:
+                                current_parts.append(" ")
+                                current_parts.append(group)
+                                current_len += cumulative[end - 1]
+                        else:
+                            if current_parts:
+                                yield {
                                     'title': f"{section['title']} (パート{sub_chunk_count + 1})",
-                                    'text': current_sub_chunk.strip()
-                                })
+                                    'text': ''.join(current_parts).strip()
+                                }
                                 sub_chunk_count += 1
-                            current_sub_chunk = sentence_with_period
-                        else:
-                            current_sub_chunk += " " + sentence_with_period if current_sub_chunk else sentence_with_period
+                            current_parts = [group]
+                            current_len = len(group)
+                        start = end
+                    continue
+
+                # 通常の段落処理
+                if current_len + len(paragraph) > self.max_chunk_chars:
+                    if current_parts:
+                        yield {
+                            'title': f"{section['title']} (パート{sub_chunk_count + 1})",
+                            'text': ''.join(current_parts).strip()
+                        }
+                        sub_chunk_count += 1
+                    current_parts = [paragraph]
+                    current_len = len(paragraph)
+                elif current_parts:
+                    current_parts.append("\n")
+                    current_parts.append(paragraph)
+                    current_len += 1 + len(paragraph)
                 else:
-                    # 通常の段落処理
-                    if len(current_sub_chunk) + len(paragraph) > self.max_chunk_chars:
-                        if current_sub_chunk:
-                            final_sections.append({
-                                'title': f"{section['title']} (パート{sub_chunk_count + 1})",
-                                'text': current_sub_chunk.strip()
-                            })
-                            sub_chunk_count += 1
-                        current_sub_chunk = paragraph
-                    else:
-                        current_sub_chunk += "\n" + paragraph if current_sub_chunk else paragraph
-
-            if current_sub_chunk:
-                final_sections.append({
+                    current_parts.append(paragraph)
+                    current_len = len(paragraph)
+
+            if current_parts:
+                yield {
                     'title': f"{section['title']} (パート{sub_chunk_count + 1})",
-                    'text': current_sub_chunk.strip()
-                })
+                    'text': ''.join(current_parts).strip()
+                }
 
-        return final_sections
+    def _sentence_group_ends(self, cumulative: list[int], carry_len: int) -> list[int]:
+        """
+        文の累積長から、最大文字数に収まるように文をまとめた各グループの終了位置を返す。
+        carry_lenが0でない場合、最初のグループは直前のサブチャンクに続ける文（0件もあり得る）。
+        """
+        ends = []
+        start = 0
+        if carry_len:
+            # 直前のサブチャンク + 文0..k の長さは carry_len + cumulative[k] - 1
+            start = bisect_right(cumulative, self.max_chunk_chars + 1 - carry_len)
+            ends.append(start)
+        while start < len(cumulative):
+            # 文start..k の長さは cumulative[k] - base - 1（1文目は長さに関わらず含める）
+            base = cumulative[start - 1] if start else 0
+            end = max(bisect_right(cumulative, base + self.max_chunk_chars + 2, start), start + 1)
+            ends.append(end)
+            start = end
+        return ends
 
-    def _apply_overlap(self, sections: list[dict]) -> list[dict]:
+    def _apply_overlap(self, sections: Iterable[dict]) -> Iterator[dict]:
         """チャンク間により効果的なオーバーラップを追加する"""
-        if not sections:
-            return []
+        # 前後のチャンクだけを参照するため、1つ先読みしながら処理する
+        prev_section = None
+        current_section = None
+        for next_section in sections:
+            if current_section is not None:
+                yield self._overlap_chunk(prev_section, current_section, next_section)
+                prev_section = current_section
+            current_section = next_section
 
-        overlapped_chunks = []
-        for i in range(len(sections)):
-            current_chunk = sections[i].copy()  # コピーを作成
-
-            # 前のチャンクの末尾を現在のチャンクの先頭に追加
-            if i > 0:
-                prev_chunk_text = sections[i-1]['text']
-                # 文の境界で切り取るように改善
-                sentences = prev_chunk_text.split('。')
-                if len(sentences) > 1:
-                    # 最後の数文を取得
-                    overlap_sentences = sentences[-3:] if len(sentences) >= 3 else sentences[-2:]
-                    overlap_text = '。'.join(s for s in overlap_sentences if s.strip()) + '。'
-                    if len(overlap_text) <= self.overlap_chars:
-                        current_chunk['text'] = overlap_text + " " + current_chunk['text']
-                    else:
-                        # 長すぎる場合は文字数で切り取り
-                        overlap_text = prev_chunk_text[-self.overlap_chars:]
-                        current_chunk['text'] = overlap_text + " " + current_chunk['text']
-                else:
+        if current_section is not None:
+            yield self._overlap_chunk(prev_section, current_section, None)
+
+    def _get_sentence_spans(self, section: dict) -> list[tuple[int, int]]:
+        """セクション本文の文の位置を返す（前後のチャンクで共有するため、初回の分割結果を保持する）"""
+        spans = section.get('sentence_spans')
+        if spans is None:
+            spans = split_sentence_spans(section['text'])
+            section['sentence_spans'] = spans
+        return spans
+
+    def _overlap_chunk(self, prev_section: Optional[dict], section: dict, next_section: Optional[dict]) -> dict:
+        """前後のチャンクの文を1つのチャンクに付け足す"""
+        current_chunk = {key: value for key, value in section.items() if key != 'sentence_spans'}  # コピーを作成
+        text_parts = [section['text']]
+
+        # 前のチャンクの末尾を現在のチャンクの先頭に追加
+        if prev_section is not None:
+            prev_chunk_text = prev_section['text']
+            # 文の境界で切り取る（最後の数文を1回のスライスで取得）
+            spans = self._get_sentence_spans(prev_section)
+            if len(spans) > 1:
+                overlap_start = spans[-3][0] if len(spans) >= 3 else spans[-2][0]
+                overlap_text = prev_chunk_text[overlap_start:].strip()
+                if len(overlap_text) > self.overlap_chars:
+                    # 長すぎる場合は文字数で切り取り
                     overlap_text = prev_chunk_text[-self.overlap_chars:]
-                    current_chunk['text'] = overlap_text + " " + current_chunk['text']
-
-            # 次のチャンクの先頭も少し追加（既存のロジック改善）
-            if i < len(sections) - 1:
-                next_chunk_text = sections[i+1]['text']
-                # 文の境界で切り取り
-                sentences = next_chunk_text.split('。')
-                if sentences:
-                    first_sentence = sentences[0] + '。' if sentences[0] and not sentences[0].endswith('。') else sentences[0]
-                    if len(first_sentence) <= self.overlap_chars // 2:  # 半分のサイズまで
-                        current_chunk['text'] += " " + first_sentence
-                    else:
-                        overlap_text = next_chunk_text[:self.overlap_chars // 2]
-                        current_chunk['text'] += " " + overlap_text
-
-            overlapped_chunks.append(current_chunk)
-
-        return overlapped_chunks
\ No newline at end of file
+            else:
+                overlap_text = prev_chunk_text[-self.overlap_chars:]
+            text_parts.insert(0, overlap_text)
+
+        # 次のチャンクの先頭も少し追加（既存のロジック改善）
+        if next_section is not None:
+            next_chunk_text = next_section['text']
+            # 文の境界で切り取り
+            spans = self._get_sentence_spans(next_section)
+            if spans:
+                first_sentence = next_chunk_text[spans[0][0]:spans[0][1]].strip()
+                if len(first_sentence) <= self.overlap_chars // 2:  # 半分のサイズまで
+                    text_parts.append(first_sentence)
+                else:
+                    text_parts.append(next_chunk_text[:self.overlap_chars // 2])
+
+        # 前後のオーバーラップと本文を1回で連結
+        current_chunk['text'] = " ".join(text_parts)
+        return current_chunk
\ No newline at end of file
@@ -1,7 +1,7 @@
+import hashlib
 import logging
 import os
-import time
-from datetime import datetime
+from datetime import datetime, timezone
 import functions_framework
 
 # 各クラスをそれぞれのファイルからインポート
@@ -16,6 +16,46 @@ logger = logging.getLogger(__name__)
 # 環境変数からプロジェクトIDを取得
 PROJECT_ID = os.getenv('GCP_PROJECT')
 
+# 埋め込み生成とBigQueryへの保存をまとめて行うチャンク数（記事の区切りで確定する）
+CHUNK_FLUSH_SIZE = 500
+
+def _embed_and_insert_chunks(bq_client, vertex_client, pending_chunks, texts_for_embedding, article_ids, force_regenerate, embedding_model, now_iso):
+    """保留中のチャンクの埋め込みを生成して保存し、保存したチャンク数を返す"""
+    # 同一テキストはハッシュでまとめ、APIへは1回だけ送る
+    text_hashes = [hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest() for text in texts_for_embedding]
+    unique_texts = {}
+    for text_hash, text in zip(text_hashes, texts_for_embedding):
+        unique_texts.setdefault(text_hash, text)
+
+    # 過去の実行で生成済みの埋め込みはキャッシュテーブルから再利用する
+    embeddings_by_hash = bq_client.get_cached_embeddings(list(unique_texts), embedding_model)
+    missing_hashes = [text_hash for text_hash in unique_texts if text_hash not in embeddings_by_hash]
+    logger.info(f"埋め込み対象: {len(texts_for_embedding)}件 (重複除外後: {len(unique_texts)}件, キャッシュ利用: {len(unique_texts) - len(missing_hashes)}件)")
+
+    if missing_hashes:
+        embeddings = vertex_client.generate_embeddings_batch([unique_texts[text_hash] for text_hash in missing_hashes])
+        new_embeddings = {
+            text_hash: embedding
+            for text_hash, embedding in zip(missing_hashes, embeddings) if embedding
+        }
+        bq_client.save_cached_embeddings(new_embeddings, embedding_model, now_iso)
+        embeddings_by_hash.update(new_embeddings)
+
+    chunks_to_insert = []
+    for chunk_row, text_hash in zip(pending_chunks, text_hashes):
+        embedding = embeddings_by_hash.get(text_hash)
+        if embedding:
+            chunk_row.update({
+                "content_embedding": embedding,
+                "embedding_model": embedding_model,
+                "created_at": now_iso
+            })
+            chunks_to_insert.append(chunk_row)
+
+    if chunks_to_insert:
+        bq_client.insert_chunks(chunks_to_insert, article_ids, force_regenerate)
+    return len(chunks_to_insert)
+
 @functions_framework.http
 def generate_chunk_embeddings(request):
     """記事をチャンクに分割し、埋め込みベクトルを生成して保存するメイン関数"""
@@ -32,20 +72,40 @@ def generate_chunk_embeddings(request):
         vertex_client = VertexAIClient(project_id=PROJECT_ID)
         chunk_processor = ChunkProcessor()
 
-        # 処理対象の記事を取得
-        articles = bq_client.get_articles_for_chunking(limit=batch_size, offset=offset)
-
-        if not articles:
-            logger.info("処理対象の記事がありません。")
-            return {"status": "success", "message": "処理対象の記事がありません。"}, 200
+        # 処理対象の記事を逐次取得
+        articles = bq_client.iter_articles_for_chunking(limit=batch_size, offset=offset)
 
-        logger.info(f"{len(articles)}件の記事を処理します。")
+        # 1回の実行内で作成日時は共通のため、ループ前に一度だけ求める
+        now_iso = datetime.now(timezone.utc).isoformat()
+        embedding_model = vertex_client.model_name
 
-        all_chunks_to_insert = []
+        pending_chunks = []
+        texts_for_embedding = []
+        pending_article_ids = []
         processed_article_ids = []
+        failed_article_ids = []
+        generated_chunk_count = 0
+        article_count = 0
+
+        def flush_pending_chunks():
+            """保留中の記事のチャンクを確定する（失敗しても他の記事の処理は続ける）"""
+            nonlocal pending_chunks, texts_for_embedding, pending_article_ids, generated_chunk_count
+            try:
+                generated_chunk_count += _embed_and_insert_chunks(
+                    bq_client, vertex_client, pending_chunks, texts_for_embedding,
+                    pending_article_ids, force_regenerate, embedding_model, now_iso
+                )
+                processed_article_ids.extend(pending_article_ids)
+            except Exception as e:
+                logger.error(f"記事ID {pending_article_ids} のチャンク保存中にエラー: {e}", exc_info=True)
+                failed_article_ids.extend(pending_article_ids)
+            pending_chunks = []
+            texts_for_embedding = []
+            pending_article_ids = []
 
         # 記事ごとにループ処理
         for article in articles:
+            article_count += 1
             article_id = str(article['id'])
             try:
                 # HTML版を優先、なければテキスト版を使用
@@ -59,36 +119,48 @@ def generate_chunk_embeddings(request):
                 if not chunks:
                     continue
 
+                # 記事単位で共通の値はチャンクのループ前に求める
+                koza_id = str(article['koza_id']) if article['koza_id'] is not None else None
+                article_title = article['title'] or ''
+
+                # 埋め込みは複数記事分をまとめてバッチ生成するため、ここではテキストのみ用意する
                 for i, chunk in enumerate(chunks):
-                    text_for_embedding = f"記事タイトル: {article['title'] or ''}\nセクション: {chunk['title']}\n\n{chunk['text']}"
-                    embedding = vertex_client.generate_embedding(text_for_embedding)
-                    time.sleep(0.1)
-
-                    if embedding:
-                        all_chunks_to_insert.append({
-                            "chunk_id": f"{article_id}_{i}",
-                            "article_id": article_id,
-                            "koza_id": str(article['koza_id']) if article['koza_id'] is not None else None,
-                            "chunk_index": i,
-                            "chunk_title": chunk['title'],
-                            "chunk_text": chunk['text'],
-                            "content_embedding": embedding,
-                            "embedding_model": vertex_client.model_name,
-                            "created_at": datetime.utcnow().isoformat()
-                        })
-                processed_article_ids.append(article_id)
+                    chunk_title = chunk['title']
+                    chunk_text = chunk['text']
+                    pending_chunks.append({
+                        "chunk_id": f"{article_id}_{i}",
+                        "article_id": article_id,
+                        "koza_id": koza_id,
+                        "chunk_index": i,
+                        "chunk_title": chunk_title,
+                        "chunk_text": chunk_text
+                    })
+                    texts_for_embedding.append(f"記事タイトル: {article_title}\nセクション: {chunk_title}\n\n{chunk_text}")
+                pending_article_ids.append(article_id)
 
             except Exception as e:
                 logger.error(f"記事ID {article_id} の処理中にエラー: {e}", exc_info=True)
                 continue
 
-        if all_chunks_to_insert:
-            bq_client.insert_chunks(all_chunks_to_insert, processed_article_ids, force_regenerate)
+            # 保留中のチャンクが一定数を超えたら、記事単位で埋め込み生成と保存を確定してメモリを解放する
+            if len(pending_chunks) >= CHUNK_FLUSH_SIZE:
+                flush_pending_chunks()
+
+        if article_count == 0:
+            logger.info("処理対象の記事がありません。")
+            return {"status": "success", "message": "処理対象の記事がありません。"}, 200
+
+        logger.info(f"{article_count}件の記事を処理しました。")
+
+        # 残りのチャンクの埋め込みをバッチリクエストで生成して保存
+        if pending_chunks:
+            flush_pending_chunks()
 
         return {
-            "status": "success",
+            "status": "partial_failure" if failed_article_ids else "success",
             "processed_articles": len(processed_article_ids),
-            "generated_chunks": len(all_chunks_to_insert)
+            "failed_articles": len(failed_article_ids),
+            "generated_chunks": generated_chunk_count
         }, 200
 
     except Exception as e:
@@ -1,14 +1,61 @@
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
 from typing import List, Optional
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.auth import default
 from google.auth.transport.requests import Request
 from google.cloud import aiplatform
 
 logger = logging.getLogger(__name__)
 
+# 1リクエストあたりのテキスト数（APIの上限は250件だが、合計2万トークンの上限に収まるよう小さめにする）
+EMBEDDING_BATCH_SIZE = 16
+
+# 同時に送信するバッチリクエスト数
+EMBEDDING_MAX_WORKERS = 4
+
+# HTTPコネクションプールのサイズ（並列ワーカー数より大きく取る）
+HTTP_POOL_SIZE = 32
+
+# Vertex AI（埋め込みAPI）への1分あたりのリクエスト数の上限（トークンバケットで制御）
+EMBEDDING_REQUESTS_PER_MINUTE = 600
+
+# アクセストークンの有効期限の何秒前に更新するか
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+# 有効期限が取得できない認証情報の場合のトークン再利用時間
+DEFAULT_TOKEN_LIFETIME_SECONDS = 55 * 60
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット（バーストは容量まで許可し、枯渇時のみ待機する）"""
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.fill_rate = rate_per_minute / 60.0
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得する（なければ補充されるまで待機）"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.fill_rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.fill_rate
+            time.sleep(wait_seconds)
+
 class VertexAIClient:
     """Vertex AI Text Embeddings APIクライアント"""
     
@@ -20,59 +67,145 @@ class VertexAIClient:
         aiplatform.init(project=project_id, location=location)
         
         self.credentials, _ = default()
+        # スレッド間で1つのトークンを共有し、更新はロック下で行う
+        self._token_lock = threading.Lock()
+        
+        # コネクションを再利用するセッション（リトライはHTTPAdapterに任せる）
+        self.session = requests.Session()
+        retry = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['POST'])
+        )
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        
+        # APIクォータに近づいた場合のみ送信を待機させる
+        self._rate_limiter = TokenBucket(EMBEDDING_REQUESTS_PER_MINUTE)
+        
+        # トークンは初回リクエスト時に取得し、有効期限が近づくまで使い回す
+        self._token_expiry = 0.0
         
         self.endpoint = f"https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/publishers/google/models/{self.model_name}:predict"
         
         logger.info(f"Vertex AI Client initialized - Project: {project_id}, Model: {self.model_name}")
+
+    def _refresh_access_token(self):
+        """アクセストークンを更新し、セッションのAuthorizationヘッダーに反映"""
+        self.credentials.refresh(Request())
+        expiry = self.credentials.expiry
+        if expiry is not None:
+            # google-authのexpiryはタイムゾーンなしのUTC
+            self._token_expiry = expiry.replace(tzinfo=timezone.utc).timestamp()
+        else:
+            self._token_expiry = time.time() + DEFAULT_TOKEN_LIFETIME_SECONDS
+        self.session.headers['Authorization'] = f'Bearer {self.credentials.token}'
+
+    def _ensure_access_token(self):
+        """有効期限が近ければ共有アクセストークンを更新"""
+        if time.time() < self._token_expiry - TOKEN_EXPIRY_MARGIN_SECONDS:
+            return
+        with self._token_lock:
+            # 待機中に他スレッドが更新済みなら何もしない
+            if time.time() >= self._token_expiry - TOKEN_EXPIRY_MARGIN_SECONDS:
+                self._refresh_access_token()
     
-    def generate_embedding(self, text: str, retry_count: int = 3) -> Optional[List[float]]:
+    def generate_embedding(self, text: str) -> Optional[List[float]]:
         """テキストの埋め込みベクトルを生成（REST API使用）"""
         if not text or not text.strip():
             logger.warning("Embedding generation skipped for empty text.")
             return None
         
-        for attempt in range(retry_count):
-            try:
-                self.credentials.refresh(Request())
-                access_token = self.credentials.token
-                
-                headers = {
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/json'
-                }
-                
-                payload = {
-                    "instances": [
-                        {
-                            "content": text,
-                            "task_type": "RETRIEVAL_DOCUMENT"
-                        }
-                    ]
-                }
-                
-                response = requests.post(self.endpoint, headers=headers, json=payload, timeout=60)
-                
-                response.raise_for_status()
-
-                result = response.json()
-                
-                if 'predictions' in result and len(result['predictions']) > 0:
-                    prediction = result['predictions'][0]
-                    if 'embeddings' in prediction and 'values' in prediction['embeddings']:
-                        embedding_vector = prediction['embeddings']['values']
-                        logger.info(f"Embedding generated successfully. Dimensions: {len(embedding_vector)}")
-                        return embedding_vector
-
-                logger.warning(f"API response did not contain expected embedding data. Response: {result}")
-                return None
-
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"API call failed on attempt {attempt + 1}/{retry_count}: {e}")
-                if attempt < retry_count - 1:
-                    wait_time = (2 ** attempt)
-                    logger.info(f"Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error("Failed to generate embedding after multiple retries.")
-                    return None
-        return None
+        try:
+            self._ensure_access_token()
+            
+            payload = {
+                "instances": [
+                    {
+                        "content": text,
+                        "task_type": "RETRIEVAL_DOCUMENT"
+                    }
+                ]
+            }
+            
+            self._rate_limiter.acquire()
+            # JSONのエンコード・デコードはorjsonで行う（Content-Typeはセッションに設定済み）
+            response = self.session.post(self.endpoint, data=orjson.dumps(payload), timeout=60)
+            
+            response.raise_for_status()
+
+            result = orjson.loads(response.content)
+            
+            if 'predictions' in result and len(result['predictions']) > 0:
+                prediction = result['predictions'][0]
+                if 'embeddings' in prediction and 'values' in prediction['embeddings']:
+                    embedding_vector = prediction['embeddings']['values']
+                    logger.info(f"Embedding generated successfully. Dimensions: {len(embedding_vector)}")
+                    return embedding_vector
+
+            logger.warning(f"API response did not contain expected embedding data. Response: {result}")
+            return None
+
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            logger.error(f"Failed to generate embedding after retries: {e}")
+            return None
+
+    def generate_embeddings_batch(self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> List[Optional[List[float]]]:
+        """複数テキストの埋め込みベクトルをまとめて生成（入力と同じ順序で返す）"""
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        starts = range(0, len(texts), batch_size)
+        if not starts:
+            return embeddings
+        
+        # バッチリクエストを並列送信し、各バッチの結果を入力の位置に書き込む
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_WORKERS, len(starts))) as executor:
+            batch_results = executor.map(
+                lambda start: self._generate_embeddings_request(texts[start:start + batch_size]),
+                starts
+            )
+            for start, batch_embeddings in zip(starts, batch_results):
+                embeddings[start:start + len(batch_embeddings)] = batch_embeddings
+        
+        return embeddings
+
+    def _generate_embeddings_request(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """1リクエスト分のテキストの埋め込みベクトルを生成（空テキストはNone）"""
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        target_indexes = [i for i, text in enumerate(texts) if text and text.strip()]
+        if not target_indexes:
+            return results
+        
+        try:
+            self._ensure_access_token()
+            
+            payload = {
+                "instances": [
+                    {
+                        "content": texts[i],
+                        "task_type": "RETRIEVAL_DOCUMENT"
+                    }
+                    for i in target_indexes
+                ]
+            }
+            
+            self._rate_limiter.acquire()
+            response = self.session.post(self.endpoint, data=orjson.dumps(payload), timeout=120)
+            
+            response.raise_for_status()
+
+            predictions = orjson.loads(response.content).get('predictions', [])
+            if len(predictions) != len(target_indexes):
+                logger.warning(f"API response prediction count mismatch. Expected: {len(target_indexes)}, Got: {len(predictions)}")
+            
+            for i, prediction in zip(target_indexes, predictions):
+                values = prediction.get('embeddings', {}).get('values')
+                if values:
+                    results[i] = values
+            
+            logger.info(f"Batch embeddings generated successfully. Count: {len(predictions)}")
+
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            logger.error(f"Failed to generate batch embeddings after retries: {e}")
+        return results
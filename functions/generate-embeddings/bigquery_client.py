@@ -1,23 +1,164 @@
 from google.cloud import bigquery
+from gcp_clients import get_bq_client
 from google.cloud.exceptions import NotFound
 import logging
-from typing import List, Dict, Any, Optional
+from typing import Iterator, List, Dict, Any, Optional, Tuple, Union
+import base64
 import json
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+try:
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import types as storage_types
+    import pyarrow.compute as pc
+    STORAGE_READ_AVAILABLE = True
+except ImportError:
+    STORAGE_READ_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
+# Storage Read APIで並列に読み込むストリーム数の上限
+STORAGE_READ_MAX_STREAMS = 4
+
+# ストリーム読み込みスレッドと呼び出し側の間でバッファするページ（RecordBatch）数
+STORAGE_READ_QUEUE_SIZE = 8
+
+# Storage Read APIで取得する列（埋め込み生成に必要な列のみ）
+_EMBEDDING_SOURCE_FIELDS = ["id", "title", "full_content", "qanda_content", "koza_id", "pageviews", "updated_at"]
+
+# insert_rows_jsonで1回に送る行数
+INSERT_ROWS_JSON_BATCH_SIZE = 500
+
+# 総数・統計クエリの結果をキャッシュする秒数（連続するバッチ呼び出しで同じ集計を繰り返さない）
+STATS_CACHE_TTL_SECONDS = 60
+
+# ウォームなインスタンスでは呼び出しをまたいで再利用される（キー: (種別, プロジェクト, 引数)）
+_stats_cache: Dict[Tuple, Tuple[float, Any]] = {}
+_stats_cache_lock = threading.Lock()
+
+def _get_cached_stats(key: Tuple) -> Optional[Any]:
+    """有効期限内のキャッシュ値を返す（なければNone）"""
+    with _stats_cache_lock:
+        entry = _stats_cache.get(key)
+    if entry and time.monotonic() - entry[0] < STATS_CACHE_TTL_SECONDS:
+        return entry[1]
+    return None
+
+def _set_cached_stats(key: Tuple, value: Any):
+    """集計結果をキャッシュに保存"""
+    with _stats_cache_lock:
+        _stats_cache[key] = (time.monotonic(), value)
+
+# 量子化した埋め込みの列（content_embedding_i8, embedding_scale）はmigrate_embedding_schema.shで追加する
+def quantize_embedding(embedding: List[float]) -> Tuple[bytes, float]:
+    """
+    埋め込みベクトルをベクトルごとのスケール付きint8に量子化
+    
+    Returns:
+        (int8値のバイト列, スケール) のタプル。元の値は int8値 * スケール で復元できる
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+    scale = max_abs / 127 if max_abs > 0 else 1.0
+    quantized = np.clip(np.round(vector / scale), -127, 127).astype(np.int8)
+    return quantized.tobytes(), scale
+
+def dequantize_embedding(data: bytes, scale: float) -> np.ndarray:
+    """quantize_embeddingで量子化した埋め込みをfloat32のベクトルに復元"""
+    return np.frombuffer(data, dtype=np.int8).astype(np.float32) * scale
+
 class BigQueryClient:
     """BigQuery操作クライアント（大量データ対応版）"""
     
-    def __init__(self, project_id: str = "seo-optimize-464208"):
+    def __init__(self, project_id: str = "seo-optimize-464208", client: Optional[bigquery.Client] = None):
         self.project_id = project_id
         self.dataset_id = "content_analysis"
         self.articles_table = "articles"
+        # generate-chunks-serviceと共有する埋め込みキャッシュ（テキストのハッシュ → 埋め込み）
+        # テーブルはmigrate_embedding_schema.shで作成する
+        self.embedding_cache_table_id = f"{project_id}.{self.dataset_id}.embedding_cache"
         
-        self.client = bigquery.Client(project=project_id)
+        # 指定がなければプロセス内で共有するクライアントを使う
+        self.client = client or get_bq_client(project_id)
         logger.info(f"BigQuery初期化完了 - Project: {project_id}")
     
+    def get_cached_embeddings(self, text_hashes: List[str], embedding_model: str) -> Dict[str, List[float]]:
+        """
+        テキストのハッシュをキーに、保存済みの埋め込みベクトルを取得
+        
+        Args:
+            text_hashes: テキストのハッシュのリスト
+            embedding_model: 埋め込みモデル名
+            
+        Returns:
+            ハッシュと埋め込みベクトルの辞書（失敗時は空の辞書）
+        """
+        if not text_hashes:
+            return {}
+        
+        try:
+            query = f"""
+            SELECT text_hash, ANY_VALUE(content_embedding) AS content_embedding
+            FROM `{self.embedding_cache_table_id}`
+            WHERE embedding_model = @embedding_model
+            AND text_hash IN UNNEST(@text_hashes)
+            GROUP BY text_hash
+            """
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("embedding_model", "STRING", embedding_model),
+                bigquery.ArrayQueryParameter("text_hashes", "STRING", text_hashes)
+            ])
+            results = self.client.query(query, job_config=job_config).result()
+            return {row.text_hash: list(row.content_embedding) for row in results if row.content_embedding}
+            
+        except Exception as e:
+            # キャッシュは最適化のためのものなので、失敗しても全件APIで生成する
+            logger.warning(f"埋め込みキャッシュ取得エラー: {str(e)}")
+            return {}
+    
+    def save_cached_embeddings(self, embeddings_by_hash: Dict[str, List[float]], embedding_model: str, created_at: str):
+        """
+        新たに生成した埋め込みベクトルをテキストのハッシュとともに保存
+        
+        Args:
+            embeddings_by_hash: ハッシュと埋め込みベクトルの辞書
+            embedding_model: 埋め込みモデル名
+            created_at: 作成日時（ISO 8601形式）
+        """
+        if not embeddings_by_hash:
+            return
+        
+        rows = [
+            {
+                "text_hash": text_hash,
+                "embedding_model": embedding_model,
+                "content_embedding": embedding,
+                "created_at": created_at
+            }
+            for text_hash, embedding in embeddings_by_hash.items()
+        ]
+        try:
+            errors = []
+            for offset in range(0, len(rows), INSERT_ROWS_JSON_BATCH_SIZE):
+                errors.extend(self.client.insert_rows_json(
+                    self.embedding_cache_table_id, rows[offset:offset + INSERT_ROWS_JSON_BATCH_SIZE]
+                ))
+            if errors:
+                logger.warning(f"埋め込みキャッシュ保存中にエラー: {errors}")
+            else:
+                logger.info(f"埋め込みキャッシュ保存完了: {len(rows)}件")
+                
+        except Exception as e:
+            logger.warning(f"埋め込みキャッシュ保存エラー: {str(e)}")
+    
     def get_articles_statistics(self) -> Dict[str, Any]:
         """
         記事の統計情報を取得
@@ -25,6 +166,12 @@ class BigQueryClient:
         Returns:
             統計情報辞書
         """
+        cache_key = ('articles_statistics', self.project_id)
+        cached = _get_cached_stats(cache_key)
+        if cached is not None:
+            logger.info("記事統計: キャッシュを使用")
+            return dict(cached)
+        
         try:
             query = f"""
             SELECT 
@@ -54,7 +201,8 @@ class BigQueryClient:
                 }
                 
                 logger.info(f"記事統計: {stats}")
-                return stats
+                _set_cached_stats(cache_key, stats)
+                return dict(stats)
             
             return {}
             
@@ -63,17 +211,21 @@ class BigQueryClient:
             return {}
     
     def get_articles_for_embedding(self, limit: int = 50, force_regenerate: bool = False, 
-                                 offset: int = 0) -> List[Dict[str, Any]]:
+                                 offset: int = 0, cursor: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict[str, Any]], int]:
         """
-        埋め込み生成対象の記事を取得（ページネーション対応）
+        埋め込み生成対象の記事と処理対象の総数を1回のクエリで取得（ページネーション対応）
         
         Args:
             limit: 取得件数制限
             force_regenerate: 既存の埋め込みを再生成するか
-            offset: オフセット（ページネーション用）
+            offset: オフセット（cursorが指定されていない場合のみ使用）。
+                    cursor指定時は処理済み件数として総数の計算にのみ使用する
+            cursor: 前のページの最後の記事のソートキー（make_article_cursorで作成）。
+                    指定した場合はOFFSETではなくキーセットページネーションで続きを取得する
             
         Returns:
-            記事データのリスト
+            (記事データのリスト, 処理対象記事の総数) のタプル
+            （ページが空の場合は総数を求められないため、総数としてoffsetを返す）
         """
         try:
             # 条件に応じてクエリを構築
@@ -93,6 +245,30 @@ class BigQueryClient:
                 AND CHAR_LENGTH(full_content) > 50
                 """
             
+            query_parameters = []
+            if cursor:
+                # ソートキー (pageviews DESC, content_length DESC, updated_at DESC, id ASC) で前ページの続きから取得
+                # OFFSETと違い、読み飛ばす行数に比例したコストがかからない
+                where_clause += """
+                AND (
+                    COALESCE(pageviews, 0) < @cursor_pageviews
+                    OR (COALESCE(pageviews, 0) = @cursor_pageviews AND CHAR_LENGTH(full_content) < @cursor_content_length)
+                    OR (COALESCE(pageviews, 0) = @cursor_pageviews AND CHAR_LENGTH(full_content) = @cursor_content_length
+                        AND COALESCE(updated_at, TIMESTAMP '1970-01-01') < @cursor_updated_at)
+                    OR (COALESCE(pageviews, 0) = @cursor_pageviews AND CHAR_LENGTH(full_content) = @cursor_content_length
+                        AND COALESCE(updated_at, TIMESTAMP '1970-01-01') = @cursor_updated_at AND id > @cursor_id)
+                )
+                """
+                query_parameters = [
+                    bigquery.ScalarQueryParameter("cursor_pageviews", "INT64", cursor['pageviews']),
+                    bigquery.ScalarQueryParameter("cursor_content_length", "INT64", cursor['content_length']),
+                    bigquery.ScalarQueryParameter("cursor_updated_at", "TIMESTAMP", cursor['updated_at']),
+                    bigquery.ScalarQueryParameter("cursor_id", "STRING", cursor['id']),
+                ]
+                offset_clause = ""
+            else:
+                offset_clause = f"OFFSET {offset}"
+            
             query = f"""
             SELECT 
                 id,
@@ -104,24 +280,30 @@ class BigQueryClient:
                 content_type,
                 created_at,
                 updated_at,
-                CHAR_LENGTH(full_content) as content_length
+                CHAR_LENGTH(full_content) as content_length,
+                -- LIMIT/OFFSET適用前の件数（別途COUNTクエリを実行せずに総数を得る）
+                COUNT(*) OVER () as total_count
             FROM `{self.project_id}.{self.dataset_id}.{self.articles_table}`
             {where_clause}
             ORDER BY 
                 CASE WHEN pageviews IS NULL THEN 0 ELSE pageviews END DESC,
                 content_length DESC,
-                updated_at DESC
+                COALESCE(updated_at, TIMESTAMP '1970-01-01') DESC,
+                id
             LIMIT {limit}
-            OFFSET {offset}
+            {offset_clause}
             """
             
-            logger.info(f"記事取得クエリ実行: force_regenerate={force_regenerate}, limit={limit}, offset={offset}")
+            logger.info(f"記事取得クエリ実行: force_regenerate={force_regenerate}, limit={limit}, offset={offset}, cursor={cursor}")
             
-            query_job = self.client.query(query)
+            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+            query_job = self.client.query(query, job_config=job_config)
             results = query_job.result()
             
             articles = []
+            matched_count = 0
             for row in results:
+                matched_count = row.total_count
                 articles.append({
                     'id': row.id,
                     'title': row.title,
@@ -135,12 +317,138 @@ class BigQueryClient:
                     'content_length': row.content_length
                 })
             
-            logger.info(f"記事取得完了: {len(articles)}件 (offset: {offset})")
-            return articles
+            if not articles:
+                total_count = offset
+            elif cursor:
+                # カーソル指定時の件数はカーソル以降の残り件数
+                total_count = offset + matched_count
+            else:
+                total_count = matched_count
+            
+            logger.info(f"記事取得完了: {len(articles)}件 (offset: {offset}, cursor: {cursor}, 総数: {total_count})")
+            return articles, total_count
             
         except Exception as e:
             logger.error(f"記事取得エラー: {str(e)}")
-            return []
+            return [], 0
+    
+    def stream_articles_for_embedding(self, max_streams: int = STORAGE_READ_MAX_STREAMS,
+                                      updated_before: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        全記事をBigQuery Storage Read APIで読み込む（全件再生成用）
+        
+        クエリジョブとREST APIのページングを経由せず、テーブルを複数ストリームで
+        並列に読み込んで1行ずつ返す。行の条件では埋め込みの有無を判定できないため、
+        force_regenerate時の全件処理でのみ使用する。
+        
+        Args:
+            max_streams: 並列に読み込むストリーム数の上限
+            updated_before: 指定した日時（ISO 8601形式）より前に更新された記事のみ読み込む。
+                            埋め込みを更新した記事はupdated_atが更新されるため、途中で打ち切った
+                            全件処理の開始日時を渡すと未処理の記事だけを読み込める
+            
+        Yields:
+            記事情報の辞書（本文50文字以下の記事は除外、順序は不定）
+        """
+        if not STORAGE_READ_AVAILABLE:
+            raise RuntimeError("google-cloud-bigquery-storageがインストールされていません")
+        
+        row_restriction = "full_content IS NOT NULL AND full_content != ''"
+        if updated_before:
+            # 行の条件はパラメータを受け付けないため、日時として解釈できた値だけを埋め込む
+            updated_before = datetime.fromisoformat(updated_before).isoformat()
+            row_restriction += f" AND (updated_at IS NULL OR updated_at < CAST('{updated_before}' AS TIMESTAMP))"
+        
+        read_client = bigquery_storage_v1.BigQueryReadClient()
+        requested_session = storage_types.ReadSession(
+            table=f"projects/{self.project_id}/datasets/{self.dataset_id}/tables/{self.articles_table}",
+            data_format=storage_types.DataFormat.ARROW,
+            read_options=storage_types.ReadSession.TableReadOptions(
+                selected_fields=_EMBEDDING_SOURCE_FIELDS,
+                row_restriction=row_restriction
+            )
+        )
+        session = read_client.create_read_session(
+            parent=f"projects/{self.project_id}",
+            read_session=requested_session,
+            max_stream_count=max_streams
+        )
+        if not session.streams:
+            return
+        logger.info(f"Storage Read APIセッション作成完了 - ストリーム数: {len(session.streams)}")
+        
+        # 各ストリームを別スレッドでページ（ArrowのRecordBatch）単位で読み込み、キュー経由で呼び出し側に渡す
+        rows_queue = queue.Queue(maxsize=STORAGE_READ_QUEUE_SIZE)
+        stream_done = object()
+        stop_event = threading.Event()
+        
+        def put(item) -> bool:
+            # 呼び出し側が読み込みを打ち切った場合はFalseを返して終了させる
+            while not stop_event.is_set():
+                try:
+                    rows_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def read_stream(stream_name: str):
+            try:
+                for page in read_client.read_rows(stream_name).rows(session).pages:
+                    record_batch = page.to_arrow()
+                    # 文字数の条件は行の条件で指定できないため、列単位の演算でまとめて除外する
+                    record_batch = record_batch.filter(
+                        pc.greater(pc.utf8_length(record_batch.column('full_content')), 50)
+                    )
+                    if record_batch.num_rows and not put(record_batch):
+                        return
+            except Exception as e:
+                logger.error(f"Storage Read APIの読み込みエラー ({stream_name}): {str(e)}")
+                put(e)
+            finally:
+                put(stream_done)
+        
+        executor = ThreadPoolExecutor(max_workers=len(session.streams))
+        try:
+            for stream in session.streams:
+                executor.submit(read_stream, stream.name)
+            
+            remaining_streams = len(session.streams)
+            while remaining_streams:
+                item = rows_queue.get()
+                if item is stream_done:
+                    remaining_streams -= 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                
+                # 列ごとにまとめてPythonの値に変換し、行の辞書は列のzipで組み立てる
+                columns = item.to_pydict()
+                for values in zip(*(columns[field] for field in _EMBEDDING_SOURCE_FIELDS)):
+                    yield dict(zip(_EMBEDDING_SOURCE_FIELDS, values))
+        finally:
+            # 途中で打ち切られた場合も読み込みスレッドを止める
+            stop_event.set()
+            executor.shutdown(wait=False)
+    
+    @staticmethod
+    def make_article_cursor(article: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        get_articles_for_embeddingで取得した記事から、次ページ取得用のカーソルを作成
+        
+        Args:
+            article: ページの最後の記事
+            
+        Returns:
+            JSONにシリアライズ可能なカーソル辞書
+        """
+        updated_at = article.get('updated_at')
+        return {
+            'pageviews': article.get('pageviews') or 0,
+            'content_length': article['content_length'],
+            'updated_at': updated_at.isoformat() if updated_at else '1970-01-01T00:00:00+00:00',
+            'id': str(article['id'])
+        }
     
     def get_total_articles_count(self, force_regenerate: bool = False) -> int:
         """
@@ -152,6 +460,12 @@ class BigQueryClient:
         Returns:
             総記事数
         """
+        cache_key = ('total_articles_count', self.project_id, force_regenerate)
+        cached = _get_cached_stats(cache_key)
+        if cached is not None:
+            logger.info(f"処理対象記事総数: {cached}（キャッシュ）")
+            return cached
+        
         try:
             if force_regenerate:
                 where_clause = """
@@ -179,6 +493,7 @@ class BigQueryClient:
             for row in results:
                 total_count = row.total_count
                 logger.info(f"処理対象記事総数: {total_count}")
+                _set_cached_stats(cache_key, total_count)
                 return total_count
             
             return 0
@@ -187,30 +502,34 @@ class BigQueryClient:
             logger.error(f"総記事数取得エラー: {str(e)}")
             return 0
     
-    def get_articles_by_course(self, course_id: str, limit: int = 100, 
+    def get_articles_by_course(self, course_ids: Union[str, List[str]], limit: int = 100, 
                              force_regenerate: bool = False) -> List[Dict[str, Any]]:
         """
-        講座別に記事を取得
+        講座別に記事を取得（複数講座の場合も1回のクエリで取得）
         
         Args:
-            course_id: 講座ID
-            limit: 取得件数制限
+            course_ids: 講座ID、または講座IDのリスト
+            limit: 取得件数制限（全講座の合計）
             force_regenerate: 既存の埋め込みを再生成するか
             
         Returns:
             記事データのリスト
         """
+        if isinstance(course_ids, (str, int)):
+            course_ids = [course_ids]
+        course_ids = [str(course_id) for course_id in course_ids]
+        
         try:
             if force_regenerate:
-                where_clause = f"""
-                WHERE koza_id = '{course_id}'
+                where_clause = """
+                WHERE koza_id IN UNNEST(@course_ids)
                 AND full_content IS NOT NULL 
                 AND full_content != ''
                 AND CHAR_LENGTH(full_content) > 50
                 """
             else:
-                where_clause = f"""
-                WHERE koza_id = '{course_id}'
+                where_clause = """
+                WHERE koza_id IN UNNEST(@course_ids)
                 AND (content_embedding IS NULL OR ARRAY_LENGTH(content_embedding) = 0)
                 AND full_content IS NOT NULL 
                 AND full_content != ''
@@ -233,10 +552,14 @@ class BigQueryClient:
             ORDER BY 
                 CASE WHEN pageviews IS NULL THEN 0 ELSE pageviews END DESC,
                 updated_at DESC
-            LIMIT {limit}
+            LIMIT @limit
             """
             
-            query_job = self.client.query(query)
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter("course_ids", "STRING", course_ids),
+                bigquery.ScalarQueryParameter("limit", "INT64", limit)
+            ])
+            query_job = self.client.query(query, job_config=job_config)
             results = query_job.result()
             
             articles = []
@@ -253,7 +576,11 @@ class BigQueryClient:
                     'updated_at': row.updated_at
                 })
             
-            logger.info(f"講座{course_id}の記事取得完了: {len(articles)}件")
+            articles_by_course = defaultdict(list)
+            for article in articles:
+                articles_by_course[str(article['koza_id'])].append(article)
+            for course_id in course_ids:
+                logger.info(f"講座{course_id}の記事取得完了: {len(articles_by_course[course_id])}件")
             return articles
             
         except Exception as e:
@@ -273,16 +600,28 @@ class BigQueryClient:
             更新成功フラグ
         """
         try:
+            quantized, scale = quantize_embedding(embedding)
+            
             query = f"""
             UPDATE `{self.project_id}.{self.dataset_id}.{self.articles_table}`
             SET 
-                content_embedding = {embedding},
-                embedding_model = '{model_name}',
+                content_embedding = @embedding,
+                content_embedding_i8 = @embedding_i8,
+                embedding_scale = @embedding_scale,
+                embedding_model = @model_name,
                 updated_at = CURRENT_TIMESTAMP()
-            WHERE id = '{article_id}'
+            WHERE id = @id
             """
             
-            query_job = self.client.query(query)
+            # 値はパラメータで渡す（埋め込みをSQL文字列に展開しない）
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter("embedding", "FLOAT64", embedding),
+                bigquery.ScalarQueryParameter("embedding_i8", "BYTES", quantized),
+                bigquery.ScalarQueryParameter("embedding_scale", "FLOAT64", scale),
+                bigquery.ScalarQueryParameter("model_name", "STRING", model_name),
+                bigquery.ScalarQueryParameter("id", "STRING", str(article_id))
+            ])
+            query_job = self.client.query(query, job_config=job_config)
             query_job.result()  # 完了を待機
             
             # 更新件数を確認
@@ -297,6 +636,84 @@ class BigQueryClient:
             logger.error(f"記事ID {article_id}: 埋め込み更新エラー - {str(e)}")
             return False
     
+    def bulk_update_embeddings(self, rows: List[Tuple[str, List[float], str]], separate_column: bool = False) -> int:
+        """
+        複数記事の埋め込みベクトルをステージングテーブル経由のMERGE 1回で更新
+        
+        Args:
+            rows: (記事ID, 埋め込みベクトル, モデル名) のリスト
+            separate_column: Trueの場合、検索が参照するcontent_embeddingではなくservice_embedding列に保存する
+                             （GPU埋め込みサービスなど、Vertex AIとベクトル空間が異なるモデルの埋め込み用）
+            
+        Returns:
+            更新された記事数
+        """
+        if not rows:
+            return 0
+        
+        articles_table_id = f"{self.project_id}.{self.dataset_id}.{self.articles_table}"
+        staging_table_id = f"{articles_table_id}_embedding_staging_{uuid.uuid4().hex}"
+        
+        # 768次元のベクトルをSQL文字列に埋め込まないよう、ロードジョブでステージングテーブルに投入
+        load_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField("id", "STRING"),
+                bigquery.SchemaField("embedding", "FLOAT64", mode="REPEATED"),
+                bigquery.SchemaField("embedding_i8", "BYTES"),
+                bigquery.SchemaField("embedding_scale", "FLOAT64"),
+                bigquery.SchemaField("model", "STRING"),
+            ],
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        staging_rows = []
+        for article_id, embedding, model_name in rows:
+            staging_row = {"id": str(article_id), "embedding": embedding, "model": model_name}
+            if not separate_column:
+                quantized, scale = quantize_embedding(embedding)
+                # JSONロードではBYTES列はbase64文字列で渡す
+                staging_row["embedding_i8"] = base64.b64encode(quantized).decode('ascii')
+                staging_row["embedding_scale"] = scale
+            staging_rows.append(staging_row)
+        
+        if separate_column:
+            # 列はmigrate_embedding_schema.shで追加する
+            set_clause = """
+                service_embedding = S.embedding,
+                service_embedding_model = S.model,"""
+        else:
+            set_clause = """
+                content_embedding = S.embedding,
+                content_embedding_i8 = S.embedding_i8,
+                embedding_scale = S.embedding_scale,
+                embedding_model = S.model,"""
+        
+        try:
+            self.client.load_table_from_json(staging_rows, staging_table_id, job_config=load_config).result()
+            
+            query = f"""
+            MERGE `{articles_table_id}` T
+            USING `{staging_table_id}` S
+            ON T.id = S.id
+            WHEN MATCHED THEN
+              UPDATE SET{set_clause}
+                updated_at = CURRENT_TIMESTAMP()
+            """
+            
+            query_job = self.client.query(query)
+            query_job.result()  # 完了を待機
+            
+            updated_count = query_job.num_dml_affected_rows or 0
+            if updated_count < len(rows):
+                logger.warning(f"埋め込み一括更新: {len(rows) - updated_count}件の更新対象が見つかりません")
+            logger.info(f"埋め込み一括更新完了: {updated_count}/{len(rows)}件")
+            return updated_count
+            
+        except Exception as e:
+            logger.error(f"埋め込み一括更新エラー: {str(e)}")
+            return 0
+        finally:
+            self.client.delete_table(staging_table_id, not_found_ok=True)
+    
     def get_course_statistics(self) -> List[Dict[str, Any]]:
         """
         講座別の統計情報を取得
@@ -1,33 +1,131 @@
 from google.cloud import bigquery
+from gcp_clients import get_bq_client
 import logging
-from typing import Dict, Optional
+import os
+import threading
+from typing import Dict, List, Optional
 import json
 
+try:
+    from google.cloud import storage
+    STORAGE_AVAILABLE = True
+except ImportError:
+    STORAGE_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
+# 講座マッピングのJSONを置くGCSのURI（例: gs://bucket/courses.json）。未設定ならBigQueryのみ使用
+COURSE_CACHE_GCS_URI = os.getenv('COURSE_CACHE_GCS_URI')
+
+# ウォームなインスタンスでは呼び出しをまたいで再利用される講座マッピング
+_MODULE_COURSE_CACHE: Optional[Dict[str, str]] = None
+_module_cache_lock = threading.Lock()
+
+# 講座名・スラッグから資格分野を特定するためのキーワード
+FIELD_MAPPING = {
+    'real_estate': ('宅建', '宅地建物', 'マンション管理', '管理業務', 'takken', 'mankan'),
+    'finance': ('fp', 'ファイナンシャル', '証券', '年金', 'gaimuin', 'nenkin'),
+    'labor': ('社会保険労務士', '社労士', 'sharoushi'),
+    'legal': ('行政書士', '司法書士', 'gyosei', 'shoshi'),
+    'technology': ('it', '基本情報', 'fe', 'システム'),
+    'accounting': ('簿記', 'boki'),
+    'trade': ('通関士', 'tsukanshi'),
+    'travel': ('旅行', 'ryokou'),
+    'safety': ('危険物', 'kikenbutsu')
+}
+
+# (キーワード, 分野) の一覧（FIELD_MAPPINGの順序を保ち、最初に一致したキーワードの分野を採用する）
+_FIELD_KEYWORD_PAIRS = tuple(
+    (keyword, field) for field, keywords in FIELD_MAPPING.items() for keyword in keywords
+)
+
+def identify_course_field_type(course_name: str, course_slug: str) -> str:
+    """講座名・スラッグから資格分野を特定（該当なしは'general'）"""
+    course_name = course_name.lower()
+    course_slug = course_slug.lower()
+    for keyword, field in _FIELD_KEYWORD_PAIRS:
+        if keyword in course_name or keyword in course_slug:
+            return field
+    return 'general'
+
+def _parse_gcs_uri(uri: str):
+    """gs://bucket/path を (bucket, path) に分割"""
+    bucket_name, _, blob_name = uri[len("gs://"):].partition("/")
+    return bucket_name, blob_name
+
 class CourseMapper:
     """講座情報のマッピングクラス"""
     
-    def __init__(self, project_id: str = "seo-optimize-464208"):
+    def __init__(self, project_id: str = "seo-optimize-464208", client: Optional[bigquery.Client] = None):
         self.project_id = project_id
         self.dataset_id = "content_analysis"
         self.courses_table = "courses"
-        self.client = bigquery.Client(project=project_id)
-        self._course_cache = {}
-        self._cache_loaded = False
+        # 指定がなければプロセス内で共有するクライアントを使う
+        self.client = client or get_bq_client(project_id)
+        self._course_cache = _MODULE_COURSE_CACHE or {}
+        self._cache_loaded = _MODULE_COURSE_CACHE is not None
         
         logger.info(f"CourseMapper初期化完了 - Project: {project_id}")
     
     def load_course_mapping(self) -> Dict[str, str]:
         """
-        BigQueryから講座マッピングを取得
+        講座マッピングを取得（モジュールのキャッシュ → GCS → BigQueryの順に参照）
         
         Returns:
             講座IDと名前のマッピング辞書
         """
+        global _MODULE_COURSE_CACHE
+        
         if self._cache_loaded and self._course_cache:
             return self._course_cache
         
+        with _module_cache_lock:
+            if _MODULE_COURSE_CACHE is None:
+                _MODULE_COURSE_CACHE = self._load_course_mapping_from_gcs()
+            if _MODULE_COURSE_CACHE:
+                self._course_cache = _MODULE_COURSE_CACHE
+                self._cache_loaded = True
+                return self._course_cache
+        
+        return self._load_course_mapping_from_bigquery()
+    
+    def _load_course_mapping_from_gcs(self) -> Optional[Dict[str, str]]:
+        """GCSに保存された講座マッピングを取得（未設定・失敗時はNone）"""
+        if not COURSE_CACHE_GCS_URI or not STORAGE_AVAILABLE:
+            return None
+        
+        try:
+            bucket_name, blob_name = _parse_gcs_uri(COURSE_CACHE_GCS_URI)
+            blob = storage.Client(project=self.project_id).bucket(bucket_name).blob(blob_name)
+            course_mapping = json.loads(blob.download_as_text())
+            logger.info(f"講座マッピングをGCSから取得: {len(course_mapping)}件")
+            return course_mapping
+        except Exception as e:
+            logger.warning(f"GCSからの講座マッピング取得に失敗: {str(e)}")
+            return None
+    
+    def _save_course_mapping_to_gcs(self, course_mapping: Dict[str, str]):
+        """講座マッピングをGCSに保存（次回のコールドスタートで使用）"""
+        if not COURSE_CACHE_GCS_URI or not STORAGE_AVAILABLE:
+            return
+        
+        try:
+            bucket_name, blob_name = _parse_gcs_uri(COURSE_CACHE_GCS_URI)
+            blob = storage.Client(project=self.project_id).bucket(bucket_name).blob(blob_name)
+            blob.upload_from_string(json.dumps(course_mapping, ensure_ascii=False), content_type='application/json')
+            logger.info(f"講座マッピングをGCSに保存: {len(course_mapping)}件")
+        except Exception as e:
+            logger.warning(f"GCSへの講座マッピング保存に失敗: {str(e)}")
+    
+    def _load_course_mapping_from_bigquery(self) -> Dict[str, str]:
+        """
+        BigQueryから講座マッピングを取得
+        
+        Returns:
+            講座IDと名前のマッピング辞書
+        """
+        global _MODULE_COURSE_CACHE
+        
         try:
             query = f"""
             SELECT 
@@ -60,6 +158,8 @@ class CourseMapper:
             
             self._course_cache = course_mapping
             self._cache_loaded = True
+            with _module_cache_lock:
+                _MODULE_COURSE_CACHE = course_mapping
             
             logger.info(f"講座マッピング取得完了: {len(course_mapping)}件")
             return course_mapping
@@ -87,7 +187,7 @@ class CourseMapper:
     
     def get_course_info(self, course_id: str) -> Dict[str, str]:
         """
-        講座IDから詳細情報を取得
+        講座IDから詳細情報を取得（資格分野 field_type も付与する）
         
         Args:
             course_id: 講座ID
@@ -105,21 +205,26 @@ class CourseMapper:
                 total_articles,
                 total_pageviews
             FROM `{self.project_id}.{self.dataset_id}.{self.courses_table}`
-            WHERE id = '{course_id}'
+            WHERE id = @course_id
             LIMIT 1
             """
             
-            query_job = self.client.query(query)
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("course_id", "STRING", str(course_id))
+            ])
+            query_job = self.client.query(query, job_config=job_config)
             results = query_job.result()
             
             for row in results:
+                course_name = row.name or f"講座{row.id}"
                 return {
                     'id': str(row.id),
-                    'name': row.name or f"講座{row.id}",
+                    'name': course_name,
                     'slug': row.slug or '',
                     'description': row.description or '',
                     'total_articles': row.total_articles or 0,
-                    'total_pageviews': row.total_pageviews or 0
+                    'total_pageviews': row.total_pageviews or 0,
+                    'field_type': identify_course_field_type(course_name, row.slug or '')
                 }
             
             # 見つからない場合
@@ -129,7 +234,8 @@ class CourseMapper:
                 'slug': '',
                 'description': '',
                 'total_articles': 0,
-                'total_pageviews': 0
+                'total_pageviews': 0,
+                'field_type': identify_course_field_type(f"講座{course_id}", '')
             }
             
         except Exception as e:
@@ -140,9 +246,75 @@ class CourseMapper:
                 'slug': '',
                 'description': '',
                 'total_articles': 0,
-                'total_pageviews': 0
+                'total_pageviews': 0,
+                'field_type': identify_course_field_type(f"講座{course_id}", '')
             }
     
+    def get_course_infos(self, course_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        """
+        複数の講座IDの詳細情報を1回のクエリで取得
+        
+        Args:
+            course_ids: 講座IDのリスト
+            
+        Returns:
+            講座IDと講座情報辞書の辞書（見つからない講座は既定値、エラー時は空の辞書）
+        """
+        course_ids = [str(course_id) for course_id in course_ids]
+        if not course_ids:
+            return {}
+        
+        try:
+            query = f"""
+            SELECT 
+                id,
+                name,
+                slug,
+                description,
+                total_articles,
+                total_pageviews
+            FROM `{self.project_id}.{self.dataset_id}.{self.courses_table}`
+            WHERE id IN UNNEST(@course_ids)
+            """
+            
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter("course_ids", "STRING", course_ids)
+            ])
+            results = self.client.query(query, job_config=job_config).result()
+            
+            course_infos = {}
+            for row in results:
+                course_name = row.name or f"講座{row.id}"
+                course_infos[str(row.id)] = {
+                    'id': str(row.id),
+                    'name': course_name,
+                    'slug': row.slug or '',
+                    'description': row.description or '',
+                    'total_articles': row.total_articles or 0,
+                    'total_pageviews': row.total_pageviews or 0,
+                    'field_type': identify_course_field_type(course_name, row.slug or '')
+                }
+            
+            # 見つからない講座
+            for course_id in course_ids:
+                if course_id not in course_infos:
+                    course_infos[course_id] = {
+                        'id': course_id,
+                        'name': f"講座{course_id}",
+                        'slug': '',
+                        'description': '',
+                        'total_articles': 0,
+                        'total_pageviews': 0,
+                        'field_type': identify_course_field_type(f"講座{course_id}", '')
+                    }
+            
+            logger.info(f"講座情報一括取得完了: {len(course_ids)}件")
+            return course_infos
+            
+        except Exception as e:
+            logger.error(f"講座情報一括取得エラー: {str(e)}")
+            return {}
+    
     def _get_fallback_mapping(self) -> Dict[str, str]:
         """フォールバッ���用の基本マッピング"""
         return {
@@ -163,11 +335,14 @@ class CourseMapper:
         }
     
     def refresh_cache(self) -> bool:
-        """キャッシュを強制更新"""
+        """キャッシュをBigQueryから強制更新し、GCSの講座マッピングも更新"""
         try:
             self._cache_loaded = False
             self._course_cache = {}
-            self.load_course_mapping()
+            self._load_course_mapping_from_bigquery()
+            if not self._cache_loaded:
+                return False
+            self._save_course_mapping_to_gcs(self._course_cache)
             return True
         except Exception as e:
             logger.error(f"キャッシュ更新エラー: {str(e)}")
@@ -196,13 +371,15 @@ class CourseMapper:
             all_courses = {}
             for row in results:
                 course_id = str(row.id)
+                course_name = row.name or f"講座{course_id}"
                 all_courses[course_id] = {
                     'id': course_id,
-                    'name': row.name or f"講座{course_id}",
+                    'name': course_name,
                     'slug': row.slug or '',
                     'description': row.description or '',
                     'total_articles': row.total_articles or 0,
                     'total_pageviews': row.total_pageviews or 0,
+                    'field_type': identify_course_field_type(course_name, row.slug or ''),
                     'created_at': row.created_at.isoformat() if row.created_at else None,
                     'updated_at': row.updated_at.isoformat() if row.updated_at else None
                 }
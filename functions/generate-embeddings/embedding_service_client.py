@@ -0,0 +1,72 @@
+import logging
+import time
+from typing import List, Optional
+
+import orjson
+import requests
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+
+logger = logging.getLogger(__name__)
+
+# 1リクエストで送るテキスト数（GPU上で1バッチとして処理される）
+EMBEDDING_SERVICE_BATCH_SIZE = 64
+
+# IDトークンを使い回す秒数（有効期限は1時間）
+ID_TOKEN_LIFETIME_SECONDS = 50 * 60
+
+class EmbeddingServiceClient:
+    """
+    GPU埋め込みサービス（Cloud Run）クライアント
+
+    POST {url}/embed に {"texts": [...]} を送り、{"embeddings": [...], "model": "..."} を受け取る。
+    大量の記事をまとめて処理する場合に、Vertex AIの代わりに使用する。
+    """
+
+    def __init__(self, service_url: str, model_name: str = "embedding-service"):
+        self.service_url = service_url.rstrip('/')
+        self.model_name = model_name
+        self.session = requests.Session()
+        self._id_token = None
+        self._id_token_expiry = 0.0
+        logger.info(f"埋め込みサービス初期化完了 - URL: {self.service_url}")
+
+    def _get_id_token(self) -> str:
+        """Cloud Runの認証用IDトークンを取得（有効期限内は使い回す）"""
+        if self._id_token is None or time.time() >= self._id_token_expiry:
+            self._id_token = id_token.fetch_id_token(Request(), self.service_url)
+            self._id_token_expiry = time.time() + ID_TOKEN_LIFETIME_SECONDS
+        return self._id_token
+
+    def generate_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        複数テキストの埋め込みベクトルを生成（入力と同じ順序で返し、失敗したものはNone）
+        """
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+
+        for start in range(0, len(texts), EMBEDDING_SERVICE_BATCH_SIZE):
+            batch = texts[start:start + EMBEDDING_SERVICE_BATCH_SIZE]
+            try:
+                response = self.session.post(
+                    f"{self.service_url}/embed",
+                    data=orjson.dumps({"texts": batch}),
+                    headers={"Authorization": f"Bearer {self._get_id_token()}", "Content-Type": "application/json"},
+                    timeout=300
+                )
+                response.raise_for_status()
+                result = orjson.loads(response.content)
+
+                batch_embeddings = result.get('embeddings', [])
+                if len(batch_embeddings) != len(batch):
+                    logger.warning(f"埋め込みサービスの応答件数が一致しません: 期待値 {len(batch)}, 実際 {len(batch_embeddings)}")
+                    continue
+                if result.get('model'):
+                    self.model_name = result['model']
+
+                embeddings[start:start + len(batch)] = batch_embeddings
+                logger.info(f"埋め込みサービスでバッチ生成成功: {len(batch)}件")
+
+            except Exception as e:
+                logger.error(f"埋め込みサービスでのバッチ生成エラー: {str(e)}")
+
+        return embeddings
@@ -0,0 +1,26 @@
+from google.cloud import bigquery
+import logging
+import threading
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROJECT_ID = "seo-optimize-464208"
+
+# ウォームアップスレッドとリクエスト処理が同時に初期化しないようにする
+_init_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def _create_bq_client(project_id: str) -> bigquery.Client:
+    logger.info(f"BigQueryクライアント作成 - Project: {project_id}")
+    return bigquery.Client(project=project_id)
+
+def get_bq_client(project_id: str = DEFAULT_PROJECT_ID) -> bigquery.Client:
+    """
+    プロセス内で共有するBigQueryクライアントを取得
+    
+    認証情報の取得はクライアント作成時の1回だけで済むよう、
+    BigQueryClientとCourseMapperで同じクライアントを使う
+    """
+    with _init_lock:
+        return _create_bq_client(project_id)
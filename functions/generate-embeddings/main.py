@@ -1,20 +1,345 @@
 import functions_framework
 from google.cloud import bigquery
 from google.cloud import aiplatform
+import hashlib
 import json
 import logging
-from datetime import datetime
-from typing import List, Dict, Any
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Tuple
+import os
+import threading
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from universal_text_processor import UniversalTextProcessor  # 更新
-from vertex_ai_client import VertexAIClient
+from vertex_ai_client import VertexAIClient, EMBEDDING_DIMENSION, EMBEDDING_MODEL_NAMES
+from embedding_service_client import EmbeddingServiceClient
 from bigquery_client import BigQueryClient
+from gcp_clients import get_bq_client
+from course_mapper import CourseMapper
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# コールドスタート時、最初のリクエストを待たずにBigQueryクライアント（認証情報）を初期化
+threading.Thread(target=get_bq_client, daemon=True).start()
+
+def _prepare_article(text_processor: UniversalTextProcessor, article: Dict[str, Any]):
+    """
+    記事のテキスト前処理と処理統計の取得
+    
+    Returns:
+        (処理済みテキスト, 処理統計) のタプル（テキストが空の場合、統計は空の辞書）
+    """
+    processed_text = text_processor.process_article_content(
+        article['full_content'], 
+        article['qanda_content'],
+        article.get('title', ''),
+        str(article.get('koza_id', ''))
+    )
+    
+    if not processed_text.strip():
+        return processed_text, {}
+    
+    stats = text_processor.get_processing_stats(
+        article['full_content'],
+        article['qanda_content'],
+        processed_text,
+        str(article.get('koza_id', ''))
+    )
+    return processed_text, stats
+
+# 記事のテキスト前処理を並列実行するスレッド数
+PREPARE_MAX_WORKERS = 16
+
+# GPU埋め込みサービスのURL（未設定の場合は常にVertex AIを使用）
+EMBEDDING_SERVICE_URL = os.getenv('EMBEDDING_SERVICE_URL')
+
+# GPU埋め込みサービスのモデル名（埋め込みキャッシュのキーになるため、サービスが返すモデル名と合わせる）
+EMBEDDING_SERVICE_MODEL = os.getenv('EMBEDDING_SERVICE_MODEL', 'embedding-service')
+
+# この件数以上のバッチのみGPU埋め込みサービスに送る（少量ではVertex AIで十分）
+EMBEDDING_SERVICE_MIN_BATCH = 32
+
+# ウォームなインスタンスで呼び出しをまたいで保持する埋め込みの最大件数
+LOCAL_EMBEDDING_CACHE_MAX_SIZE = 2000
+
+# 全件再生成を1回の呼び出しで処理する時間の上限（超えたらhas_moreを返して次の呼び出しで再開する）
+STREAM_ALL_TIME_BUDGET_SECONDS = 480
+
+# インスタンス内の埋め込みキャッシュ（キー: (モデル名, テキストのハッシュ)）。キャッシュテーブルの検索も省く
+_local_embedding_cache: Dict[Tuple[str, str], List[float]] = {}
+_local_embedding_cache_lock = threading.Lock()
+
+def _get_local_embeddings(text_hashes: List[str], model_name: str) -> Dict[str, List[float]]:
+    """インスタンス内キャッシュにある埋め込みを取得"""
+    with _local_embedding_cache_lock:
+        return {
+            text_hash: _local_embedding_cache[(model_name, text_hash)]
+            for text_hash in text_hashes
+            if (model_name, text_hash) in _local_embedding_cache
+        }
+
+def _set_local_embeddings(embeddings_by_hash: Dict[str, List[float]], model_by_hash: Dict[str, str]):
+    """埋め込みをインスタンス内キャッシュに保存（上限を超えたら全件破棄）"""
+    with _local_embedding_cache_lock:
+        if len(_local_embedding_cache) + len(embeddings_by_hash) > LOCAL_EMBEDDING_CACHE_MAX_SIZE:
+            _local_embedding_cache.clear()
+        for text_hash, embedding in embeddings_by_hash.items():
+            _local_embedding_cache[(model_by_hash[text_hash], text_hash)] = embedding
+
+def _generate_embeddings(texts: List[str], vertex_client: VertexAIClient, bq_client: BigQueryClient,
+                         embedding_service: EmbeddingServiceClient = None):
+    """
+    埋め込みをまとめて生成
+    
+    同じテキストは1回だけ生成し、インスタンス内キャッシュ・埋め込みキャッシュテーブルにあるものはAPIを呼ばずに再利用する
+    
+    Returns:
+        (埋め込みのリスト, 各埋め込みの生成に使用したモデル名のリスト) のタプル
+    """
+    text_hashes = [hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest() for text in texts]
+    unique_texts = {}
+    for text_hash, text in zip(text_hashes, texts):
+        unique_texts.setdefault(text_hash, text)
+    
+    # キャッシュは生成に使うモデルで検索する（Vertex AIを優先し、GPU埋め込みサービスに送る件数が残る場合はそのモデルでも検索）
+    local_embeddings_by_hash = {}
+    embeddings_by_hash = {}
+    model_by_hash = {}
+    for model_name in (vertex_client.model_name, embedding_service.model_name if embedding_service else None):
+        missing_hashes = [text_hash for text_hash in unique_texts if text_hash not in embeddings_by_hash]
+        if model_name is None or not missing_hashes:
+            break
+        if model_name != vertex_client.model_name and len(missing_hashes) < EMBEDDING_SERVICE_MIN_BATCH:
+            break
+        local_found = _get_local_embeddings(missing_hashes, model_name)
+        local_embeddings_by_hash.update(local_found)
+        found = dict(local_found)
+        found.update(bq_client.get_cached_embeddings(
+            [text_hash for text_hash in missing_hashes if text_hash not in found], model_name
+        ))
+        embeddings_by_hash.update(found)
+        model_by_hash.update((text_hash, model_name) for text_hash in found)
+    missing_hashes = [text_hash for text_hash in unique_texts if text_hash not in embeddings_by_hash]
+    logger.info(f"埋め込み対象: {len(texts)}件 (重複除外後: {len(unique_texts)}件, キャッシュ利用: {len(unique_texts) - len(missing_hashes)}件"
+                f", うちインスタンス内: {len(local_embeddings_by_hash)}件)")
+    
+    if missing_hashes:
+        new_embeddings, new_model_names = _generate_embeddings_uncached(
+            [unique_texts[text_hash] for text_hash in missing_hashes], vertex_client, embedding_service
+        )
+        new_embeddings_by_model = {}
+        for text_hash, embedding, model_name in zip(missing_hashes, new_embeddings, new_model_names):
+            if embedding:
+                embeddings_by_hash[text_hash] = embedding
+                model_by_hash[text_hash] = model_name
+                new_embeddings_by_model.setdefault(model_name, {})[text_hash] = embedding
+        
+        created_at = datetime.now(timezone.utc).isoformat()
+        for model_name, new_embeddings_by_hash in new_embeddings_by_model.items():
+            bq_client.save_cached_embeddings(new_embeddings_by_hash, model_name, created_at)
+    
+    _set_local_embeddings(
+        {text_hash: embedding for text_hash, embedding in embeddings_by_hash.items() if text_hash not in local_embeddings_by_hash},
+        model_by_hash
+    )
+    
+    return (
+        [embeddings_by_hash.get(text_hash) for text_hash in text_hashes],
+        [model_by_hash.get(text_hash, vertex_client.model_name) for text_hash in text_hashes]
+    )
+
+def _generate_embeddings_uncached(texts: List[str], vertex_client: VertexAIClient,
+                                  embedding_service: EmbeddingServiceClient = None):
+    """
+    埋め込みをAPIで生成（大きいバッチはGPU埋め込みサービス、失敗した場合はバッチ全体をVertex AIで生成）
+    
+    GPU埋め込みサービスとVertex AIのベクトル空間は異なるため、1回の呼び出しの結果はどちらか一方のモデルで揃える
+    
+    Returns:
+        (埋め込みのリスト, 各埋め込みの生成に使用したモデル名のリスト) のタプル
+    """
+    model_names = [vertex_client.model_name] * len(texts)
+    
+    if embedding_service and len(texts) >= EMBEDDING_SERVICE_MIN_BATCH:
+        service_embeddings = embedding_service.generate_embeddings_batch(texts)
+        if all(embedding and len(embedding) == EMBEDDING_DIMENSION for embedding in service_embeddings):
+            return service_embeddings, [embedding_service.model_name] * len(texts)
+        logger.warning(f"埋め込みサービスで失敗または次元数が{EMBEDDING_DIMENSION}でない埋め込みがあるため、{len(texts)}件すべてをVertex AIで生成")
+    
+    # Vertex AIのバッチリクエストで生成
+    embeddings = vertex_client.generate_embeddings_batch(texts)
+    
+    # REST APIで失敗したものはSDKでまとめて再試行
+    retry_indexes = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if retry_indexes:
+        logger.info(f"{len(retry_indexes)}件をSDK版で再試行")
+        retry_embeddings = vertex_client.generate_embeddings_batch_with_sdk([texts[i] for i in retry_indexes])
+        for i, embedding in zip(retry_indexes, retry_embeddings):
+            embeddings[i] = embedding
+            # SDK版は成功したモデル名をvertex_clientに保存する
+            model_names[i] = vertex_client.model_name
+    
+    return embeddings, model_names
+
+def _embed_articles(articles: List[Dict[str, Any]], text_processor: UniversalTextProcessor,
+                    vertex_client: VertexAIClient, bq_client: BigQueryClient,
+                    field_stats: Dict[str, Dict[str, int]], progress_base: int, total_count: int,
+                    embedding_service: EmbeddingServiceClient = None):
+    """
+    記事の前処理・埋め込み生成・BigQueryへの保存をまとめて実行
+    
+    Args:
+        articles: 処理対象の記事
+        field_stats: 分野別統計（この関数内で更新）
+        progress_base: 進捗表示用の、このバッチより前に処理済みの件数
+        total_count: 進捗表示用の総数
+        embedding_service: GPU埋め込みサービス（指定時は大きいバッチをこちらで生成）
+        
+    Returns:
+        (処理成功数, 失敗数) のタプル
+    """
+    processed_count = 0
+    failed_count = 0
+    # 保存先ごと（False: content_embedding, True: GPU埋め込みサービス用のservice_embedding）の (記事ID, 埋め込み, モデル名)
+    pending_updates = {False: [], True: []}
+    pending_field_types = {False: [], True: []}
+    
+    # 記事ごとのテキスト前処理をスレッドプールで並列実行
+    prepared_articles = []  # (記事, 処理済みテキスト, 分野)
+    with ThreadPoolExecutor(max_workers=min(PREPARE_MAX_WORKERS, len(articles))) as executor:
+        futures = {
+            executor.submit(_prepare_article, text_processor, article): article
+            for article in articles
+        }
+        for completed, future in enumerate(as_completed(futures), start=1):
+            article = futures[future]
+            try:
+                processed_text, stats = future.result()
+                logger.info(f"記事 {completed}/{len(articles)} 前処理完了: ID={article['id']} (全体進捗: {progress_base + completed}/{total_count})")
+                
+                if not processed_text.strip():
+                    logger.warning(f"記事ID {article['id']}: 処理後のテキストが空です")
+                    failed_count += 1
+                    continue
+                
+                # 分野別統計の更新
+                field_type = stats.get('field_type', 'general')
+                if field_type not in field_stats:
+                    field_stats[field_type] = {'count': 0, 'success': 0}
+                field_stats[field_type]['count'] += 1
+                
+                logger.info(f"記事ID {article['id']}: テキスト処理完了 ({len(processed_text)}文字, 分野: {field_type})")
+                prepared_articles.append((article, processed_text, field_type))
+                
+            except Exception as e:
+                failed_count += 1
+                logger.error(f"記事ID {article['id']}: 処理中にエラー - {str(e)}")
+                continue
+    
+    # 埋め込みをバッチリクエストでまとめて生成
+    texts = [processed_text for _, processed_text, _ in prepared_articles]
+    embeddings, model_names = _generate_embeddings(texts, vertex_client, bq_client, embedding_service)
+    
+    for (article, _, field_type), embedding, model_name in zip(prepared_articles, embeddings, model_names):
+        if embedding:
+            # BigQueryへの保存はバッチ終了後にまとめて行う
+            separate_column = model_name not in EMBEDDING_MODEL_NAMES
+            pending_updates[separate_column].append((article['id'], embedding, model_name))
+            pending_field_types[separate_column].append(field_type)
+        else:
+            failed_count += 1
+            logger.error(f"記事ID {article['id']}: 埋め込み生成に失敗")
+    
+    # 生成した埋め込みを保存先ごとにMERGE 1回でまとめて保存
+    for separate_column, updates in pending_updates.items():
+        if not updates:
+            continue
+        updated_count = bq_client.bulk_update_embeddings(updates, separate_column)
+        processed_count += updated_count
+        failed_count += len(updates) - updated_count
+        if updated_count == len(updates):
+            for field_type in pending_field_types[separate_column]:
+                field_stats[field_type]['success'] += 1
+        else:
+            logger.error(f"BigQuery保存に失敗した記事があります: {len(updates) - updated_count}件")
+    
+    return processed_count, failed_count
+
+def _embed_all_articles_streaming(bq_client: BigQueryClient, vertex_client: VertexAIClient,
+                                  text_processor: UniversalTextProcessor, batch_size: int,
+                                  max_articles: int = None,
+                                  embedding_service: EmbeddingServiceClient = None,
+                                  stream_started_at: str = None) -> Dict[str, Any]:
+    """
+    Storage Read APIで全記事を読み込みながら埋め込みを再生成
+    
+    OFFSETによるページ取得を繰り返さず、読み込み済みの行をbatch_size件ずつ処理する。
+    STREAM_ALL_TIME_BUDGET_SECONDSを超えたら打ち切り、has_moreと再開位置（stream_started_at）を返す。
+    再開時はstream_started_atより前に更新された記事（＝この全件処理で未更新の記事）だけを読み込む
+    """
+    started = time.monotonic()
+    resumed = bool(stream_started_at)
+    if not resumed:
+        stream_started_at = datetime.now(timezone.utc).isoformat()
+    total_count = bq_client.get_total_articles_count(force_regenerate=True)
+    if max_articles:
+        total_count = min(total_count, max_articles)
+    logger.info(f"Storage Read APIによる全件処理開始 - 総数: {total_count}, 開始日時: {stream_started_at}, 再開: {resumed}")
+    
+    processed_count = 0
+    failed_count = 0
+    read_count = 0
+    field_stats = {}  # 分野別統計
+    batch = []
+    has_more = False
+    
+    def flush():
+        nonlocal processed_count, failed_count
+        batch_processed, batch_failed = _embed_articles(
+            batch, text_processor, vertex_client, bq_client, field_stats, read_count - len(batch), total_count,
+            embedding_service
+        )
+        processed_count += batch_processed
+        failed_count += batch_failed
+        batch.clear()
+    
+    updated_before = stream_started_at if resumed else None
+    for article in bq_client.stream_articles_for_embedding(updated_before=updated_before):
+        batch.append(article)
+        read_count += 1
+        if len(batch) >= batch_size:
+            flush()
+            if time.monotonic() - started > STREAM_ALL_TIME_BUDGET_SECONDS:
+                logger.info(f"処理時間の上限により {read_count} 件で中断（次の呼び出しで再開）")
+                has_more = True
+                break
+        if max_articles and read_count >= max_articles:
+            logger.info(f"最大処理数制限により {max_articles} 件で終了")
+            break
+    if batch:
+        flush()
+    
+    result = {
+        "status": "success",
+        "message": f"全資格対応埋め込み生成{'中断' if has_more else '完了'} (Storage Read API, {read_count}件)",
+        "processed_count": processed_count,
+        "failed_count": failed_count,
+        "batch_articles": read_count,
+        "total_count": total_count,
+        "has_more": has_more,
+        # 次の呼び出しでstream_allと一緒に渡すと、未処理の記事から再開する
+        "stream_started_at": stream_started_at if has_more else None,
+        "model_used": vertex_client.model_name,
+        "course_id": None,
+        "processor_type": "universal",
+        "field_statistics": field_stats
+    }
+    logger.info(f"全件処理完了: {result}")
+    return result
+
 @functions_framework.http
 def generate_embeddings(request):
     """
@@ -29,18 +354,35 @@ def generate_embeddings(request):
         stats_only = request_json.get('stats_only', False) if request_json else False
         course_id = request_json.get('course_id', None) if request_json else None
         offset = request_json.get('offset', 0) if request_json else 0
+        cursor = request_json.get('cursor', None) if request_json else None
         max_articles = request_json.get('max_articles', None) if request_json else None
+        stream_all = request_json.get('stream_all', False) if request_json else False
+        stream_started_at = request_json.get('stream_started_at', None) if request_json else None
+        refresh_course_cache = request_json.get('refresh_course_cache', False) if request_json else False
         
-        logger.info(f"全資格対応埋め込み生成開始 - batch_size: {batch_size}, force_regenerate: {force_regenerate}, test_mode: {test_mode}, stats_only: {stats_only}, course_id: {course_id}, offset: {offset}")
+        logger.info(f"全資格対応埋め込み生成開始 - batch_size: {batch_size}, force_regenerate: {force_regenerate}, test_mode: {test_mode}, stats_only: {stats_only}, course_id: {course_id}, offset: {offset}, stream_all: {stream_all}")
         
         # クライアント初期化
         bq_client = BigQueryClient()
         
+        # 講座マッピングの更新（Cloud Schedulerから定期実行し、GCSの講座マッピングを更新する）
+        if refresh_course_cache:
+            refreshed = CourseMapper().refresh_cache()
+            return {
+                "status": "course_cache_refreshed" if refreshed else "error",
+                "message": "講座マッピングを更新しました" if refreshed else "講座マッピングの更新に失敗しました",
+                "processor_type": "universal"
+            }, (200 if refreshed else 500)
+        
         # 統計情報のみの場合
         if stats_only:
             logger.info("統計情報取得モード")
-            general_stats = bq_client.get_articles_statistics()
-            course_stats = bq_client.get_course_statistics()
+            # 独立した2つの集計クエリを並行して実行
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                general_stats_future = executor.submit(bq_client.get_articles_statistics)
+                course_stats_future = executor.submit(bq_client.get_course_statistics)
+                general_stats = general_stats_future.result()
+                course_stats = course_stats_future.result()
             
             return {
                 "status": "stats_complete",
@@ -52,12 +394,17 @@ def generate_embeddings(request):
         
         vertex_client = VertexAIClient()
         text_processor = UniversalTextProcessor()  # 汎用プロセッサーを使用
+        embedding_service = EmbeddingServiceClient(EMBEDDING_SERVICE_URL, EMBEDDING_SERVICE_MODEL) if EMBEDDING_SERVICE_URL else None
         
         # テストモードの場合
         if test_mode:
             logger.info("テストモード: 利用可能なモデルをチェック中...")
-            available_models = vertex_client.test_model_availability()
-            stats = bq_client.get_articles_statistics()
+            # モデルの確認と統計クエリを並行して実行
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                available_models_future = executor.submit(vertex_client.test_model_availability)
+                stats_future = executor.submit(bq_client.get_articles_statistics)
+                available_models = available_models_future.result()
+                stats = stats_future.result()
             return {
                 "status": "test_complete",
                 "available_models": available_models,
@@ -66,15 +413,22 @@ def generate_embeddings(request):
                 "message": f"利用可能なモデル: {', '.join(available_models) if available_models else 'なし'}"
             }
         
+        # 全件再生成: Storage Read APIで全記事を読み込み、batch_size件ずつ処理
+        if stream_all and force_regenerate and not course_id:
+            return _embed_all_articles_streaming(
+                bq_client, vertex_client, text_processor, batch_size, max_articles, embedding_service,
+                stream_started_at
+            )
+        
         # 処理対象記事の取得
         if course_id:
-            # 講座別処理
+            # 講座別処理（course_idには講座IDのリストも指定可能）
             articles = bq_client.get_articles_by_course(course_id, batch_size, force_regenerate)
             total_count = len(articles)  # 簡易的な総数
         else:
             # 全記事処理
-            total_count = bq_client.get_total_articles_count(force_regenerate)
-            articles = bq_client.get_articles_for_embedding(batch_size, force_regenerate, offset)
+            # 総数はページ取得と同じクエリで取得する（COUNT(*) OVER ()）
+            articles, total_count = bq_client.get_articles_for_embedding(batch_size, force_regenerate, offset, cursor)
         
         if not articles:
             logger.info("処理対象の記事がありません")
@@ -89,8 +443,6 @@ def generate_embeddings(request):
         
         logger.info(f"処理対象記事数: {len(articles)} / 総数: {total_count}")
         
-        processed_count = 0
-        failed_count = 0
         field_stats = {}  # 分野別統計
         
         # 最大処理数の制限
@@ -98,74 +450,10 @@ def generate_embeddings(request):
             articles = articles[:max_articles]
             logger.info(f"最大処理数制限により {max_articles} 件に制限")
         
-        # 記事ごとに埋め込み生成
-        for i, article in enumerate(articles):
-            try:
-                logger.info(f"記事 {i+1}/{len(articles)} 処理中: ID={article['id']} (全体進捗: {offset + i + 1}/{total_count})")
-                
-                # 汎用テキスト前処理
-                processed_text = text_processor.process_article_content(
-                    article['full_content'], 
-                    article['qanda_content'],
-                    article.get('title', ''),
-                    str(article.get('koza_id', ''))
-                )
-                
-                if not processed_text.strip():
-                    logger.warning(f"記事ID {article['id']}: 処理後のテキストが空です")
-                    failed_count += 1
-                    continue
-                
-                # 処理統計の取得
-                stats = text_processor.get_processing_stats(
-                    article['full_content'],
-                    article['qanda_content'],
-                    processed_text,
-                    str(article.get('koza_id', ''))
-                )
-                
-                # 分野別統計の更新
-                field_type = stats.get('field_type', 'general')
-                if field_type not in field_stats:
-                    field_stats[field_type] = {'count': 0, 'success': 0}
-                field_stats[field_type]['count'] += 1
-                
-                logger.info(f"記事ID {article['id']}: テキスト処理完了 ({len(processed_text)}文字, 分野: {field_type})")
-                
-                # 埋め込み生成
-                embedding = vertex_client.generate_embedding(processed_text)
-                
-                # REST APIで失敗した場合はSDKで試行
-                if embedding is None:
-                    logger.info(f"記事ID {article['id']}: SDK版で再試行")
-                    embedding = vertex_client.generate_embedding_with_sdk(processed_text)
-                
-                if embedding:
-                    # BigQueryに保存
-                    success = bq_client.update_article_embedding(
-                        article['id'], 
-                        embedding, 
-                        vertex_client.model_name
-                    )
-                    
-                    if success:
-                        processed_count += 1
-                        field_stats[field_type]['success'] += 1
-                        logger.info(f"記事ID {article['id']}: 埋め込み生成・保存完了")
-                    else:
-                        failed_count += 1
-                        logger.error(f"記事ID {article['id']}: BigQuery保存に失敗")
-                else:
-                    failed_count += 1
-                    logger.error(f"記事ID {article['id']}: 埋め込み生成に失敗")
-                
-                # API制限対策のための待機
-                time.sleep(0.2)
-                
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"記事ID {article['id']}: 処理中にエラー - {str(e)}")
-                continue
+        processed_count, failed_count = _embed_articles(
+            articles, text_processor, vertex_client, bq_client, field_stats, offset, total_count,
+            embedding_service
+        )
         
         # 次のバッチがあるかチェック
         next_offset = offset + len(articles)
@@ -180,6 +468,8 @@ def generate_embeddings(request):
             "total_count": total_count,
             "current_offset": offset,
             "next_offset": next_offset if has_more else None,
+            # 次のバッチはnext_offsetの代わりにcursorを渡すと、OFFSETの読み飛ばしなしで取得できる
+            "next_cursor": bq_client.make_article_cursor(articles[-1]) if has_more and not course_id else None,
             "has_more": has_more,
             "progress_percentage": round((next_offset / total_count * 100), 2) if total_count > 0 else 100,
             "model_used": vertex_client.model_name,
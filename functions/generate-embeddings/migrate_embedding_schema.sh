@@ -0,0 +1,57 @@
+#!/bin/bash
+
+# generate-embeddingsが書き込む列・テーブルを用意する一回限りのマイグレーション
+# 関数はリクエストごとにスキーマ変更を発行しないので、デプロイ前に1回実行する
+# （IF NOT EXISTSなので再実行しても問題ない）
+
+# 設定値
+PROJECT_ID="seo-optimize-464208"
+TARGET_DATASET_ID="content_analysis"
+ARTICLES_TABLE="$PROJECT_ID.$TARGET_DATASET_ID.articles"
+EMBEDDING_CACHE_TABLE="$PROJECT_ID.$TARGET_DATASET_ID.embedding_cache"
+
+echo "🗂️ 埋め込み関連スキーマのマイグレーションを開始..."
+
+# 1. int8量子化した埋め込みの列を追加
+echo "🔧 articlesテーブルに量子化埋め込みの列を追加中: $ARTICLES_TABLE"
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "ALTER TABLE \`$ARTICLES_TABLE\`
+   ADD COLUMN IF NOT EXISTS content_embedding_i8 BYTES,
+   ADD COLUMN IF NOT EXISTS embedding_scale FLOAT64"
+
+if [ $? -ne 0 ]; then
+    echo "❌ 量子化埋め込みの列の追加に失敗"
+    exit 1
+fi
+
+# 2. generate-chunks-serviceと共有する埋め込みキャッシュテーブルを作成
+# （作成直後のテーブルへのストリーミング挿入は失敗・欠落することがあるため、実行時には作成しない）
+echo "🔧 埋め込みキャッシュテーブルを作成中: $EMBEDDING_CACHE_TABLE"
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "CREATE TABLE IF NOT EXISTS \`$EMBEDDING_CACHE_TABLE\` (
+     text_hash STRING NOT NULL,
+     embedding_model STRING NOT NULL,
+     content_embedding ARRAY<FLOAT64>,
+     created_at TIMESTAMP
+   )
+   CLUSTER BY text_hash"
+
+if [ $? -ne 0 ]; then
+    echo "❌ 埋め込みキャッシュテーブルの作成に失敗"
+    exit 1
+fi
+
+# 3. Vertex AI以外（GPU埋め込みサービス）で生成した埋め込みの列を追加
+# （ベクトル空間が異なるため、検索がモデルを区別するまではcontent_embeddingと分けて保存する）
+echo "🔧 articlesテーブルにGPU埋め込みサービスの埋め込みの列を追加中: $ARTICLES_TABLE"
+bq query --use_legacy_sql=false --project_id=$PROJECT_ID \
+  "ALTER TABLE \`$ARTICLES_TABLE\`
+   ADD COLUMN IF NOT EXISTS service_embedding ARRAY<FLOAT64>,
+   ADD COLUMN IF NOT EXISTS service_embedding_model STRING"
+
+if [ $? -ne 0 ]; then
+    echo "❌ GPU埋め込みサービスの埋め込みの列の追加に失敗"
+    exit 1
+fi
+
+echo "✅ マイグレーション完了"
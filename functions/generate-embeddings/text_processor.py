@@ -1,16 +1,97 @@
 import re
+import heapq
 import html
 from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import logging
 from typing import Dict, List, Tuple, Optional
 import unicodedata
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from course_mapper import CourseMapper
 
 logger = logging.getLogger(__name__)
 
+# 講座情報・講座名のキャッシュの有効期間（秒）と最大件数
+COURSE_CACHE_TTL_SECONDS = 300
+COURSE_CACHE_MAX_SIZE = 1024
+
+# 複数記事をまとめて処理する際の並列数
+BATCH_MAX_WORKERS = 8
+
+# 本文HTMLがmax_lengthのこの倍数を超える場合、解析前に切り詰める
+PRE_TRUNCATE_RATIO = 4
+
+# 最終正規化で削除する装飾文字
+DECORATIVE_CHARS = '◆◇■□●○▲△▼▽★☆※'
+
+# HTML除去時に中身ごと削除するタグ
+SKIP_TAGS = ('script', 'style', 'meta', 'link', 'nav', 'footer')
+_SKIP_TAGS_SELECTOR = ', '.join(SKIP_TAGS)
+
+# 講座別特化キーワード（講座ID → キーワード）
+COURSE_SPECIFIC_KEYWORDS = {
+    "1": ("行政書士法", "許認可", "官公署", "代理", "代行"),  # 行政書士
+    "2": ("労働基準法", "社会保険", "労災", "雇用保険", "年金"),  # 社労士
+    "3": ("ライフプランニング", "リスク管理", "金融資産", "タックスプランニング", "不動産", "相続"),  # FP
+    "4": ("宅建業法", "都市計画法", "建築基準法", "重要事項説明", "媒介契約"),  # 宅建
+    "5": ("マンション管理適正化法", "区分所有法", "管理組合", "修繕積立金"),  # マンション管理士
+    "6": ("仕訳", "貸借対照表", "損益計算書", "減価償却", "棚卸資産"),  # 簿記
+    "26": ("ITパスポート", "情報セキュリティ", "システム開発", "データベース"),  # IT
+    "27": ("関税法", "通関業法", "輸出入", "税関"),  # 通関士
+    "45": ("司法書士法", "不動産登記", "商業登記", "供託"),  # 司法書士
+    "46": ("アルゴリズム", "データ構造", "プログラミング", "システム設計"),  # 基本情報技術者
+    "47": ("金融商品取引法", "証券", "投資信託", "デリバティブ")  # 証券外務員
+}
+
+# 基本的な法律用語（埋め込み時に重要度を高めるため強調する）
+IMPORTANT_TERMS = (
+    '宅建業法', '宅地建物取引士', '重要事項説明', '営業保証金', '供託所',
+    '宅建業者', '媒介契約', '売買契約', '賃貸借契約', '重要事項',
+    '契約書面', '37条書面', '35条書面', '免許', '登録', '更新',
+    '監督処分', '指示処分', '業務停止', '免許取消', '罰則',
+    '行政書士', '社会保険労務士', 'ファイナンシャルプランナー', '簿記',
+    'マンション管理士', '管理業務主任者', '司法書士', '通関士'
+)
+
+# 全角英数記号・半角カナ・丸数字等（U+2000〜U+33FF, U+FF00〜U+FFEF）の文字単位のNFKC変換表
+_NFKC_FAST_TABLE = {}
+for _codepoint in (*range(0x2000, 0x3400), *range(0xFF00, 0xFFF0)):
+    _normalized = unicodedata.normalize('NFKC', chr(_codepoint))
+    if _normalized != chr(_codepoint):
+        _NFKC_FAST_TABLE[_codepoint] = _normalized
+del _codepoint, _normalized
+
+def _normalize_nfkc(text: str) -> str:
+    """
+    NFKC正規化（unicodedata.normalize('NFKC', text)と同じ結果を返す）
+    
+    正規化済みならそのまま返し、そうでなければ変換表で文字単位に置換する。
+    濁点の結合等、文字単位の置換で正規形にならない場合のみunicodedata.normalizeを使う
+    """
+    if unicodedata.is_normalized('NFKC', text):
+        return text
+    text = text.translate(_NFKC_FAST_TABLE)
+    if unicodedata.is_normalized('NFKC', text):
+        return text
+    return unicodedata.normalize('NFKC', text)
+
 class TextProcessor:
     """宅建・資格試験記事に最適化されたテキスト前処理クラス"""
     
+    # 属性は初期化時に固定されるため、インスタンス辞書を持たせない
+    __slots__ = (
+        'max_length', 'min_length', 'course_mapper',
+        '_course_cache', '_course_cache_lock',
+        'legal_patterns', 'course_specific_keywords', 'removal_patterns', '_decorative_deletes',
+        '_re_heading', '_re_article_ref', '_re_important_terms', '_re_q_marker', '_re_a_marker',
+        '_re_bullet', '_re_numlist', '_re_point', '_re_excessive_symbols', '_re_url', '_re_email',
+        '_re_important', '_important_first_chars', '_re_priority_keywords',
+        '_re_course', '_course_first_chars',
+        '_re_multi_nl', '_re_ws', '_re_any_ws', '_re_qa_number', '_re_tag',
+    )
+    
     def __init__(self, project_id: str = "seo-optimize-464208"):
         self.max_length = 8000  # Vertex AI Text Embeddings APIの制限
         self.min_length = 50    # 最小テキスト長
@@ -18,35 +99,27 @@ class TextProcessor:
         # 講座マッパーの初期化
         self.course_mapper = CourseMapper(project_id)
         
+        # 講座情報・講座名のTTLキャッシュ（キー: (種別, 講座ID) → (取得時刻, 値)）
+        self._course_cache: Dict[Tuple[str, str], Tuple[float, object]] = {}
+        self._course_cache_lock = threading.Lock()
+        
         # 法律・資格試験特有のパターン
         self.legal_patterns = {
             # 条文参照パターン
-            'article_ref': r'([^\s]+法[第]?\d+条[の]?\d*(?:第\d+項)?)',
+            # 空白を含まない語の途中から照合し直すと語長の2乗の時間がかかるため、語の先頭からのみ照合する
+            'article_ref': r'(?<!\S)([^\s]+法[第]?\d+条[の]?\d*(?:第\d+項)?)',
             # 重要キーワード
             'important_terms': r'(宅建業法|宅地建物取引士|重要事項説明|営業保証金|供託所|行政書士|社会保険労務士|ファイナンシャルプランナー|簿記|マンション管理士)',
-            # 質問回答パターン
-            'qa_pattern': r'Q[:：]\s*([^\n]+(?:\n(?!A[:：])[^\n]*)*)\s*A[:：]\s*([^\n]+(?:\n(?!Q[:：])[^\n]*)*)',
         }
         
-        # 講座別特化キーワード
-        self.course_specific_keywords = {
-            "1": ["行政書士法", "許認可", "官公署", "代理", "代行"],  # 行政書士
-            "2": ["労働基準法", "社会保険", "労災", "雇用保険", "年金"],  # 社労士
-            "3": ["ライフプランニング", "リスク管理", "金融資産", "タックスプランニング", "不動産", "相続"],  # FP
-            "4": ["宅建業法", "都市計画法", "建築基準法", "重要事項説明", "媒介契約"],  # 宅建
-            "5": ["マンション管理適正化法", "区分所有法", "管理組合", "修繕積立金"],  # マンション管理士
-            "6": ["仕訳", "貸借対照表", "損益計算書", "減価償却", "棚卸資産"],  # 簿記
-            "26": ["ITパスポート", "情報セキュリティ", "システム開発", "データベース"],  # IT
-            "27": ["関税法", "通関業法", "輸出入", "税関"],  # 通関士
-            "45": ["司法書士法", "不動産登記", "商業登記", "供託"],  # 司法書士
-            "46": ["アルゴリズム", "データ構造", "プログラミング", "システム設計"],  # 基本情報技術者
-            "47": ["金融商品取引法", "証券", "投資信託", "デリバティブ"]  # 証券外務員
-        }
+        # 講座別特化キーワード（モジュール定数を参照）
+        self.course_specific_keywords = COURSE_SPECIFIC_KEYWORDS
         
         # 除去対象パターン
+        # 不要な装飾文字（固定の文字集合なので正規表現を使わずstr.translateで削除する）
+        self._decorative_deletes = str.maketrans('', '', DECORATIVE_CHARS)
+        
         self.removal_patterns = {
-            # 不要な装飾文字
-            'decorative': r'[◆◇■□●○▲△▼▽★☆※]',
             # 過度な記号
             'excessive_symbols': r'[！？]{2,}|[。、]{2,}',
             # URL
@@ -55,8 +128,125 @@ class TextProcessor:
             'emails': r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}',
         }
         
+        # 正規表現は初期化時に1回だけコンパイルする
+        self._re_heading = re.compile(r'(?:^|\n)([^\n]{1,50}とは[？?]?)\s*(?:\n|$)', re.MULTILINE)
+        self._re_article_ref = re.compile(self.legal_patterns['article_ref'])
+        self._re_important_terms = re.compile(self.legal_patterns['important_terms'])
+        # Q&Aの行頭マーカー（Q&Aは行単位の走査で抽出し、バックトラックの大きい正規表現は使わない）
+        self._re_q_marker = re.compile(r'\s*Q[:：]\s*')
+        self._re_a_marker = re.compile(r'\s*A[:：]\s*')
+        self._re_bullet = re.compile(r'(?:^|\n)・([^\n]+)', re.MULTILINE)
+        self._re_numlist = re.compile(r'(?:^|\n)(\d+)\.([^\n]+)', re.MULTILINE)
+        self._re_point = re.compile(r'(?:^|\n)(ポイント|重要|注意)[：:]([^\n]+)', re.MULTILINE)
+        # 除去パターンは装飾文字の削除後に定義順で1つずつ適用する
+        # （前の除去で隣り合った文字が次のパターンに一致する場合があるため、1つの選択パターンにはまとめない）
+        self._re_excessive_symbols = re.compile(self.removal_patterns['excessive_symbols'])
+        self._re_url = re.compile(self.removal_patterns['urls'])
+        self._re_email = re.compile(self.removal_patterns['emails'])
+        
+        # 強調する用語は長い順の選択パターンにまとめ、1回の走査で置換する
+        self._re_important = self._compile_term_alternation(IMPORTANT_TERMS)
+        # 用語の先頭文字の集合（どれも含まれないテキストは正規表現を実行せずに返す）
+        self._important_first_chars = frozenset(term[0] for term in IMPORTANT_TERMS)
+        
+        # セクションの重要度計算に使うキーワード（1回の走査で全キーワードの出現数を数える）
+        self._re_priority_keywords = re.compile('|'.join(map(re.escape, [
+            '宅建業法', '重要事項説明', '契約', '免許', '登録', '行政書士', '社労士', 'FP'
+        ])))
+        self._re_course = {
+            course_id: self._compile_term_alternation(keywords)
+            for course_id, keywords in self.course_specific_keywords.items()
+        }
+        self._course_first_chars = {
+            course_id: frozenset(keyword[0] for keyword in keywords)
+            for course_id, keywords in self.course_specific_keywords.items()
+        }
+        self._re_multi_nl = re.compile(r'\n\s*\n\s*\n+')
+        self._re_ws = re.compile(r'[ \t]+')
+        self._re_any_ws = re.compile(r'\s+')
+        self._re_qa_number = re.compile(r'Q\d+:')
+        self._re_tag = re.compile(r'<[^>]+>')
+        
         logger.info("TextProcessor初期化完了")
     
+    @staticmethod
+    def _compile_term_alternation(terms: List[str]) -> re.Pattern:
+        """用語リストを長い順の選択パターンにコンパイル（重なる用語は長い方を優先）"""
+        return re.compile('|'.join(map(re.escape, sorted(terms, key=len, reverse=True))))
+    
+    def _get_course_cached(self, kind: str, course_id: str, loader):
+        """講座情報をTTLキャッシュ経由で取得（期限切れ・未取得の場合のみloaderを呼ぶ）"""
+        key = (kind, course_id)
+        now = time.monotonic()
+        with self._course_cache_lock:
+            entry = self._course_cache.get(key)
+            if entry and now - entry[0] < COURSE_CACHE_TTL_SECONDS:
+                return entry[1]
+        
+        value = loader(course_id)
+        with self._course_cache_lock:
+            if len(self._course_cache) >= COURSE_CACHE_MAX_SIZE:
+                self._course_cache.clear()
+            self._course_cache[key] = (now, value)
+        return value
+    
+    def _cached_course_info(self, koza_id: str) -> Dict:
+        """講座IDから講座情報を取得（TTLキャッシュ付き）"""
+        return self._get_course_cached('info', koza_id, self.course_mapper.get_course_info)
+    
+    def _cached_course_name(self, course_id: str) -> str:
+        """講座IDから講座名を取得（TTLキャッシュ付き）"""
+        return self._get_course_cached('name', course_id, self.course_mapper.get_course_name)
+    
+    def _prefetch_course_infos(self, course_ids: set):
+        """キャッシュにない講座情報を1回のクエリでまとめて取得し、キャッシュに格納"""
+        now = time.monotonic()
+        with self._course_cache_lock:
+            missing_ids = [
+                course_id for course_id in course_ids
+                if not (('info', course_id) in self._course_cache
+                        and now - self._course_cache[('info', course_id)][0] < COURSE_CACHE_TTL_SECONDS)
+            ]
+        if not missing_ids:
+            return
+        
+        # 取得できなかった講座は記事ごとの処理で個別に取得される
+        course_infos = self.course_mapper.get_course_infos(missing_ids)
+        with self._course_cache_lock:
+            if len(self._course_cache) + len(course_infos) > COURSE_CACHE_MAX_SIZE:
+                self._course_cache.clear()
+            for course_id, course_info in course_infos.items():
+                self._course_cache[('info', course_id)] = (now, course_info)
+    
+    def process_article_content_batch(self, rows: List[Dict]) -> List[str]:
+        """
+        複数記事のコンテンツをまとめて前処理
+        
+        講座情報は1回のクエリで先読みし、記事ごとの処理はスレッドプールで並列実行する
+        
+        Args:
+            rows: full_content, qanda_content, title, koza_id を持つ記事の辞書のリスト
+            
+        Returns:
+            入力と同じ順序の処理済みテキストのリスト
+        """
+        if not rows:
+            return []
+        
+        self._prefetch_course_infos({str(row['koza_id']) for row in rows if row.get('koza_id')})
+        
+        with ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(rows))) as executor:
+            return list(executor.map(self._process_one, rows))
+    
+    def _process_one(self, row: Dict) -> str:
+        """記事の辞書1件を前処理（講座情報は先読み済みのキャッシュから取得）"""
+        return self.process_article_content(
+            row.get('full_content'),
+            row.get('qanda_content'),
+            row.get('title', ''),
+            row.get('koza_id', '')
+        )
+    
     def process_article_content(self, full_content: str, qanda_content: str, 
                               title: str = "", koza_id: str = "") -> str:
         """
@@ -78,20 +268,21 @@ class TextProcessor:
             title = title or ""
             
             # 1. HTMLタグの除去と基本クリーニング
-            full_text = self._clean_html_and_basic(full_content)
-            qanda_text = self._clean_html_and_basic(qanda_content)
-            title_text = self._clean_html_and_basic(title)
+            full_html = self._pre_truncate_html(full_content, self.max_length * PRE_TRUNCATE_RATIO)
+            full_text, qanda_text, title_text = self._clean_html_batch([full_html, qanda_content, title])
             
             # 2. 講座情報の取得
-            course_info = self.course_mapper.get_course_info(str(koza_id)) if koza_id else {}
+            course_info = self._cached_course_info(str(koza_id)) if koza_id else {}
             
             # 3. 講座別特化処理
-            structured_full = self._structure_course_specific_content(full_text, str(koza_id))
+            course_id = str(koza_id)
+            structured_full = self._structure_course_specific_content(full_text, course_id)
             structured_qanda = self._structure_qanda_content(qanda_text)
             
-            # 4. 重要情報の抽出と強調（講座別）
-            enhanced_full = self._enhance_course_specific_terms(structured_full, str(koza_id))
-            enhanced_qanda = self._enhance_course_specific_terms(structured_qanda, str(koza_id))
+            # 4. 重要情報の抽出と強調（講座別、講座名は本文・Q&Aで共通なので1回だけ引く）
+            course_name = self._emphasis_course_name(course_id) if structured_full or structured_qanda else ""
+            enhanced_full = self._enhance_course_specific_terms(structured_full, course_name)
+            enhanced_qanda = self._enhance_course_specific_terms(structured_qanda, course_name)
             
             # 5. テキストの結合（講座情報含む）
             combined_text = self._combine_content_with_course_info(
@@ -122,15 +313,20 @@ class TextProcessor:
         text = self._structure_legal_content(text)
         
         # 講座別キーワードの強調
-        if course_id in self.course_specific_keywords:
-            keywords = self.course_specific_keywords[course_id]
-            for keyword in keywords:
-                if keyword in text:
-                    text = text.replace(keyword, f'【{keyword}】')
+        course_pattern = self._re_course.get(course_id)
+        if course_pattern and any(char in text for char in self._course_first_chars[course_id]):
+            text = course_pattern.sub(lambda m: f'【{m.group(0)}】', text)
         
         return text
     
-    def _enhance_course_specific_terms(self, text: str, course_id: str) -> str:
+    def _emphasis_course_name(self, course_id: str) -> str:
+        """強調対象とする講座名を取得（講座マスタに無い仮の講座名は空文字）"""
+        course_name = self._cached_course_name(course_id)
+        if course_name and course_name != f"講座{course_id}":
+            return course_name
+        return ""
+    
+    def _enhance_course_specific_terms(self, text: str, course_name: str) -> str:
         """講座別重要用語の強調"""
         if not text:
             return ""
@@ -139,8 +335,7 @@ class TextProcessor:
         text = self._enhance_important_terms(text)
         
         # 講座別の追加強調
-        course_name = self.course_mapper.get_course_name(course_id)
-        if course_name and course_name != f"講座{course_id}":
+        if course_name:
             # 講座名自体も重要用語として強調
             text = text.replace(course_name, f'【{course_name}】')
         
@@ -174,33 +369,70 @@ class TextProcessor:
         
         return '\n\n'.join(parts)
     
+    def _pre_truncate_html(self, text: str, cap: int) -> str:
+        """極端に長いHTMLを解析前に切り詰める（cap以内で最後の</p>・</div>の直後で切る）"""
+        if len(text) <= cap:
+            return text
+        
+        cut = max(
+            text.rfind('</p>', 0, cap) + len('</p>'),
+            text.rfind('</div>', 0, cap) + len('</div>'),
+        )
+        # 閉じタグが見つからない場合（rfindが-1）はcapの位置で切る
+        if cut < len('</div>'):
+            cut = cap
+        
+        logger.info(f"本文HTMLを解析前に切り詰め: {len(text)} -> {cut}文字")
+        return text[:cut]
+    
+    def _clean_html_batch(self, texts: List[str]) -> List[str]:
+        """複数テキストのHTMLタグ除去と基本クリーニング（入力と同じ順序で返す）"""
+        return [self._clean_html_and_basic(text) for text in texts]
+    
     def _clean_html_and_basic(self, text: str) -> str:
         """HTMLタグ除去と基本クリーニング"""
         if not text:
             return ""
         
+        # タグを含まないテキスト（タイトル・プレーンテキストのQ&A等）はパーサーを通さない
+        # BeautifulSoupと同じ結果になるよう、エンティティは2回デコードし改行コードを揃える
+        if '<' not in text:
+            text = html.unescape(html.unescape(text)).replace('\r\n', '\n')
+            return _normalize_nfkc(text)
+        
+        clean_text = self._extract_html_text(text)
+        if clean_text is None:
+            # どちらのパーサーでも解析できない場合はタグのみ正規表現で除去
+            clean_text = self._re_tag.sub('', text)
+        
+        # HTMLエンティティのデコードとUnicode正規化
+        return _normalize_nfkc(html.unescape(clean_text))
+    
+    def _extract_html_text(self, text: str) -> Optional[str]:
+        """不要タグを除いたHTMLのテキストを抽出（解析に失敗した場合はNone）"""
+        # selectolax（C実装のパーサー）でHTMLタグを除去
+        try:
+            tree = LexborHTMLParser(text)
+        except Exception as e:
+            logger.warning(f"selectolaxでのHTML解析エラー、BeautifulSoupで再試行: {str(e)}")
+        else:
+            for node in tree.css(_SKIP_TAGS_SELECTOR):
+                node.decompose()
+            return tree.root.text() if tree.root is not None else ""
+        
+        # BeautifulSoupでHTMLタグを除去
         try:
-            # BeautifulSoupでHTMLタグを除去
             soup = BeautifulSoup(text, 'html.parser')
-            
-            # 不要なタグを完全に削除
-            for tag in soup(['script', 'style', 'meta', 'link', 'nav', 'footer']):
-                tag.decompose()
-            
-            # テキストのみを抽出
-            clean_text = soup.get_text()
-            
-            # HTMLエンティティのデコード
-            clean_text = html.unescape(clean_text)
-            
-            # Unicode正規化
-            clean_text = unicodedata.normalize('NFKC', clean_text)
-            
-            return clean_text
-            
         except Exception as e:
             logger.warning(f"HTML除去エラー: {str(e)}")
-            return text
+            return None
+        
+        # 不要なタグを完全に削除
+        for tag in soup(SKIP_TAGS):
+            tag.decompose()
+        
+        # テキストのみを抽出
+        return soup.get_text()
     
     def _structure_legal_content(self, text: str) -> str:
         """法律・資格試験コンテンツの構造化"""
@@ -208,17 +440,17 @@ class TextProcessor:
             return ""
         
         # 見出し構造の正規化
-        text = re.sub(r'(?:^|\n)([^\n]{1,50}とは[？?]?)\s*(?:\n|$)', r'\n【\1】\n', text, flags=re.MULTILINE)
+        text = self._re_heading.sub(r'\n【\1】\n', text)
         
         # 条文参照の正規化
-        text = re.sub(self.legal_patterns['article_ref'], r'《\1》', text)
+        text = self._re_article_ref.sub(r'《\1》', text)
         
         # リスト項目の正規化
-        text = re.sub(r'(?:^|\n)・([^\n]+)', r'\n- \1', text, flags=re.MULTILINE)
-        text = re.sub(r'(?:^|\n)(\d+)\.([^\n]+)', r'\n\1. \2', text, flags=re.MULTILINE)
+        text = self._re_bullet.sub(r'\n- \1', text)
+        text = self._re_numlist.sub(r'\n\1. \2', text)
         
         # 重要ポイントの強調
-        text = re.sub(r'(?:^|\n)(ポイント|重要|注意)[：:]([^\n]+)', r'\n★\1: \2', text, flags=re.MULTILINE)
+        text = self._re_point.sub(r'\n★\1: \2', text)
         
         return text
     
@@ -228,14 +460,14 @@ class TextProcessor:
             return ""
         
         # Q&Aペアの抽出と構造化
-        qa_matches = re.findall(self.legal_patterns['qa_pattern'], text, re.MULTILINE | re.DOTALL)
+        qa_matches = self._extract_qa_pairs(text)
         
         if qa_matches:
             structured_qa = []
             for i, (question, answer) in enumerate(qa_matches, 1):
                 # 質問と回答のクリーニング
-                clean_q = re.sub(r'\s+', ' ', question.strip())
-                clean_a = re.sub(r'\s+', ' ', answer.strip())
+                clean_q = self._re_any_ws.sub(' ', question.strip())
+                clean_a = self._re_any_ws.sub(' ', answer.strip())
                 
                 structured_qa.append(f"Q{i}: {clean_q}")
                 structured_qa.append(f"A{i}: {clean_a}")
@@ -245,27 +477,64 @@ class TextProcessor:
         # Q&Aパターンが見つからない場合は元のテキストを返す
         return text
     
+    def _extract_qa_pairs(self, text: str) -> List[Tuple[str, str]]:
+        """
+        行頭のQ:/A:マーカーでQ&Aペアを抽出（1回の行走査で完結し、入力長に対して線形時間）
+        
+        回答が始まるまでの行は質問、次の質問が始まるまでの行は回答として扱う
+        """
+        pairs = []
+        question_lines: List[str] = []
+        answer_lines: List[str] = []
+        mode = None  # None: Q&A外, 'q': 質問中, 'a': 回答中
+        
+        def flush_pair():
+            question = '\n'.join(question_lines).strip()
+            answer = '\n'.join(answer_lines).strip()
+            if question and answer:
+                pairs.append((question, answer))
+        
+        # 行ごとに呼ぶメソッドはローカル変数に束縛しておく
+        match_question = self._re_q_marker.match
+        match_answer = self._re_a_marker.match
+        
+        for line in text.split('\n'):
+            q_match = match_question(line)
+            if q_match and mode != 'q':
+                if mode == 'a':
+                    flush_pair()
+                mode = 'q'
+                question_lines = [line[q_match.end():]]
+                answer_lines = []
+                continue
+            
+            a_match = match_answer(line)
+            if a_match and mode == 'q':
+                mode = 'a'
+                answer_lines = [line[a_match.end():]]
+                continue
+            
+            if mode == 'q':
+                question_lines.append(line)
+            elif mode == 'a':
+                answer_lines.append(line)
+        
+        if mode == 'a':
+            flush_pair()
+        
+        return pairs
+    
     def _enhance_important_terms(self, text: str) -> str:
         """重要用語の強調"""
         if not text:
             return ""
         
-        # 基本的な法律用語の強調
-        important_terms = [
-            '宅建業法', '宅地建物取引士', '重要事項説明', '営業保証金', '供託所',
-            '宅建業者', '媒介契約', '売買契約', '賃貸借契約', '重要事項',
-            '契約書面', '37条書面', '35条書面', '免許', '登録', '更新',
-            '監督処分', '指示処分', '業務停止', '免許取消', '罰則',
-            '行政書士', '社会保険労務士', 'ファイナンシャルプランナー', '簿記',
-            'マンション管理士', '管理業務主任者', '司法書士', '通関士'
-        ]
-        
-        for term in important_terms:
-            if term in text:
-                # 重要用語を強調マークで囲む（埋め込み時に重要度を高める）
-                text = text.replace(term, f'【{term}】')
+        # 用語の先頭文字が1つも無ければ置換対象は存在しない
+        if not any(char in text for char in self._important_first_chars):
+            return text
         
-        return text
+        # 重要用語を強調マークで囲む（埋め込み時に重要度を高める）
+        return self._re_important.sub(lambda m: f'【{m.group(0)}】', text)
     
     def _final_normalization(self, text: str) -> str:
         """最終正規化処理"""
@@ -273,13 +542,18 @@ class TextProcessor:
             return ""
         
         # 不要パターンの除去
-        for pattern_name, pattern in self.removal_patterns.items():
-            text = re.sub(pattern, '', text)
-        
-        # 連続する空白・改行の正規化
-        text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)  # 3つ以上の改行を2つに
-        text = re.sub(r'[ \t]+', ' ', text)  # 連続するスペース・タブを1つに
-        text = re.sub(r'\n ', '\n', text)  # 行頭のスペースを除去
+        text = text.translate(self._decorative_deletes)
+        text = self._re_excessive_symbols.sub('', text)
+        text = self._re_url.sub('', text)
+        if '@' in text:
+            text = self._re_email.sub('', text)
+        
+        # 連続する空白・改行の正規化（置換対象が無い場合は走査を省く）
+        text = self._re_multi_nl.sub('\n\n', text)  # 3つ以上の改行を2つに
+        if '\t' in text or '  ' in text:
+            text = self._re_ws.sub(' ', text)  # 連続するスペース・タブを1つに
+        if '\n ' in text:
+            text = text.replace('\n ', '\n')  # 行頭のスペースを除去
         
         # 文字数制限の適用
         if len(text) > self.max_length:
@@ -295,28 +569,30 @@ class TextProcessor:
         # セクション別に分割
         sections = text.split('\n\n')
         
-        # 重要度順にソート
-        priority_sections = []
-        for section in sections:
-            priority = self._calculate_section_priority(section)
-            priority_sections.append((priority, section))
-        
-        priority_sections.sort(key=lambda x: x[0], reverse=True)
-        
-        # 重要度の高いセクションから順に追加
-        result = ""
-        for priority, section in priority_sections:
-            if len(result + section + '\n\n') <= self.max_length:
-                result += section + '\n\n'
+        # 重要度の高い順（同じ重要度なら元の順序）に取り出すヒープ
+        # 上限に達した時点で打ち切るため、全体のソートは行わない
+        priority_heap = [
+            (-self._calculate_section_priority(section), index, section)
+            for index, section in enumerate(sections)
+        ]
+        heapq.heapify(priority_heap)
+        
+        # 重要度の高いセクションから順に追加（文字数は加算で管理し、結合は最後に1回）
+        kept_sections = []
+        current_length = 0
+        while priority_heap:
+            _, _, section = heapq.heappop(priority_heap)
+            if current_length + len(section) + 2 <= self.max_length:
+                kept_sections.append(section + '\n\n')
+                current_length += len(section) + 2
             else:
                 # 残り文字数で可能な限り追加
-                remaining = self.max_length - len(result)
+                remaining = self.max_length - current_length
                 if remaining > 100:  # 最低100文字は確保
-                    truncated_section = section[:remaining-10] + "..."
-                    result += truncated_section
+                    kept_sections.append(section[:remaining-10] + "...")
                 break
         
-        return result.strip()
+        return ''.join(kept_sections).strip()
     
     def _calculate_section_priority(self, section: str) -> int:
         """セクションの重要度を計算"""
@@ -330,13 +606,11 @@ class TextProcessor:
         if section.startswith('講座:') or section.startswith('分野:'):
             priority += 90
         
-        # 重要キーワードの含有数
-        important_keywords = ['宅建業法', '重要事項説明', '契約', '免許', '登録', '行政書士', '社労士', 'FP']
-        for keyword in important_keywords:
-            priority += section.count(keyword) * 10
+        # 重要キーワードの含有数（キーワード同士は重ならないため、各キーワードの出現数の合計と一致する）
+        priority += len(self._re_priority_keywords.findall(section)) * 10
         
         # 条文参照の含有数
-        article_refs = re.findall(self.legal_patterns['article_ref'], section)
+        article_refs = self._re_article_ref.findall(section)
         priority += len(article_refs) * 5
         
         # Q&Aセクション
@@ -364,10 +638,10 @@ class TextProcessor:
             combined = '\n\n'.join(parts)
             
             # HTMLタグの簡易除去
-            combined = re.sub(r'<[^>]+>', '', combined)
+            combined = self._re_tag.sub('', combined)
             
             # 基本的な正規化
-            combined = re.sub(r'\s+', ' ', combined)
+            combined = self._re_any_ws.sub(' ', combined)
             
             # 長さ制限
             if len(combined) > self.max_length:
@@ -381,16 +655,16 @@ class TextProcessor:
     
     def get_processing_stats(self, original_full: str, original_qanda: str, processed: str, course_id: str = "") -> Dict:
         """処理統計情報の取得"""
-        course_name = self.course_mapper.get_course_name(course_id) if course_id else "Unknown"
+        course_name = self._cached_course_name(course_id) if course_id else "Unknown"
         
         return {
             'original_full_length': len(original_full or ''),
             'original_qanda_length': len(original_qanda or ''),
             'processed_length': len(processed),
             'compression_ratio': len(processed) / (len(original_full or '') + len(original_qanda or '') + 1),
-            'has_legal_terms': bool(re.search(self.legal_patterns['important_terms'], processed)),
-            'has_article_refs': bool(re.search(self.legal_patterns['article_ref'], processed)),
-            'qa_count': len(re.findall(r'Q\d+:', processed)),
+            'has_legal_terms': bool(self._re_important_terms.search(processed)),
+            'has_article_refs': bool(self._re_article_ref.search(processed)),
+            'qa_count': len(self._re_qa_number.findall(processed)),
             'course_id': course_id,
             'course_name': course_name
         }
@@ -1,14 +1,53 @@
 import re
+import heapq
 import html
 from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import logging
 from typing import Dict, List, Tuple, Optional
 import unicodedata
-from course_mapper import CourseMapper
+import threading
+import time
+from course_mapper import CourseMapper, identify_course_field_type
 import json
 
 logger = logging.getLogger(__name__)
 
+# 講座情報のキャッシュの有効期間（秒）と最大件数
+COURSE_CACHE_TTL_SECONDS = 300
+COURSE_CACHE_MAX_SIZE = 1024
+
+# HTML除去時に中身ごと削除するタグ
+SKIP_TAGS = ('script', 'style', 'meta', 'link', 'nav', 'footer')
+_SKIP_TAGS_SELECTOR = ', '.join(SKIP_TAGS)
+
+# タグを含まないテキストをパーサーを通さずに処理するエンティティ数の上限
+# （html.unescapeはエンティティごとにPython側で置換するため、多い場合はパーサーの方が速い）
+ENTITY_ONLY_FAST_PATH_MAX_ENTITIES = 16
+
+# 最終正規化で削除する装飾文字
+DECORATIVE_CHARS = '◆◇■□●○▲△▼▽★☆※'
+
+# 資格分野の表示名
+FIELD_NAMES = {
+    'real_estate': '不動産',
+    'finance': '金融・保険',
+    'labor': '労務・社会保険',
+    'legal': '法律',
+    'technology': 'IT・技術',
+    'accounting': '会計・簿記',
+    'trade': '貿易・物流',
+    'travel': '旅行・観光',
+    'safety': '安全管理'
+}
+
+# 全分野共通で強調する重要用語
+UNIVERSAL_TERMS = (
+    '重要', '注意', 'ポイント', '必要', '義務', '権利', '責任',
+    '手続', '申請', '登録', '許可', '免許', '資格', '試験',
+    '法律', '規則', '規定', '基準', '要件', '条件'
+)
+
 class UniversalTextProcessor:
     """全資格対応汎用テキスト前処理クラス"""
     
@@ -19,10 +58,15 @@ class UniversalTextProcessor:
         # 講座マッパーの初期化
         self.course_mapper = CourseMapper(project_id)
         
+        # 講座情報のTTLキャッシュ（キー: 講座ID → (取得時刻, 講座情報)）
+        self._course_cache: Dict[str, Tuple[float, Dict]] = {}
+        self._course_cache_lock = threading.Lock()
+        
         # 汎用的な重要パターン（全資格共通）
         self.universal_patterns = {
             # 法律・規則関連
-            'legal_terms': r'([^\s]+(?:法|規則|規定|基準|要件|条例))',
+            # 空白を含まない語の途中から照合し直すと語長の2乗の時間がかかるため、語の先頭からのみ照合する
+            'legal_terms': r'(?<!\S)([^\s]+(?:法|規則|規定|基準|要件|条例))',
             'articles': r'([第]?\d+条[の]?\d*(?:第\d+項)?)',
             'procedures': r'([^\s]+(?:手続|申請|届出|登録|許可|認定|免許|資格))',
             
@@ -36,69 +80,154 @@ class UniversalTextProcessor:
         
         # 資格分野別の特化キーワード（動的に更新可能）
         self.field_keywords = self._initialize_field_keywords()
+        self._keyword_fields = self._build_keyword_fields()
+        self._keywords_need_lowercase = self._check_keywords_need_lowercase()
         
         # 除去対象パターン
+        # 装飾文字は固定の文字集合なので正規表現を使わずstr.translateで削除する
+        self._decorative_deletes = str.maketrans('', '', DECORATIVE_CHARS)
         self.removal_patterns = {
-            'decorative': r'[◆◇■□●○▲△▼▽★☆※]',
             'excessive_symbols': r'[！？]{2,}|[。、]{2,}',
             'urls': r'https?://[^\s]+',
             'emails': r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}',
         }
         
+        # 正規表現は初期化時に1回だけコンパイルする
+        self._re_heading = re.compile(r'(?:^|\n)([^\n]{1,50}とは[？?]?)\s*(?:\n|$)', re.MULTILINE)
+        self._re_legal_terms = re.compile(self.universal_patterns['legal_terms'])
+        self._re_articles = re.compile(self.universal_patterns['articles'])
+        self._re_qa = re.compile(self.universal_patterns['qa_pattern'], re.MULTILINE | re.DOTALL)
+        self._re_bullet = re.compile(r'(?:^|\n)・([^\n]+)', re.MULTILINE)
+        self._re_numlist = re.compile(r'(?:^|\n)(\d+)\.([^\n]+)', re.MULTILINE)
+        self._re_point = re.compile(r'(?:^|\n)(ポイント|重要|注意|要点|まとめ)[：:]([^\n]+)', re.MULTILINE)
+        # 除去パターンは装飾文字の削除後に定義順で1つずつ適用する
+        # （前の除去で隣り合った文字が次のパターンに一致する場合があるため、1つの選択パターンにはまとめない）
+        self._re_excessive_symbols = re.compile(self.removal_patterns['excessive_symbols'])
+        self._re_url = re.compile(self.removal_patterns['urls'])
+        self._re_email = re.compile(self.removal_patterns['emails'])
+        self._re_multi_nl = re.compile(r'\n\s*\n\s*\n+')
+        self._re_ws = re.compile(r'[ \t]+')
+        self._re_any_ws = re.compile(r'\s+')
+        self._re_tag = re.compile(r'<[^>]+>')
+        self._re_qa_number = re.compile(r'Q\d+:')
+        self._re_enhanced_term = re.compile(r'【[^】]+】')
+        # セクションの重要度計算に使う強調済みキーワード（1回の走査で全キーワードの出現数を数える）
+        self._re_priority_keywords = re.compile('|'.join(
+            re.escape(f'【{keyword}】')
+            for keyword in ('重要', '注意', 'ポイント', '必要', '義務', '権利', '法律', '規則')
+        ))
+        
+        # 強調する用語（分野別キーワード＋共通の重要用語）は長い順の選択パターンにまとめ、1回の走査で置換する
+        self._re_universal_terms = self._compile_term_alternation(UNIVERSAL_TERMS)
+        self._re_field_terms = {
+            field_type: self._compile_term_alternation([*keywords, *UNIVERSAL_TERMS])
+            for field_type, keywords in self.field_keywords.items()
+        }
+        
         logger.info("UniversalTextProcessor初期化完了")
     
-    def _initialize_field_keywords(self) -> Dict[str, List[str]]:
+    @staticmethod
+    def _compile_term_alternation(terms: List[str]) -> re.Pattern:
+        """用語リストを長い順の選択パターンにコンパイル（重なる用語は長い方を優先、splitで用語を残すためグループで囲む）"""
+        return re.compile('(' + '|'.join(map(re.escape, sorted(set(terms), key=len, reverse=True))) + ')')
+    
+    def _initialize_field_keywords(self) -> Dict[str, Tuple[str, ...]]:
         """資格分野別キーワードの初期化"""
         return {
             # 法律系資格
-            "legal": [
+            "legal": (
                 "法律", "条文", "規則", "規定", "手続", "申請", "届出", "登録", "許可", "免許",
                 "契約", "権利", "義務", "責任", "損害", "賠償", "処分", "罰則", "違反"
-            ],
+            ),
             
             # 不動産系資格
-            "real_estate": [
+            "real_estate": (
                 "宅建業法", "重要事項説明", "媒介契約", "売買契約", "賃貸借", "都市計画法",
                 "建築基準法", "区分所有法", "マンション", "管理組合", "修繕", "供託"
-            ],
+            ),
             
             # 金融・保険系資格
-            "finance": [
+            "finance": (
                 "ライフプランニング", "リスク管理", "金融資産", "タックスプランニング", "相続",
                 "投資信託", "証券", "保険", "年金", "税金", "控除", "所得", "資産運用"
-            ],
+            ),
             
             # 労務・社会保険系資格
-            "labor": [
+            "labor": (
                 "労働基準法", "社会保険", "労災", "雇用保険", "年金", "健康保険", "厚生年金",
                 "労働契約", "就業規則", "賃金", "休暇", "解雇", "退職"
-            ],
+            ),
             
             # IT・技術系資格
-            "technology": [
+            "technology": (
                 "システム", "データベース", "ネットワーク", "セキュリティ", "プログラミング",
                 "アルゴリズム", "データ構造", "開発", "設計", "テスト", "運用", "保守"
-            ],
+            ),
             
             # 会計・簿記系資格
-            "accounting": [
+            "accounting": (
                 "仕訳", "貸借対照表", "損益計算書", "減価償却", "棚卸資産", "固定資産",
                 "流動資産", "負債", "資本", "収益", "費用", "決算", "税務"
-            ],
+            ),
             
             # 貿易・物流系資格
-            "trade": [
+            "trade": (
                 "関税法", "通関業法", "輸出入", "税関", "関税", "貿易", "通関", "検査",
                 "申告", "許可", "承認", "輸出", "輸入", "原産地"
-            ],
+            ),
             
             # 旅行・観光系資格
-            "travel": [
+            "travel": (
                 "旅行業法", "旅行業務", "取扱管理者", "企画旅行", "手配旅行", "旅程管理",
                 "添乗", "宿泊", "運送", "観光", "ツアー", "パッケージ"
-            ]
+            )
         }
     
+    def _build_keyword_fields(self) -> Dict[str, List[Tuple[str, List[str]]]]:
+        """
+        先頭文字 → (キーワード, そのキーワードを持つ分野のリスト) のリスト
+        
+        複数分野に属するキーワードも1回の検索で済ませ、先頭文字がテキストに無いキーワードは検索しない
+        """
+        keyword_fields: Dict[str, List[str]] = {}
+        for field, keywords in self.field_keywords.items():
+            for keyword in keywords:
+                keyword_fields.setdefault(keyword, []).append(field)
+        
+        keyword_fields_by_first_char: Dict[str, List[Tuple[str, List[str]]]] = {}
+        for keyword, fields in keyword_fields.items():
+            if keyword:
+                keyword_fields_by_first_char.setdefault(keyword[0], []).append((keyword, fields))
+        return keyword_fields_by_first_char
+    
+    def _check_keywords_need_lowercase(self) -> bool:
+        """
+        分野の推定前にテキストを小文字化する必要があるか
+        
+        大文字・小文字の区別が無い文字（日本語等）のみのキーワードは小文字化の有無で一致結果が変わらない
+        （U+0307はİの小文字化で生じるため除く）
+        """
+        return any(
+            keyword.lower() != keyword or keyword.upper() != keyword or '\u0307' in keyword
+            for keywords in self.field_keywords.values()
+            for keyword in keywords
+        )
+    
+    def _cached_course_info(self, koza_id: str) -> Dict:
+        """講座IDから講座情報を取得（TTLキャッシュ付き、期限切れ・未取得の場合のみBigQueryを参照）"""
+        now = time.monotonic()
+        with self._course_cache_lock:
+            entry = self._course_cache.get(koza_id)
+            if entry and now - entry[0] < COURSE_CACHE_TTL_SECONDS:
+                return entry[1]
+        
+        course_info = self.course_mapper.get_course_info(koza_id)
+        with self._course_cache_lock:
+            if len(self._course_cache) >= COURSE_CACHE_MAX_SIZE:
+                self._course_cache.clear()
+            self._course_cache[koza_id] = (now, course_info)
+        return course_info
+    
     def process_article_content(self, full_content: str, qanda_content: str, 
                               title: str = "", koza_id: str = "") -> str:
         """
@@ -125,7 +254,7 @@ class UniversalTextProcessor:
             title_text = self._clean_html_and_basic(title)
             
             # 2. 講座情報の取得
-            course_info = self.course_mapper.get_course_info(str(koza_id)) if koza_id else {}
+            course_info = self._cached_course_info(str(koza_id)) if koza_id else {}
             
             # 3. 資格分野の特定
             field_type = self._identify_field_type(course_info, full_text, title_text)
@@ -162,40 +291,32 @@ class UniversalTextProcessor:
     def _identify_field_type(self, course_info: Dict, content: str, title: str) -> str:
         """資格分野を特定"""
         
-        # 講座名やスラッグから分野を推定
-        course_name = course_info.get('name', '').lower()
-        course_slug = course_info.get('slug', '').lower()
-        
-        # 分野マッピング
-        field_mapping = {
-            'real_estate': ['宅建', '宅地建物', 'マンション管理', '管理業務', 'takken', 'mankan'],
-            'finance': ['fp', 'ファイナンシャル', '証券', '年金', 'gaimuin', 'nenkin'],
-            'labor': ['社会保険労務士', '社労士', 'sharoushi'],
-            'legal': ['行政書士', '司法書士', 'gyosei', 'shoshi'],
-            'technology': ['it', '基本情報', 'fe', 'システム'],
-            'accounting': ['簿記', 'boki'],
-            'trade': ['通関士', 'tsukanshi'],
-            'travel': ['旅行', 'ryokou'],
-            'safety': ['危険物', 'kikenbutsu']
-        }
-        
-        # 講座情報から分野を特定
-        for field, keywords in field_mapping.items():
-            for keyword in keywords:
-                if keyword in course_name or keyword in course_slug:
-                    return field
-        
-        # コンテンツから分野を推定
-        combined_text = (content + ' ' + title).lower()
-        
-        field_scores = {}
-        for field, keywords in self.field_keywords.items():
-            score = sum(1 for keyword in keywords if keyword in combined_text)
-            if score > 0:
-                field_scores[field] = score
-        
-        if field_scores:
-            return max(field_scores, key=field_scores.get)
+        # 講座情報から分野を特定（CourseMapperが取得時に付与した分野を優先し、無ければ講座名・スラッグから推定）
+        field_type = course_info.get('field_type')
+        if field_type is None:
+            field_type = identify_course_field_type(course_info.get('name', ''), course_info.get('slug', ''))
+        if field_type != 'general':
+            return field_type
+        
+        # コンテンツから分野を推定（キーワードが日本語のみであれば小文字化は不要）
+        combined_text = f"{content} {title}"
+        if self._keywords_need_lowercase:
+            combined_text = combined_text.lower()
+        
+        # 各キーワードを1回だけ検索し、出現したキーワード数を分野ごとに数える
+        # （同点の場合はfield_keywordsの順で先の分野を選ぶ）
+        field_scores = dict.fromkeys(self.field_keywords, 0)
+        for first_char, keyword_fields in self._keyword_fields.items():
+            if first_char not in combined_text:
+                continue
+            for keyword, fields in keyword_fields:
+                if keyword in combined_text:
+                    for field in fields:
+                        field_scores[field] += 1
+        
+        best_field = max(field_scores, key=field_scores.get, default=None)
+        if best_field is not None and field_scores[best_field] > 0:
+            return best_field
         
         return 'general'  # デフォルト
     
@@ -206,18 +327,18 @@ class UniversalTextProcessor:
         
         # 基本的な構造化
         # 見出し構造の正規化
-        text = re.sub(r'(?:^|\n)([^\n]{1,50}とは[？?]?)\s*(?:\n|$)', r'\n【\1】\n', text, flags=re.MULTILINE)
+        text = self._re_heading.sub(r'\n【\1】\n', text)
         
         # 条文・規則参照の正規化
-        text = re.sub(self.universal_patterns['legal_terms'], r'《\1》', text)
-        text = re.sub(self.universal_patterns['articles'], r'《\1》', text)
+        text = self._re_legal_terms.sub(r'《\1》', text)
+        text = self._re_articles.sub(r'《\1》', text)
         
         # リスト項目の正規化
-        text = re.sub(r'(?:^|\n)・([^\n]+)', r'\n- \1', text, flags=re.MULTILINE)
-        text = re.sub(r'(?:^|\n)(\d+)\.([^\n]+)', r'\n\1. \2', text, flags=re.MULTILINE)
+        text = self._re_bullet.sub(r'\n- \1', text)
+        text = self._re_numlist.sub(r'\n\1. \2', text)
         
         # 重要ポイントの強調
-        text = re.sub(r'(?:^|\n)(ポイント|重要|注意|要点|まとめ)[：:]([^\n]+)', r'\n★\1: \2', text, flags=re.MULTILINE)
+        text = self._re_point.sub(r'\n★\1: \2', text)
         
         return text
     
@@ -227,14 +348,14 @@ class UniversalTextProcessor:
             return ""
         
         # Q&Aペアの抽出と構造化
-        qa_matches = re.findall(self.universal_patterns['qa_pattern'], text, re.MULTILINE | re.DOTALL)
+        qa_matches = self._re_qa.findall(text)
         
         if qa_matches:
             structured_qa = []
             for i, (question, answer) in enumerate(qa_matches, 1):
                 # 質問と回答のクリーニング
-                clean_q = re.sub(r'\s+', ' ', question.strip())
-                clean_a = re.sub(r'\s+', ' ', answer.strip())
+                clean_q = self._re_any_ws.sub(' ', question.strip())
+                clean_a = self._re_any_ws.sub(' ', answer.strip())
                 
                 structured_qa.append(f"Q{i}: {clean_q}")
                 structured_qa.append(f"A{i}: {clean_a}")
@@ -248,25 +369,14 @@ class UniversalTextProcessor:
         if not text:
             return ""
         
-        # 分野特有のキーワードを強調
-        if field_type in self.field_keywords:
-            keywords = self.field_keywords[field_type]
-            for keyword in keywords:
-                if keyword in text:
-                    text = text.replace(keyword, f'【{keyword}】')
-        
-        # 汎用的な重要用語の強調
-        universal_terms = [
-            '重要', '注意', 'ポイント', '必要', '義務', '権利', '責任',
-            '手続', '申請', '登録', '許可', '免許', '資格', '試験',
-            '法律', '規則', '規定', '基準', '要件', '条件'
-        ]
-        
-        for term in universal_terms:
-            if term in text:
-                text = text.replace(term, f'【{term}】')
-        
-        return text
+        # 分野特有のキーワードと汎用的な重要用語を1回の走査で強調
+        pattern = self._re_field_terms.get(field_type, self._re_universal_terms)
+        # splitの奇数番目が一致した用語なので、そこだけ囲んでから1回で連結する
+        parts = pattern.split(text)
+        if len(parts) == 1:
+            return text
+        parts[1::2] = [f'【{term}】' for term in parts[1::2]]
+        return ''.join(parts)
     
     def _combine_content_with_metadata(self, title: str, full_content: str, 
                                      qanda_content: str, course_info: Dict, field_type: str) -> str:
@@ -284,19 +394,7 @@ class UniversalTextProcessor:
                 parts.append(f"講座: {course_name}")
         
         if field_type and field_type != 'general':
-            field_names = {
-                'real_estate': '不動産',
-                'finance': '金融・保険',
-                'labor': '労務・社会保険',
-                'legal': '法律',
-                'technology': 'IT・技術',
-                'accounting': '会計・簿記',
-                'trade': '貿易・物流',
-                'travel': '旅行・観光',
-                'safety': '安全管理'
-            }
-            field_name = field_names.get(field_type, field_type)
-            parts.append(f"分野: {field_name}")
+            parts.append(f"分野: {FIELD_NAMES.get(field_type, field_type)}")
         
         # 3. 本文（重要度高）
         if full_content.strip():
@@ -313,28 +411,54 @@ class UniversalTextProcessor:
         if not text:
             return ""
         
+        # タグ・エンティティを含まないテキスト（タイトル・プレーンテキストのQ&A等）はパーサーを通さない
+        # selectolaxと同じ結果になるよう、改行コードを揃え、先頭の空白とNUL文字を除く
+        if '<' not in text and '&' not in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n').lstrip(' \t\n\x0c').replace('\x00', '')
+            return unicodedata.normalize('NFKC', text)
+        
+        # タグが無くエンティティが少ないテキスト（Q&A等）もDOMを構築しない
+        # パーサーのエンティティ展開（展開後の先頭の空白も除かれる）を再現してから、通常経路と同じくもう一度展開する
+        if '<' not in text and text.count('&') <= ENTITY_ONLY_FAST_PATH_MAX_ENTITIES:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+            text = html.unescape(text).lstrip(' \t\n\x0c\r').replace('\x00', '')
+            return unicodedata.normalize('NFKC', html.unescape(text))
+        
+        clean_text = self._extract_html_text(text)
+        if clean_text is None:
+            return text
+        
+        # HTMLエンティティのデコード
+        clean_text = html.unescape(clean_text)
+        
+        # Unicode正規化
+        return unicodedata.normalize('NFKC', clean_text)
+    
+    def _extract_html_text(self, text: str) -> Optional[str]:
+        """不要タグを除いたHTMLのテキストを抽出（解析に失敗した場合はNone）"""
+        # selectolax（C実装のパーサー）でHTMLタグを除去
+        try:
+            tree = LexborHTMLParser(text)
+        except Exception as e:
+            logger.warning(f"selectolaxでのHTML解析エラー、BeautifulSoupで再試行: {str(e)}")
+        else:
+            for node in tree.css(_SKIP_TAGS_SELECTOR):
+                node.decompose()
+            return tree.root.text() if tree.root is not None else ""
+        
+        # BeautifulSoupでHTMLタグを除去
         try:
-            # BeautifulSoupでHTMLタグを除去
             soup = BeautifulSoup(text, 'html.parser')
-            
-            # 不要なタグを完全に削除
-            for tag in soup(['script', 'style', 'meta', 'link', 'nav', 'footer']):
-                tag.decompose()
-            
-            # テキストのみを抽出
-            clean_text = soup.get_text()
-            
-            # HTMLエンティティのデコード
-            clean_text = html.unescape(clean_text)
-            
-            # Unicode正規化
-            clean_text = unicodedata.normalize('NFKC', clean_text)
-            
-            return clean_text
-            
         except Exception as e:
             logger.warning(f"HTML除去エラー: {str(e)}")
-            return text
+            return None
+        
+        # 不要なタグを完全に削除
+        for tag in soup(SKIP_TAGS):
+            tag.decompose()
+        
+        # テキストのみを抽出
+        return soup.get_text()
     
     def _final_normalization(self, text: str) -> str:
         """最終正規化処理"""
@@ -342,13 +466,18 @@ class UniversalTextProcessor:
             return ""
         
         # 不要パターンの除去
-        for pattern_name, pattern in self.removal_patterns.items():
-            text = re.sub(pattern, '', text)
-        
-        # 連続する空白・改行の正規化
-        text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)  # 3つ以上の改行を2つに
-        text = re.sub(r'[ \t]+', ' ', text)  # 連続するスペース・タブを1つに
-        text = re.sub(r'\n ', '\n', text)  # 行頭のスペースを除去
+        text = text.translate(self._decorative_deletes)
+        text = self._re_excessive_symbols.sub('', text)
+        text = self._re_url.sub('', text)
+        if '@' in text:
+            text = self._re_email.sub('', text)
+        
+        # 連続する空白・改行の正規化（置換対象が無い場合は走査を省く）
+        text = self._re_multi_nl.sub('\n\n', text)  # 3つ以上の改行を2つに
+        if '\t' in text or '  ' in text:
+            text = self._re_ws.sub(' ', text)  # 連続するスペース・タブを1つに
+        if '\n ' in text:
+            text = text.replace('\n ', '\n')  # 行頭のスペースを除去
         
         # 文字数制限の適用
         if len(text) > self.max_length:
@@ -364,28 +493,30 @@ class UniversalTextProcessor:
         # セクション別に分割
         sections = text.split('\n\n')
         
-        # 重要度順にソート
-        priority_sections = []
-        for section in sections:
-            priority = self._calculate_section_priority(section)
-            priority_sections.append((priority, section))
-        
-        priority_sections.sort(key=lambda x: x[0], reverse=True)
-        
-        # 重要度の高いセクションから順に追加
-        result = ""
-        for priority, section in priority_sections:
-            if len(result + section + '\n\n') <= self.max_length:
-                result += section + '\n\n'
+        # 重要度の高い順（同じ重要度なら元の順序）に取り出すヒープ
+        # 上限に達した時点で打ち切るため、全体のソートは行わない
+        priority_heap = [
+            (-self._calculate_section_priority(section), index, section)
+            for index, section in enumerate(sections)
+        ]
+        heapq.heapify(priority_heap)
+        
+        # 重要度の高いセクションから順に追加（文字数は加算で管理し、結合は最後に1回）
+        kept_sections = []
+        current_length = 0
+        while priority_heap:
+            _, _, section = heapq.heappop(priority_heap)
+            if current_length + len(section) + 2 <= self.max_length:
+                kept_sections.append(section + '\n\n')
+                current_length += len(section) + 2
             else:
                 # 残り文字数で可能な限り追加
-                remaining = self.max_length - len(result)
+                remaining = self.max_length - current_length
                 if remaining > 100:  # 最低100文字は確保
-                    truncated_section = section[:remaining-10] + "..."
-                    result += truncated_section
+                    kept_sections.append(section[:remaining-10] + "...")
                 break
         
-        return result.strip()
+        return ''.join(kept_sections).strip()
     
     def _calculate_section_priority(self, section: str) -> int:
         """セクションの重要度を計算"""
@@ -399,13 +530,11 @@ class UniversalTextProcessor:
         if section.startswith('講座:') or section.startswith('分野:'):
             priority += 90
         
-        # 重要キーワードの含有数
-        important_keywords = ['重要', '注意', 'ポイント', '必要', '義務', '権利', '法律', '規則']
-        for keyword in important_keywords:
-            priority += section.count(f'【{keyword}】') * 10
+        # 重要キーワードの含有数（【】で囲まれたキーワード同士は重ならないため、各キーワードの出現数の合計と一致する）
+        priority += len(self._re_priority_keywords.findall(section)) * 10
         
         # 条文参照の含有数
-        article_refs = re.findall(self.universal_patterns['articles'], section)
+        article_refs = self._re_articles.findall(section)
         priority += len(article_refs) * 5
         
         # Q&Aセクション
@@ -433,10 +562,10 @@ class UniversalTextProcessor:
             combined = '\n\n'.join(parts)
             
             # HTMLタグの簡易除去
-            combined = re.sub(r'<[^>]+>', '', combined)
+            combined = self._re_tag.sub('', combined)
             
             # 基本的な正規化
-            combined = re.sub(r'\s+', ' ', combined)
+            combined = self._re_any_ws.sub(' ', combined)
             
             # 長さ制限
             if len(combined) > self.max_length:
@@ -451,7 +580,7 @@ class UniversalTextProcessor:
     def get_processing_stats(self, original_full: str, original_qanda: str, processed: str, 
                            course_id: str = "") -> Dict:
         """処理統計情報の取得"""
-        course_info = self.course_mapper.get_course_info(course_id) if course_id else {}
+        course_info = self._cached_course_info(course_id) if course_id else {}
         course_name = course_info.get('name', 'Unknown')
         
         # 分野の特定
@@ -462,23 +591,29 @@ class UniversalTextProcessor:
             'original_qanda_length': len(original_qanda or ''),
             'processed_length': len(processed),
             'compression_ratio': len(processed) / (len(original_full or '') + len(original_qanda or '') + 1),
-            'has_legal_terms': bool(re.search(self.universal_patterns['legal_terms'], processed)),
-            'has_article_refs': bool(re.search(self.universal_patterns['articles'], processed)),
-            'qa_count': len(re.findall(r'Q\d+:', processed)),
+            'has_legal_terms': bool(self._re_legal_terms.search(processed)),
+            'has_article_refs': bool(self._re_articles.search(processed)),
+            'qa_count': len(self._re_qa_number.findall(processed)),
             'course_id': course_id,
             'course_name': course_name,
             'field_type': field_type,
-            'enhanced_terms_count': len(re.findall(r'【[^】]+】', processed))
+            'enhanced_terms_count': len(self._re_enhanced_term.findall(processed))
         }
     
     def update_field_keywords(self, field_type: str, new_keywords: List[str]):
         """分野別キーワードの動的更新"""
-        if field_type not in self.field_keywords:
-            self.field_keywords[field_type] = []
-        
-        # 重複を避けて追加
-        for keyword in new_keywords:
-            if keyword not in self.field_keywords[field_type]:
-                self.field_keywords[field_type].append(keyword)
+        keywords = self.field_keywords.get(field_type, ())
+        
+        # 重複を避けて追加（キーワードはタプルで保持するため作り直す）
+        self.field_keywords[field_type] = keywords + tuple(
+            keyword for keyword in dict.fromkeys(new_keywords) if keyword not in keywords
+        )
+        
+        # 分野特定用の索引と強調用のパターンを更新後のキーワードで作り直す
+        self._keyword_fields = self._build_keyword_fields()
+        self._keywords_need_lowercase = self._check_keywords_need_lowercase()
+        self._re_field_terms[field_type] = self._compile_term_alternation(
+            [*self.field_keywords[field_type], *UNIVERSAL_TERMS]
+        )
         
         logger.info(f"分野 {field_type} のキーワードを更新: {len(new_keywords)}個追加")
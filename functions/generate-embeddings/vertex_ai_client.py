@@ -1,14 +1,79 @@
 from google.cloud import aiplatform
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional
 import time
-import json
-import requests
+import orjson
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.auth import default
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession
 
 logger = logging.getLogger(__name__)
 
+# 埋め込みに使用するモデル（先頭から順に試す）
+EMBEDDING_MODEL_NAMES = (
+    "text-embedding-004",
+    "textembedding-gecko@latest",
+    "textembedding-gecko@003",
+    "textembedding-gecko@002",
+    "textembedding-gecko@001",
+)
+
+# 埋め込みベクトルの次元数（EMBEDDING_MODEL_NAMESのモデルはいずれも768次元）
+EMBEDDING_DIMENSION = 768
+
+# 埋め込みAPIへの1分あたりのリクエスト数の上限（トークンバケットで制御）
+EMBEDDING_REQUESTS_PER_MINUTE = 600
+
+# 1リクエストあたりのテキスト数の上限（APIの上限は250件）
+EMBEDDING_BATCH_MAX_INSTANCES = 25
+
+# 1リクエストあたりの合計文字数の上限（APIの合計2万トークンの上限に収まるよう余裕を持たせる）
+EMBEDDING_BATCH_CHAR_BUDGET = 15000
+
+# 同時に送信するバッチリクエスト数
+EMBEDDING_BATCH_MAX_WORKERS = 4
+
+# HTTPコネクションプールのサイズ（並列ワーカー数より大きく取る）
+HTTP_POOL_SIZE = 32
+
+# バッチリクエストで再試行するHTTPステータス（レート制限・一時的なサーバーエラー）
+RETRYABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+# リトライ待機時間（指数バックオフの上限までの範囲でランダムに待機し、同時リトライの集中を避ける）
+RETRY_BASE_WAIT_SECONDS = 1.0
+RETRY_MAX_WAIT_SECONDS = 30.0
+
+def _retry_wait_seconds(attempt: int) -> float:
+    """attempt回目の失敗後の待機秒数（フルジッター付き指数バックオフ）"""
+    return random.uniform(0, min(RETRY_MAX_WAIT_SECONDS, RETRY_BASE_WAIT_SECONDS * (2 ** (attempt + 1))))
+
+class TokenBucket:
+    """スレッドセーフなトークンバケット（バーストは容量まで許可し、枯渇時のみ待機する）"""
+    
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.fill_rate = rate_per_minute / 60.0
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """トークンを1つ取得する（なければ補充されるまで待機）"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.fill_rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self.fill_rate
+            time.sleep(wait_seconds)
+
 class VertexAIClient:
     """Vertex AI Text Embeddings APIクライアント（修正版）"""
     
@@ -24,6 +89,23 @@ class VertexAIClient:
         # 認証情報の取得
         self.credentials, _ = default()
         
+        # コネクションを使い回すセッション（アクセストークンは期限切れ時のみ自動で更新される）
+        # 接続エラーのみアダプターで再試行し、HTTPステータスによる再試行は各メソッドで行う
+        self.session = AuthorizedSession(self.credentials)
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=3, backoff_factor=0.2)
+        )
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        
+        # 並列リクエストがAPIクォータを超えないよう送信レートを制御
+        self.rate_limiter = TokenBucket(EMBEDDING_REQUESTS_PER_MINUTE)
+        
+        # SDK版で読み込んだモデル（モデル名 → TextEmbeddingModel）。呼び出しごとのモデル情報の取得を省く
+        self._sdk_models = {}
+        
         # APIエンドポイント
         self.endpoint = f"https://{location}-aiplatform.googleapis.com/v1/projects/{project_id}/locations/{location}/publishers/google/models/{self.model_name}:predict"
         
@@ -46,16 +128,6 @@ class VertexAIClient:
         
         for attempt in range(retry_count):
             try:
-                # アクセストークンの取得
-                self.credentials.refresh(Request())
-                access_token = self.credentials.token
-                
-                # リクエストヘッダー
-                headers = {
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/json'
-                }
-                
                 # リクエストボディ
                 payload = {
                     "instances": [
@@ -67,15 +139,16 @@ class VertexAIClient:
                 }
                 
                 # API呼び出し
-                response = requests.post(
+                self.rate_limiter.acquire()
+                response = self.session.post(
                     self.endpoint,
-                    headers=headers,
-                    json=payload,
+                    data=orjson.dumps(payload),
                     timeout=30
                 )
                 
                 if response.status_code == 200:
-                    result = response.json()
+                    # 埋め込みベクトルの浮動小数点数の解析が大半を占めるため、JSONの解析はorjsonで行う
+                    result = orjson.loads(response.content)
                     
                     if 'predictions' in result and len(result['predictions']) > 0:
                         prediction = result['predictions'][0]
@@ -99,9 +172,9 @@ class VertexAIClient:
                         self.endpoint = f"https://{self.location}-aiplatform.googleapis.com/v1/projects/{self.project_id}/locations/{self.location}/publishers/google/models/{self.model_name}:predict"
                         continue
                     
-                    if attempt < retry_count - 1:
-                        wait_time = (2 ** attempt) + 1
-                        logger.info(f"{wait_time}秒待機してリトライします")
+                    if response.status_code in RETRYABLE_STATUS_CODES and attempt < retry_count - 1:
+                        wait_time = _retry_wait_seconds(attempt)
+                        logger.info(f"{wait_time:.1f}秒待機してリトライします")
                         time.sleep(wait_time)
                     else:
                         logger.error(f"埋め込み生成に失敗しました: {response.status_code} - {response.text}")
@@ -111,8 +184,8 @@ class VertexAIClient:
                 logger.warning(f"埋め込み生成試行 {attempt + 1}/{retry_count} 失敗: {str(e)}")
                 
                 if attempt < retry_count - 1:
-                    wait_time = (2 ** attempt) + 1
-                    logger.info(f"{wait_time}秒待機してリトライします")
+                    wait_time = _retry_wait_seconds(attempt)
+                    logger.info(f"{wait_time:.1f}秒待機してリトライします")
                     time.sleep(wait_time)
                 else:
                     logger.error(f"埋め込み生成に失敗しました: {str(e)}")
@@ -120,26 +193,25 @@ class VertexAIClient:
         
         return None
     
+    def _get_sdk_model(self, model_name: str):
+        """SDKの埋め込みモデルを取得（読み込み済みなら使い回す。SDKが無い場合はImportErrorを送出）"""
+        model = self._sdk_models.get(model_name)
+        if model is None:
+            from vertexai.language_models import TextEmbeddingModel
+            model = TextEmbeddingModel.from_pretrained(model_name)
+            self._sdk_models[model_name] = model
+        return model
+    
     def generate_embedding_with_sdk(self, text: str, retry_count: int = 3) -> Optional[List[float]]:
         """
         SDK使用版の埋め込み生成（フォールバック用）
         """
         try:
-            from vertexai.language_models import TextEmbeddingModel
-            
             # 利用可能なモデル名を順番に試す
-            model_names = [
-                "text-embedding-004",
-                "textembedding-gecko@latest", 
-                "textembedding-gecko@003",
-                "textembedding-gecko@002",
-                "textembedding-gecko@001"
-            ]
-            
-            for model_name in model_names:
+            for model_name in EMBEDDING_MODEL_NAMES:
                 try:
                     logger.info(f"モデル {model_name} で埋め込み生成を試行")
-                    model = TextEmbeddingModel.from_pretrained(model_name)
+                    model = self._get_sdk_model(model_name)
                     embeddings = model.get_embeddings([text])
                     
                     if embeddings and len(embeddings) > 0:
@@ -147,7 +219,9 @@ class VertexAIClient:
                         logger.info(f"埋め込み生成成功 (SDK) - モデル: {model_name}, 次元数: {len(embedding_vector)}")
                         self.model_name = model_name  # 成功したモデル名を保存
                         return embedding_vector
-                        
+                
+                except ImportError:
+                    raise
                 except Exception as e:
                     logger.warning(f"モデル {model_name} での生成失敗: {str(e)}")
                     continue
@@ -172,15 +246,7 @@ class VertexAIClient:
         available_models = []
         test_text = "これはテストです。"
         
-        model_names = [
-            "text-embedding-004",
-            "textembedding-gecko@latest",
-            "textembedding-gecko@003", 
-            "textembedding-gecko@002",
-            "textembedding-gecko@001"
-        ]
-        
-        for model_name in model_names:
+        for model_name in EMBEDDING_MODEL_NAMES:
             try:
                 # 一時的にモデル名を変更してテスト
                 original_model = self.model_name
@@ -206,29 +272,172 @@ class VertexAIClient:
         
         return available_models
     
-    def generate_embeddings_batch(self, texts: List[str], batch_size: int = 5) -> List[Optional[List[float]]]:
+    def _pack_batches(self, texts: List[str]) -> List[List[int]]:
+        """
+        空でないテキストのインデックスを、1リクエストの件数・文字数の上限に収まるようにまとめる
+        
+        Args:
+            texts: テキストのリスト
+            
+        Returns:
+            リクエストごとのインデックスのリスト
+        """
+        batches = []
+        current_batch = []
+        current_chars = 0
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                continue
+            if current_batch and (len(current_batch) >= EMBEDDING_BATCH_MAX_INSTANCES
+                                  or current_chars + len(text) > EMBEDDING_BATCH_CHAR_BUDGET):
+                batches.append(current_batch)
+                current_batch = []
+                current_chars = 0
+            current_batch.append(i)
+            current_chars += len(text)
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+    
+    def _predict_batch(self, texts: List[str], retry_count: int = 3) -> List[Optional[List[float]]]:
+        """
+        1リクエストで複数テキストの埋め込みを生成（REST API使用）
+        
+        Args:
+            texts: 空でないテキストのリスト
+            retry_count: リトライ回数
+            
+        Returns:
+            入力と同じ順序の埋め込みベクトルのリスト（失敗時はNone）
+        """
+        for attempt in range(retry_count):
+            try:
+                payload = {
+                    "instances": [
+                        {
+                            "content": text,
+                            "task_type": "RETRIEVAL_DOCUMENT"  # 文書検索用の埋め込み
+                        }
+                        for text in texts
+                    ]
+                }
+                
+                self.rate_limiter.acquire()
+                response = self.session.post(
+                    self.endpoint,
+                    data=orjson.dumps(payload),
+                    timeout=120
+                )
+                
+                if response.status_code == 200:
+                    predictions = orjson.loads(response.content).get('predictions', [])
+                    if len(predictions) != len(texts):
+                        logger.warning(f"予測結果の件数が一致しません: 期待値 {len(texts)}, 取得 {len(predictions)}")
+                    
+                    results = [None] * len(texts)
+                    for i, prediction in enumerate(predictions[:len(texts)]):
+                        values = prediction.get('embeddings', {}).get('values')
+                        if values:
+                            results[i] = values
+                    logger.info(f"バッチ埋め込み生成成功 - {sum(1 for r in results if r)}/{len(texts)}件")
+                    return results
+                
+                logger.warning(f"バッチAPI呼び出し失敗: {response.status_code} - {response.text}")
+                
+                # 合計トークン数の上限超過等で拒否された場合は半分ずつ送り直し、原因のテキストのみ失敗扱いにする
+                if response.status_code == 400 and len(texts) > 1:
+                    middle = len(texts) // 2
+                    return (self._predict_batch(texts[:middle], retry_count)
+                            + self._predict_batch(texts[middle:], retry_count))
+                
+                # 再試行しても結果が変わらないエラーは待機せずに失敗とする
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    break
+                
+            except Exception as e:
+                logger.warning(f"バッチ埋め込み生成試行 {attempt + 1}/{retry_count} 失敗: {str(e)}")
+            
+            if attempt < retry_count - 1:
+                wait_time = _retry_wait_seconds(attempt)
+                logger.info(f"{wait_time:.1f}秒待機してリトライします")
+                time.sleep(wait_time)
+        
+        logger.error(f"バッチ埋め込み生成に失敗しました ({len(texts)}件)")
+        return [None] * len(texts)
+    
+    def generate_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
         """
-        複数テキストの埋め込みをバッチ生成
+        複数テキストの埋め込みをバッチリクエストで生成
         
         Args:
             texts: テキストのリスト
-            batch_size: バッチサイズ
             
         Returns:
-            埋め込みベクトルのリスト
+            入力と同じ順序の埋め込みベクトルのリスト（空テキスト・失敗時はNone）
+        """
+        # 同じテキストは1回だけ送信し、結果を元の位置に展開する
+        unique_indexes: Dict[str, int] = {}
+        for text in texts:
+            unique_indexes.setdefault(text, len(unique_indexes))
+        if len(unique_indexes) < len(texts):
+            logger.info(f"重複テキストを除外: {len(texts)}件 → {len(unique_indexes)}件")
+            unique_embeddings = self.generate_embeddings_batch(list(unique_indexes))
+            return [unique_embeddings[unique_indexes[text]] for text in texts]
+        
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        batches = self._pack_batches(texts)
+        if not batches:
+            return results
+        
+        logger.info(f"バッチ埋め込み生成開始: {len(texts)}件 → {len(batches)}リクエスト")
+        
+        # バッチリクエストを並列送信（送信レートはトークンバケットで制御）
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_BATCH_MAX_WORKERS, len(batches))) as executor:
+            batch_results = executor.map(
+                lambda indexes: self._predict_batch([texts[i] for i in indexes]),
+                batches
+            )
+            for indexes, embeddings in zip(batches, batch_results):
+                for i, embedding in zip(indexes, embeddings):
+                    results[i] = embedding
+        
+        return results
+    
+    def generate_embeddings_batch_with_sdk(self, texts: List[str]) -> List[Optional[List[float]]]:
         """
-        results = []
+        SDK使用版のバッチ埋め込み生成（フォールバック用）
         
-        for i in range(0, len(texts), batch_size):
-            batch_texts = texts[i:i + batch_size]
-            logger.info(f"バッチ処理 {i//batch_size + 1}: {len(batch_texts)}件")
+        Args:
+            texts: テキストのリスト
             
-            # 個別に処理（REST APIの制限のため）
-            for text in batch_texts:
-                embedding = self.generate_embedding(text)
-                results.append(embedding)
+        Returns:
+            入力と同じ順序の埋め込みベクトルのリスト（空テキスト・失敗時はNone）
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        batches = self._pack_batches(texts)
+        if not batches:
+            return results
+        
+        for model_name in EMBEDDING_MODEL_NAMES:
+            try:
+                logger.info(f"モデル {model_name} でバッチ埋め込み生成を試行")
+                model = self._get_sdk_model(model_name)
+                for indexes in batches:
+                    embeddings = model.get_embeddings([texts[i] for i in indexes])
+                    for i, embedding in zip(indexes, embeddings):
+                        results[i] = embedding.values
                 
-                # API制限対策
-                time.sleep(0.1)
+                logger.info(f"バッチ埋め込み生成成功 (SDK) - モデル: {model_name}, {len(texts)}件")
+                self.model_name = model_name  # 成功したモデル名を保存
+                return results
+            
+            except ImportError:
+                logger.error("vertexai.language_models のインポートに失敗しました")
+                return [None] * len(texts)
+            except Exception as e:
+                logger.warning(f"モデル {model_name} でのバッチ生成失敗: {str(e)}")
+                results = [None] * len(texts)
+                continue
         
+        logger.error("すべてのモデルでバッチ埋め込み生成に失敗しました")
         return results
@@ -4,18 +4,84 @@ BigQuery クライアントモジュール
 """
 
 import logging
-from typing import List, Dict, Optional, Any
+from datetime import datetime, timezone
+from typing import List, Dict, Optional, Any, Tuple
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 
+try:
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import types as storage_types
+    from google.cloud.bigquery_storage_v1 import writer as storage_writer
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+    STORAGE_WRITE_AVAILABLE = True
+except ImportError:
+    STORAGE_WRITE_AVAILABLE = False
+
 logger = logging.getLogger(__name__)
 
+# この行数未満の挿入はStorage Write APIを使わずinsert_rows_jsonで送る（ストリーム確立の手間の方が大きいため）
+STORAGE_WRITE_MIN_ROWS = 100
+
+# Storage Write APIで送れる列の型 → protoの型
+# TIMESTAMP列はエポックからのマイクロ秒(INT64)で送る
+_STORAGE_WRITE_PROTO_TYPES = {
+    'STRING': 'TYPE_STRING',
+    'INTEGER': 'TYPE_INT64',
+    'INT64': 'TYPE_INT64',
+    'FLOAT': 'TYPE_DOUBLE',
+    'FLOAT64': 'TYPE_DOUBLE',
+    'BOOLEAN': 'TYPE_BOOL',
+    'BOOL': 'TYPE_BOOL',
+    'TIMESTAMP': 'TYPE_INT64',
+}
+
+
+def _build_row_message_class(table_name: str, schema: List[bigquery.SchemaField]):
+    """テーブルの1行を表すprotoメッセージクラスをスキーマから動的に生成する"""
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name=f"{table_name}_row.proto", package="similarity_cache", syntax="proto2"
+    )
+    message_proto = file_proto.message_type.add(name="Row")
+    for number, field in enumerate(schema, start=1):
+        label = 'LABEL_REPEATED' if field.mode == 'REPEATED' else 'LABEL_OPTIONAL'
+        message_proto.field.add(
+            name=field.name,
+            number=number,
+            type=descriptor_pb2.FieldDescriptorProto.Type.Value(_STORAGE_WRITE_PROTO_TYPES[field.field_type]),
+            label=descriptor_pb2.FieldDescriptorProto.Label.Value(label),
+        )
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName("similarity_cache.Row")
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+def _to_timestamp_micros(value: Any) -> int:
+    """TIMESTAMP列の値（datetimeまたはISO形式の文字列）をエポックからのマイクロ秒に変換"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1_000_000)
+
 class BigQueryClient:
     def __init__(self, project_id: str, dataset_id: str):
         """BigQuery クライアントの初期化"""
         self.project_id = project_id
         self.dataset_id = dataset_id
-        self.client = bigquery.Client(project=project_id)
+        # 短いクエリはジョブを作成せずに実行させる（未対応のライブラリでは従来どおりジョブを作成する）
+        try:
+            self.client = bigquery.Client(project=project_id, default_job_creation_mode="JOB_CREATION_OPTIONAL")
+        except TypeError:
+            self.client = bigquery.Client(project=project_id)
+        
+        # Storage Write APIのクライアントと、テーブルごとの (protoメッセージクラス, スキーマ) は初回の書き込み時に作成して使い回す
+        self._write_client = None
+        self._storage_row_classes: Dict[str, Optional[Tuple[Any, List[bigquery.SchemaField]]]] = {}
         
         logger.info(f"BigQuery クライアント初期化: {project_id}.{dataset_id}")
 
@@ -34,9 +100,8 @@ class BigQueryClient:
             if job_config is None:
                 job_config = bigquery.QueryJobConfig()
             
-            # クエリ実行
-            query_job = self.client.query(query, job_config=job_config)
-            results = query_job.result()
+            # クエリ実行（jobs.queryで結果を直接受け取り、時間のかかるクエリのみ完了を待って取得する）
+            results = self.client.query_and_wait(query, job_config=job_config)
             
             # 結果をリストに変換
             result_list = list(results)
@@ -208,6 +273,9 @@ class BigQueryClient:
         """
         バッチ挿入（リトライ機能付き）
         
+        まとまった行数はStorage Write APIのデフォルトストリームで1本の接続から全バッチを送信し、
+        失敗したバッチと少量の挿入はinsert_rows_jsonで送る
+        
         Args:
             table_name: 挿入先テーブル名
             rows: 挿入するデータのリスト
@@ -218,12 +286,25 @@ class BigQueryClient:
             成功した場合True
         """
         total_rows = len(rows)
+        if total_rows == 0:
+            return True
+        
+        batches = [rows[i:i + batch_size] for i in range(0, total_rows, batch_size)]
+        total_batches = len(batches)
         successful_batches = 0
         
-        for i in range(0, total_rows, batch_size):
-            batch_rows = rows[i:i + batch_size]
-            batch_num = (i // batch_size) + 1
-            total_batches = (total_rows + batch_size - 1) // batch_size
+        pending_indexes = list(range(total_batches))
+        if STORAGE_WRITE_AVAILABLE and total_rows >= STORAGE_WRITE_MIN_ROWS:
+            try:
+                pending_indexes = self._append_rows_with_storage_api(table_name, batches)
+                successful_batches = total_batches - len(pending_indexes)
+                logger.info(f"Storage Write APIで{successful_batches}/{total_batches}バッチ挿入完了")
+            except Exception as e:
+                logger.warning(f"Storage Write APIでの挿入に失敗したため、insert_rows_jsonにフォールバックします: {str(e)}")
+        
+        for index in pending_indexes:
+            batch_rows = batches[index]
+            batch_num = index + 1
             
             retry_count = 0
             while retry_count < max_retries:
@@ -245,7 +326,113 @@ class BigQueryClient:
                 if retry_count >= max_retries:
                     logger.error(f"バッチ {batch_num} が最大リトライ回数に達しました")
         
-        success_rate = successful_batches / ((total_rows + batch_size - 1) // batch_size)
+        success_rate = successful_batches / total_batches
         logger.info(f"バッチ挿入完了: {successful_batches}バッチ成功 (成功率: {success_rate:.1%})")
         
         return success_rate > 0.8  # 80%以上成功で成功とみなす
+
+    def _get_storage_row_class(self, table_name: str) -> Optional[Tuple[Any, List[bigquery.SchemaField]]]:
+        """テーブルの (protoメッセージクラス, スキーマ) を取得（Storage Write APIで送れない型の列があればNone）"""
+        if table_name not in self._storage_row_classes:
+            table = self.client.get_table(self.client.dataset(self.dataset_id).table(table_name))
+            schema = list(table.schema)
+            unsupported = [field.name for field in schema if field.field_type not in _STORAGE_WRITE_PROTO_TYPES]
+            if unsupported:
+                logger.info(f"テーブル {table_name} にStorage Write API非対応の列があります: {unsupported}")
+                self._storage_row_classes[table_name] = None
+            else:
+                self._storage_row_classes[table_name] = (_build_row_message_class(table_name, schema), schema)
+        return self._storage_row_classes[table_name]
+
+    def _append_rows_with_storage_api(self, table_name: str, batches: List[List[Dict]]) -> List[int]:
+        """
+        Storage Write APIのデフォルトストリームで全バッチを送信（送信後すぐに読み取り可能になる）
+        
+        Args:
+            table_name: 挿入先テーブル名
+            batches: 挿入するデータのバッチのリスト
+            
+        Returns:
+            書き込めなかったバッチの番号のリスト
+        """
+        row_class_and_schema = self._get_storage_row_class(table_name)
+        if row_class_and_schema is None:
+            return list(range(len(batches)))
+        row_class, schema = row_class_and_schema
+        field_names = {field.name for field in schema}
+        
+        if self._write_client is None:
+            self._write_client = bigquery_storage_v1.BigQueryWriteClient()
+        parent = self._write_client.table_path(self.project_id, self.dataset_id, table_name)
+        
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        row_class.DESCRIPTOR.CopyToProto(proto_descriptor)
+        request_template = storage_types.AppendRowsRequest(
+            write_stream=f"{parent}/streams/_default",
+            proto_rows=storage_types.AppendRowsRequest.ProtoData(
+                writer_schema=storage_types.ProtoSchema(proto_descriptor=proto_descriptor)
+            ),
+        )
+        append_rows_stream = storage_writer.AppendRowsStream(self._write_client, request_template)
+        
+        failed_indexes = []
+        futures = []
+        try:
+            # 全バッチを応答を待たずに送信し、最後にまとめて結果を確認する
+            for index, batch_rows in enumerate(batches):
+                # スキーマに無い列を含むバッチはinsert_rows_jsonに回し、従来どおりエラーとして報告させる
+                if any(not field_names.issuperset(row) for row in batch_rows):
+                    failed_indexes.append(index)
+                    continue
+                try:
+                    proto_rows = storage_types.ProtoRows()
+                    for row in batch_rows:
+                        proto_rows.serialized_rows.append(self._to_storage_row(row_class, schema, row).SerializeToString())
+                except (TypeError, ValueError, AttributeError) as e:
+                    logger.warning(f"バッチ {index + 1} をStorage Write API用に変換できません: {str(e)}")
+                    failed_indexes.append(index)
+                    continue
+                request = storage_types.AppendRowsRequest(
+                    proto_rows=storage_types.AppendRowsRequest.ProtoData(rows=proto_rows),
+                )
+                try:
+                    futures.append((index, append_rows_stream.send(request)))
+                except Exception as e:
+                    # ストリームが使えなくなった場合、未送信のバッチはすべてinsert_rows_jsonに回す
+                    logger.warning(f"バッチ {index + 1} 以降をStorage Write APIで送信できません: {str(e)}")
+                    failed_indexes.extend(range(index, len(batches)))
+                    break
+            
+            # 行エラーのあるリクエストは1行も書き込まれないため、そのバッチはそのまま再送できる
+            for index, future in futures:
+                try:
+                    response = future.result()
+                    if response.row_errors:
+                        logger.warning(f"バッチ {index + 1} でStorage Write APIの行エラー: {list(response.row_errors)[:5]}")
+                        failed_indexes.append(index)
+                except Exception as e:
+                    logger.warning(f"バッチ {index + 1} でStorage Write APIのエラー: {str(e)}")
+                    failed_indexes.append(index)
+        finally:
+            try:
+                append_rows_stream.close()
+            except Exception as e:
+                logger.warning(f"Storage Write APIのストリーム終了でエラー: {str(e)}")
+        
+        return sorted(failed_indexes)
+
+    @staticmethod
+    def _to_storage_row(row_class, schema: List[bigquery.SchemaField], row: Dict):
+        """行のdictをprotoメッセージに変換する"""
+        message = row_class()
+        for field in schema:
+            value = row.get(field.name)
+            if value is None:
+                continue
+            if field.field_type == 'TIMESTAMP':
+                value = [_to_timestamp_micros(item) for item in value] if field.mode == 'REPEATED' else _to_timestamp_micros(value)
+            if field.mode == 'REPEATED':
+                getattr(message, field.name).extend(value)
+            else:
+                setattr(message, field.name, value)
+        return message